@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Compare the AESGCM one-shot path with the Cipher update/finalize path.
+
+Usage: python benchmarks/bench_aes_gcm.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+
+from common import best_of, print_table
+
+from profanity_omemo_plugin.omemo import aes_gcm_native as native
+
+SIZES = (16, 256, 4096, 65536, 1024 * 1024)
+
+
+def label(size):
+    if size >= 1024 * 1024:
+        return '{0} MiB'.format(size // (1024 * 1024))
+    if size >= 1024:
+        return '{0} KiB'.format(size // 1024)
+    return '{0} B'.format(size)
+
+
+def main():
+    key = os.urandom(16)
+    iv = os.urandom(16)
+
+    rows = []
+    for size in SIZES:
+        plaintext = os.urandom(size)
+        payload, tag = native.aes_encrypt(key, iv, plaintext)
+        legacy_payload = payload + tag
+        number = max(50, 20000 // max(1, size // 256))
+
+        row = [label(size)]
+        for encrypt, decrypt in ((native._cipher_encrypt,
+                                  native._cipher_decrypt),
+                                 (native._aead_encrypt,
+                                  native._aead_decrypt),
+                                 (native.aes_encrypt,
+                                  native.aes_decrypt)):
+            row.append('{0:.1f}'.format(
+                best_of(lambda: encrypt(key, iv, plaintext), number)))
+            row.append('{0:.1f}'.format(
+                best_of(lambda: decrypt(key + tag, iv, payload), number)))
+            row.append('{0:.1f}'.format(
+                best_of(lambda: decrypt(key, iv, legacy_payload), number)))
+        rows.append(tuple(row))
+
+    print_table(('payload', 'cipher enc', 'cipher dec', 'legacy dec',
+                 'aead enc', 'aead dec', 'legacy dec',
+                 'aes_encrypt', 'aes_decrypt', 'legacy dec'), rows)
+    print('times in µs per call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Compare tree based and streamed bundle unpacking for large bundles.
+
+Usage: python benchmarks/bench_bundle_streaming.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import tracemalloc
+
+from common import best_of, print_table
+
+import profanity_omemo_plugin.xmpp as xmpp
+from tests.test_unpacking_xmpp import TestStreamingBundleInfo
+
+
+def peak_kib(func):
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024.0
+
+
+def main():
+    rows = []
+    for count in (100, 1000, 10000):
+        stanza = TestStreamingBundleInfo.create_bundle(count)
+
+        def tree():
+            return xmpp.unpack_bundle_info(xmpp.parse_stanza(stanza))
+
+        def stream():
+            return xmpp.stream_bundle_info(stanza)
+
+        rows.append((count,
+                     '{0:.2f}'.format(best_of(tree, 5, 3) / 1000),
+                     '{0:.2f}'.format(best_of(stream, 5, 3) / 1000),
+                     '{0:.0f}'.format(peak_kib(tree)),
+                     '{0:.0f}'.format(peak_kib(stream))))
+
+    print_table(('prekeys', 'tree ms', 'stream ms', 'tree KiB', 'stream KiB'),
+                rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Memory held by SessionCiphers after touching many devices.
+
+Usage: python benchmarks/bench_cipher_pool.py [devices]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import tracemalloc
+
+from common import best_of, create_state, print_table
+
+
+def main(device_count=20000):
+    state = create_state('juliet@capulet.lit')
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(device_count):
+        state.get_session_cipher('contact{0}@example.lit'.format(i % 2000), i)
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    lookup = best_of(lambda: state.get_session_cipher(
+        'contact1@example.lit', device_count - 1), number=10000)
+    print_table(('devices', 'held KiB', 'lookup us'),
+                [(device_count, held // 1024, '{0:.2f}'.format(lookup))])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
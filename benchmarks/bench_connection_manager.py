@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Plain sqlite connection against the ConnectionManager.
+
+Measures single threaded create_msg throughput and the commits needed
+when several threads store sessions at once.
+
+Usage: python benchmarks/bench_connection_manager.py [messages]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from common import connect_devices, create_state, print_table
+
+ROMEO = 'romeo@montague.lit'
+JULIET = 'juliet@capulet.lit'
+THREADS = 8
+WRITES = 50
+
+
+def open_db(path, managed):
+    from profanity_omemo_plugin.db import ConnectionManager
+
+    if managed:
+        return ConnectionManager(path)
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+def throughput(path, managed, message_count):
+    state = create_state(ROMEO, open_db(path, managed), journal_mode='wal')
+    state.isTrusted = lambda jid, device: 1
+    connect_devices(state, JULIET, 2)
+
+    start = time.time()
+    for _ in range(message_count):
+        state.create_msg(ROMEO, JULIET, b'Hello')
+    return message_count / (time.time() - start)
+
+
+def concurrent_writes(path, managed):
+    from axolotl.state.sessionrecord import SessionRecord
+    from profanity_omemo_plugin.omemo.liteaxolotlstore import LiteAxolotlStore
+
+    connection = open_db(path, managed)
+    store = LiteAxolotlStore(connection, journal_mode='wal')
+    commits = []
+    connection.set_trace_callback(
+        lambda q: q.startswith('COMMIT') and commits.append(q))
+    lock = threading.Lock()
+    record = SessionRecord()
+
+    def write(thread):
+        for device in range(WRITES):
+            if managed:
+                store.storeSession(JULIET, thread * WRITES + device, record)
+            else:
+                # the shared connection is not safe without a lock
+                with lock:
+                    store.storeSession(JULIET, thread * WRITES + device,
+                                       record)
+
+    threads = [threading.Thread(target=write, args=(i, ))
+               for i in range(THREADS)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.time() - start) * 1000, len(commits)
+
+
+def main(message_count=200):
+    rows = []
+    for managed in (False, True):
+        root = tempfile.mkdtemp(prefix='omemo-manager-')
+        try:
+            rate = throughput(os.path.join(root, 'speed.db'), managed,
+                              message_count)
+            elapsed, commits = concurrent_writes(
+                os.path.join(root, 'writes.db'), managed)
+        finally:
+            shutil.rmtree(root)
+        rows.append(('manager' if managed else 'plain',
+                     '{0:.0f}'.format(rate), '{0:.0f}'.format(elapsed),
+                     '{0}/{1}'.format(commits, THREADS * WRITES)))
+
+    print_table(('connection', 'msgs/s', '{0}x{1} writes ms'.format(
+        THREADS, WRITES), 'commits'), rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time create_msg against an on-disk database.
+
+Usage: python benchmarks/bench_create_msg.py [devices] [messages]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from common import create_state, connect_devices, StatementCounter, \
+    print_table
+
+ALICE = 'alice@wonderland.lit'
+BOB = 'bob@builder.lit'
+
+
+def main(device_count=20, messages=20):
+    db_path = os.path.join(tempfile.mkdtemp(prefix='omemo-bench-'), 'omemo.db')
+    connection = sqlite3.connect(db_path, check_same_thread=False)
+    state = create_state(ALICE, connection)
+    connect_devices(state, BOB, device_count)
+
+    counter = StatementCounter(connection)
+    start = time.time()
+    for _ in range(messages):
+        state.create_msg(ALICE, BOB, b'Hello Bob')
+    elapsed = (time.time() - start) * 1000 / messages
+
+    print_table(('devices', 'statements/msg', 'commits/msg', 'ms/msg'),
+                [(device_count, counter.statements // messages,
+                  counter.commits // messages, '{0:.1f}'.format(elapsed))])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Message throughput and crash recovery per sqlite journal mode.
+
+The crash is a process crash: a child process commits some sessions,
+then dies in the middle of a large transaction. The parent reopens the
+db and checks what survived.
+
+Usage: python benchmarks/bench_journal_modes.py [messages]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from common import connect_devices, create_state, print_table
+
+ROMEO = 'romeo@montague.lit'
+JULIET = 'juliet@capulet.lit'
+MODES = ('memory', 'delete', 'wal')
+COMMITTED = 50
+
+
+def throughput(path, mode, message_count):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    state = create_state(ROMEO, connection, journal_mode=mode)
+    state.isTrusted = lambda jid, device: 1
+    connect_devices(state, JULIET, 2)
+
+    start = time.time()
+    for _ in range(message_count):
+        state.create_msg(ROMEO, JULIET, b'Hello')
+    return message_count / (time.time() - start)
+
+
+def crash(path, mode):
+    from axolotl.state.sessionrecord import SessionRecord
+    from profanity_omemo_plugin.omemo.liteaxolotlstore import LiteAxolotlStore
+
+    store = LiteAxolotlStore(sqlite3.connect(path), journal_mode=mode)
+    record = SessionRecord()
+    for device in range(COMMITTED):
+        store.storeSession(JULIET, device, record)
+
+    # a tiny page cache makes sqlite write pages of the open transaction
+    # into the db before it commits
+    store.sql.dbConn.execute('PRAGMA cache_size=2')
+    blob = os.urandom(4096)
+    with store.transaction():
+        for device in range(COMMITTED, COMMITTED + 500):
+            store.sql.dbConn.execute(
+                'INSERT INTO sessions(recipient_id, device_id, record) '
+                'VALUES(?,?,?)', (JULIET, device, blob))
+        os._exit(1)
+
+
+def recover(path):
+    start = time.time()
+    connection = sqlite3.connect(path)
+    try:
+        integrity = connection.execute(
+            'PRAGMA integrity_check').fetchone()[0]
+        sessions = connection.execute(
+            'SELECT COUNT(*) FROM sessions').fetchone()[0]
+    except sqlite3.DatabaseError as error:
+        integrity, sessions = str(error), '-'
+    return integrity, sessions, (time.time() - start) * 1000
+
+
+def main(message_count=200):
+    rows = []
+    for mode in MODES:
+        root = tempfile.mkdtemp(prefix='omemo-journal-')
+        try:
+            rate = throughput(os.path.join(root, 'speed.db'), mode,
+                              message_count)
+
+            path = os.path.join(root, 'crash.db')
+            process = multiprocessing.Process(target=crash, args=(path, mode))
+            process.start()
+            process.join()
+            integrity, sessions, reopen = recover(path)
+        finally:
+            shutil.rmtree(root)
+
+        rows.append((mode, '{0:.0f}'.format(rate), integrity,
+                     '{0}/{1}'.format(sessions, COMMITTED),
+                     '{0:.1f}'.format(reopen)))
+
+    print_table(('mode', 'msgs/s', 'integrity after crash',
+                 'sessions kept', 'reopen ms'), rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Compare serial and executor backed key wrapping in create_msg.
+
+Usage: python benchmarks/bench_key_wrapping.py [workers]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import time
+
+from common import create_state, connect_devices, print_table
+
+ALICE = 'alice@wonderland.lit'
+BOB = 'bob@builder.lit'
+DEVICES = (1, 8, 32, 128)
+MESSAGES = 5
+
+
+def ms_per_message(state):
+    state.create_msg(ALICE, BOB, b'warm up')
+    start = time.time()
+    for _ in range(MESSAGES):
+        state.create_msg(ALICE, BOB, b'Hello Bob')
+    return '{0:.1f}'.format((time.time() - start) * 1000 / MESSAGES)
+
+
+def main(workers=4):
+    rows = []
+    for count in DEVICES:
+        serial = create_state(ALICE)
+        connect_devices(serial, BOB, count)
+        parallel = create_state(ALICE, key_wrap_workers=workers)
+        connect_devices(parallel, BOB, count)
+
+        rows.append((count, ms_per_message(serial), ms_per_message(parallel)))
+
+    print_table(('devices', 'serial ms',
+                 '{0} workers ms'.format(workers)), rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
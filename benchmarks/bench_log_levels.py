@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time the receive hooks at the INFO and WARNING log levels.
+
+At INFO the records are either handed to profanity by the hook or queued
+and drained right after it, like the timed drain task of the plugin does.
+The mocked prof.log_* functions write to a file like profanity does.
+
+Usage: python benchmarks/bench_log_levels.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import base64
+import logging
+import os
+import tempfile
+
+from common import load_plugin, best_of, print_table
+
+from mock import MagicMock, patch
+
+from profanity_omemo_plugin import log
+from profanity_omemo_plugin.constants import NS_OMEMO
+import profanity_omemo_plugin.xmpp as xmpp
+from tests.fixtures import get_stanza_fixture
+
+
+def encrypted_msg(payload_size, devices):
+    """ An OMEMO message with a payload of payload_size bytes. """
+    keys = ''.join('<key rid="{0}">{1}</key>'.format(
+        1000 + i, base64.b64encode(os.urandom(96)).decode('ascii'))
+        for i in range(devices))
+    payload = base64.b64encode(os.urandom(payload_size)).decode('ascii')
+    return ('<message id="msg1" to="me@there.com/profanity" type="chat" '
+            'from="juliet@capulet.lit/balcony">'
+            '<body>I sent you an OMEMO encrypted message.</body>'
+            '<encrypted xmlns="{0}">'
+            '<header sid="1461841909">{1}'
+            '<iv>PnZsChVPjwI6jTL6fpkz5Q==</iv>'
+            '</header>'
+            '<payload>{2}</payload>'
+            '</encrypted>'
+            '<store xmlns="urn:xmpp:hints"/>'
+            '</message>').format(NS_OMEMO, keys, payload)
+
+
+def log_to_file(plugin, path):
+    logfile = open(path, 'a')
+
+    def write(message):
+        logfile.write(message + '\n')
+        logfile.flush()
+
+    for level in ('debug', 'info', 'warning', 'error'):
+        getattr(plugin.prof, 'log_' + level).side_effect = write
+    return logfile
+
+
+SYNC_HANDLER = log.ProfLogHandler(prefix='ProfOmemoPlugin')
+
+
+def ship_synchronously(synchronous):
+    """ Swap the queue handler of the plugin loggers for a ProfLogHandler. """
+    old, new = log._plugin_handler, SYNC_HANDLER
+    if not synchronous:
+        old, new = new, old
+    for name in log._plugin_loggers:
+        logger = logging.getLogger(name)
+        logger.removeHandler(old)
+        logger.addHandler(new)
+
+
+def main():
+    plugin = load_plugin()
+    plugin.prof.settings_boolean_get.return_value = True
+    logfile = log_to_file(plugin, tempfile.mktemp(prefix='omemo-bench-log-'))
+
+    state = MagicMock()
+    state.decrypt_msg.return_value = None
+
+    cases = [
+        ('chat message', encrypted_msg(200, 3),
+         plugin.prof_on_message_stanza_receive),
+        ('long message', encrypted_msg(16 * 1024, 3),
+         plugin.prof_on_message_stanza_receive),
+        ('muc message, 40 devices', encrypted_msg(200, 40),
+         plugin.prof_on_message_stanza_receive),
+        ('bundle result', get_stanza_fixture('iq_bundle_info.xml'),
+         plugin.prof_on_iq_stanza_receive),
+    ]
+
+    rows = []
+    with patch.object(plugin, 'ProfOmemoState', return_value=state), \
+            patch.object(xmpp, 'ProfOmemoState', return_value=state):
+        for name, stanza, hook in cases:
+            timings = []
+            for level, synchronous in (('info', True), ('info', False),
+                                       ('warning', False)):
+                log.set_log_level(level)
+                ship_synchronously(synchronous)
+                timings.append(best_of(
+                    lambda: (hook(stanza), log.drain_log_queue()),
+                    number=200))
+            rows.append([name, len(stanza)] +
+                        ['{0:.1f}'.format(t) for t in timings])
+
+    log.set_log_level('info')
+    log.drain_log_queue()
+    logfile.close()
+    os.remove(logfile.name)
+
+    print_table(('stanza', 'bytes', 'INFO sync us', 'INFO drained us',
+                 'WARNING us'), rows)
+    print('dropped records: {0}'.format(log.get_log_metrics()['dropped']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Measure the peak allocation of encrypting and decrypting one message.
+
+Usage: python benchmarks/bench_message_buffers.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import time
+import tracemalloc
+
+from common import bundle_dict, create_state, load_plugin, print_table
+
+ALICE = 'alice@wonderland.lit'
+BOB = 'bob@builder.lit'
+SIZES = (1024, 256 * 1024)
+
+
+def setup():
+    from profanity_omemo_plugin.prof_omemo_state import ProfOmemoState
+
+    load_plugin(ALICE)
+    alice = ProfOmemoState()
+    bob = create_state(BOB)
+    alice.build_session(BOB, bob.own_device_id, bundle_dict(bob))
+    alice.set_devices(BOB, [bob.own_device_id])
+    return alice, bob
+
+
+def peak(func):
+    """ Return the result of func and its peak allocation in KiB. """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    result = func()
+    elapsed = (time.time() - start) * 1000
+    size = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return result, '{0:.0f}'.format(size / 1024.0), '{0:.2f}'.format(elapsed)
+
+
+def main():
+    from profanity_omemo_plugin import xmpp
+
+    alice, bob = setup()
+    rows = []
+    for size in SIZES:
+        body = 'x' * size
+        stanza = ('<message to="{0}/pda" id="msg1" type="chat">'
+                  '<body>{1}</body></message>').format(BOB, body)
+        # the first message sets up the session on both ends
+        bob.decrypt_msg(xmpp.unpack_encrypted_stanza(
+            xmpp.encrypt_stanza(stanza)))
+
+        encrypted, send_kib, send_ms = peak(
+            lambda: xmpp.encrypt_stanza(stanza))
+        plaintext, recv_kib, recv_ms = peak(
+            lambda: bob.decrypt_msg(xmpp.unpack_encrypted_stanza(encrypted)))
+        assert plaintext == body
+
+        rows.append(('{0} KiB'.format(size // 1024), send_kib, send_ms,
+                     recv_kib, recv_ms))
+
+    print_table(('message', 'send peak KiB', 'send ms', 'receive peak KiB',
+                 'receive ms'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time building the own bundle and bundle stanza after prekeys have been
+consumed.
+
+Usage: python benchmarks/bench_own_bundle.py [consumed]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import time
+
+from common import create_state, load_plugin, print_table
+
+ALICE = 'alice@wonderland.lit'
+
+
+def consume(state, count):
+    for prekey in state.store.loadPreKeys()[:count]:
+        state.store.removePreKey(prekey.getId())
+
+
+def timed(func):
+    start = time.time()
+    func()
+    return '{0:.1f}'.format((time.time() - start) * 1000)
+
+
+def stanza_rows():
+    from profanity_omemo_plugin import xmpp
+    from profanity_omemo_plugin.prof_omemo_state import ProfOmemoState
+
+    load_plugin(ALICE)
+    state = ProfOmemoState()
+    create = xmpp.create_own_bundle_stanza
+
+    rows = [('stanza cold', 0, timed(create)),
+            ('stanza cached', 0, timed(create))]
+    consume(state, 1)
+    rows.append(('stanza', 1, timed(create)))
+    return rows
+
+
+def main(consumed=30):
+    state = create_state(ALICE)
+    replenisher = getattr(state, 'replenisher', None)
+
+    consume(state, consumed)
+    rows = [('bundle', consumed, timed(lambda: state.bundle))]
+    if replenisher is not None:
+        replenisher.schedule()
+        rows.append(('replenish', consumed, timed(replenisher.run)))
+        rows.append(('bundle', 0, timed(lambda: state.bundle)))
+    if hasattr(state, 'bundle_version'):
+        rows.extend(stanza_rows())
+
+    print_table(('step', 'consumed', 'ms'), rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
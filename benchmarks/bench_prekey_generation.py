@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time prekey generation and storage for growing batch sizes.
+
+Usage: python benchmarks/bench_prekey_generation.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import tempfile
+import time
+
+from common import StatementCounter, print_table
+
+from axolotl.util.keyhelper import KeyHelper
+from profanity_omemo_plugin.omemo.liteaxolotlstore import LiteAxolotlStore
+
+SIZES = (100, 1000, 5000)
+
+
+def one_by_one(store, count):
+    """ The previous behaviour: one INSERT and commit per prekey. """
+    start = store.getCurrentPreKeyId() + 1
+    for preKey in KeyHelper.generatePreKeys(start, count):
+        store.storePreKey(preKey.getId(), preKey)
+
+
+def run(func, count):
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    connection = sqlite3.connect(path, check_same_thread=False)
+    store = LiteAxolotlStore(connection).preKeyStore
+    counter = StatementCounter(connection)
+
+    start = time.time()
+    func(store, count)
+    elapsed = (time.time() - start) * 1000
+
+    connection.close()
+    os.remove(path)
+    return counter.commits, '{0:.0f}'.format(elapsed)
+
+
+def main():
+    modes = (
+        ('one by one', one_by_one),
+        ('executemany', lambda s, n: s.generateNewPreKeys(n)),
+    )
+
+    rows = []
+    for count in SIZES:
+        for name, func in modes:
+            rows.append((count, name) + run(func, count))
+
+    print_table(('prekeys', 'mode', 'commits', 'ms'), rows)
+
+
+if __name__ == '__main__':
+    main()
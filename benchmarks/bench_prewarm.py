@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" First message latency with and without session prewarming.
+
+The network is simulated: every IQ is answered after one round trip, a
+bundle response builds the session with its device. The chat window
+gains focus at t=0 and the first message is sent after the think time.
+
+Usage: python benchmarks/bench_prewarm.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import heapq
+
+from common import load_plugin, print_table
+
+from mock import MagicMock, patch
+
+import profanity_omemo_plugin.xmpp as xmpp
+from profanity_omemo_plugin.prewarmer import SessionPrewarmer
+
+JULIET = 'juliet@capulet.lit'
+
+
+class Network(object):
+
+    def __init__(self, plugin, rtt, missing):
+        self.plugin = plugin
+        self.rtt = rtt
+        self.missing = missing
+        self.now = 0.0
+        self._responses = []
+
+    def send_stanza(self, stanza):
+        heapq.heappush(self._responses, (self.now + self.rtt, stanza))
+        return True
+
+    def run_until(self, until):
+        while self._responses and self._responses[0][0] <= until:
+            self.now, stanza = heapq.heappop(self._responses)
+            self.plugin.outstanding_requests.complete(
+                xmpp.get_stanza_id(stanza))
+            if isinstance(stanza, bytes):  # a bundle request
+                nodes = xmpp.parse_stanza(stanza).nodes
+                device = int([n for n in nodes if ':' in n][0].split(':')[-1])
+                self.missing.discard(device)
+                self.plugin.pending_messages.trigger()
+            else:
+                self.plugin.prewarmer.devicelist_received(JULIET)
+        self.now = until
+
+
+def first_message_latency(plugin, prewarm, think, rtt, devices):
+    missing = set(range(1000, 1000 + devices))
+    network = Network(plugin, rtt, missing)
+    state = MagicMock()
+    state.own_jid = plugin.ProfOmemoUser.account
+    state.devices_without_sessions.side_effect = \
+        lambda jid: sorted(missing) if jid == JULIET else []
+
+    plugin.prof.settings_boolean_get.side_effect = \
+        lambda group, key, default: prewarm if key == 'prewarm' else True
+    plugin.outstanding_requests.clear()
+    plugin.prewarmer = SessionPrewarmer(plugin._query_device_list,
+                                        plugin._query_bundle_info_for)
+
+    with patch.object(plugin, 'ProfOmemoState', return_value=state), \
+            patch.object(plugin, 'send_stanza', network.send_stanza), \
+            patch('time.time', lambda: network.now):
+        plugin.prof_on_chat_win_focus(JULIET)
+        network.run_until(think)
+        plugin.prof_pre_chat_message_send(JULIET, 'Hello')
+        network.run_until(think + 10 * rtt)
+
+    metrics = plugin.prewarmer.get_metrics()
+    if prewarm:
+        return metrics['prewarmed_latency']
+    return metrics['cold_latency']
+
+
+def main():
+    plugin = load_plugin()
+    plugin.ProfActiveOmemoChats.add(JULIET)
+
+    rows = []
+    for think, rtt, devices in ((2.0, 0.3, 2), (0.1, 0.3, 2), (2.0, 1.5, 5),
+                                (5.0, 1.5, 5)):
+        rows.append((think, rtt, devices,
+                     '{0:.2f}'.format(first_message_latency(
+                         plugin, False, think, rtt, devices)),
+                     '{0:.2f}'.format(first_message_latency(
+                         plugin, True, think, rtt, devices))))
+
+    print_table(('think s', 'rtt s', 'devices', 'cold s', 'prewarmed s'),
+                rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Count the IQs sent while bundles of a contact are still in flight.
+
+Usage: python benchmarks/bench_request_dedup.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from common import load_plugin, print_table
+
+from mock import MagicMock, patch
+
+JULIET = 'juliet@capulet.lit'
+
+
+def main():
+    plugin = load_plugin()
+    plugin.prof.settings_boolean_get.return_value = True
+    plugin.ProfActiveOmemoChats.add(JULIET)
+
+    rows = []
+    for devices, messages in ((1, 5), (3, 5), (3, 20), (10, 20)):
+        missing = list(range(1000, 1000 + devices))
+        state = MagicMock()
+        state.devices_without_sessions.side_effect = \
+            lambda jid: list(missing) if jid == JULIET else []
+        plugin.outstanding_requests.clear()
+        metrics = plugin.outstanding_requests.get_metrics()
+
+        with patch.object(plugin, 'ProfOmemoState', return_value=state), \
+                patch.object(plugin, 'send_stanza',
+                             return_value=True) as send_stanza:
+            for _ in range(messages):
+                plugin.prof_pre_chat_message_send(JULIET, 'Hello')
+
+        suppressed = (plugin.outstanding_requests.suppressed -
+                      metrics['suppressed'])
+        rows.append((devices, messages, send_stanza.call_count + suppressed,
+                     send_stanza.call_count, suppressed))
+        plugin.pending_messages.clear()
+
+    print_table(('devices', 'messages', 'IQs before', 'IQs sent',
+                 'suppressed'), rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time create_gc_msg for a room with many members.
+
+Usage: python benchmarks/bench_room_fanout.py [members]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import time
+
+from mock import MagicMock
+
+from common import bundle_dict, create_state, print_table
+
+JULIET = 'juliet@capulet.lit'
+ROOM = 'garden@chat.capulet.lit'
+MESSAGES = 5
+
+
+def join(state, nick, jid):
+    if hasattr(state, 'room_index'):
+        state.room_index.add_member(ROOM, nick, jid)
+    else:
+        state.plugin.groupchat.setdefault(ROOM, {})[nick] = jid
+
+
+def setup(member_count):
+    from profanity_omemo_plugin.omemo.state import TRUSTED
+
+    plugin = MagicMock()
+    plugin.groupchat = {}
+    state = create_state(JULIET)
+    state.plugin = plugin
+    # all members share one remote identity, only the fan-out is measured
+    remote = create_state('romeo@montague.lit')
+    bundle = bundle_dict(remote)
+    state.store.setTrust(remote.store.getIdentityKeyPair().getPublicKey(),
+                         TRUSTED)
+
+    for i in range(member_count):
+        jid = 'member{0}@montague.lit'.format(i)
+        state.build_session(jid, remote.own_device_id, bundle)
+        state.set_devices(jid, [remote.own_device_id])
+        join(state, 'nick{0}'.format(i), jid)
+    join(state, 'juliet', JULIET)
+    return state
+
+
+def timed(func, number):
+    func()
+    start = time.time()
+    for _ in range(number):
+        func()
+    return '{0:.2f}'.format((time.time() - start) * 1000 / number)
+
+
+def main(member_count=500):
+    state = setup(member_count)
+    state.isTrusted = lambda jid, device: 1
+
+    rows = [(member_count,
+             timed(lambda: state.device_list_for(ROOM, True), 100),
+             timed(lambda: state.create_gc_msg(JULIET, ROOM, b'Hi'),
+                   MESSAGES))]
+    print_table(('members', 'device_list_for ms', 'create_gc_msg ms'), rows)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Count the database round trips of a create_msg fan-out.
+
+Usage: python benchmarks/bench_session_cache.py [devices]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import time
+
+from common import create_state, connect_devices, StatementCounter, \
+    print_table
+
+ALICE = 'alice@wonderland.lit'
+BOB = 'bob@builder.lit'
+
+
+def main(device_count=50):
+    state = create_state(ALICE)
+    connect_devices(state, BOB, device_count)
+    counter = StatementCounter(state.store.sql.dbConn)
+    sessions = state.store.sessionStore
+
+    rows = []
+    for name, cache_size in (('no cache', 0), ('session cache', 256)):
+        sessions.setCacheSize(cache_size)
+        state.create_msg(ALICE, BOB, b'warm up')
+        counter.reset()
+
+        start = time.time()
+        state.create_msg(ALICE, BOB, b'Hello Bob')
+        elapsed = (time.time() - start) * 1000
+
+        rows.append((name, device_count,
+                     counter.count('SELECT', 'sessions'),
+                     counter.statements, counter.commits,
+                     '{0:.1f}'.format(elapsed)))
+
+    print_table(('mode', 'devices', 'session reads', 'statements', 'commits',
+                 'ms'), rows)
+    print('cache: {0}'.format(sessions.getCacheInfo()))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time the session check run before every outgoing message.
+
+Usage: python benchmarks/bench_session_check.py [devices]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+
+from common import (StatementCounter, best_of, connect_devices, create_state,
+                    print_table)
+
+ROMEO = 'romeo@montague.lit'
+JULIET = 'juliet@capulet.lit'
+
+
+def main(device_count=20):
+    state = create_state(ROMEO)
+    connect_devices(state, JULIET, device_count)
+
+    counter = StatementCounter(state.store.sql.dbConn)
+    # both sending hooks check the contact and the own devices
+    for _ in range(2):
+        state.devices_without_sessions(JULIET)
+        state.devices_without_sessions(ROMEO)
+    queries = len(counter.queries)
+
+    check = best_of(lambda: state.devices_without_sessions(JULIET))
+    print_table(('devices', 'queries per send', 'check us'),
+                [(device_count, queries, '{0:.1f}'.format(check))])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time the start tag classifier against a full parse.
+
+Usage: python benchmarks/bench_stanza_classification.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from common import load_plugin, best_of, print_table
+
+from bench_stanza_parsing import ENCRYPTED_MSG, DEVICELIST_MSG, PLAIN_MSG
+import profanity_omemo_plugin.xmpp as xmpp
+from tests.fixtures import get_stanza_fixture
+
+CHATSTATE_MSG = ('<message from="juliet@capulet.lit/pda" to="me@there.com" '
+                 'type="chat"><composing '
+                 'xmlns="http://jabber.org/protocol/chatstates"/></message>')
+
+MENTION_MSG = ('<message from="room@muc.there.com/romeo" to="me@there.com" '
+               'type="groupchat"><body>Is the body of this message '
+               'encrypted? Check eu.siacs.conversations.axolotl.devicelist'
+               '</body></message>')
+
+
+def main():
+    plugin = load_plugin()
+    plugin.prof.settings_boolean_get.return_value = True
+
+    cases = [
+        ('chat state', CHATSTATE_MSG),
+        ('plain muc message', PLAIN_MSG),
+        ('namespace in body', MENTION_MSG),
+        ('encrypted message', ENCRYPTED_MSG),
+        ('devicelist event', DEVICELIST_MSG),
+        ('bundle result', get_stanza_fixture('iq_bundle_info.xml')),
+    ]
+
+    rows = []
+    for name, stanza in cases:
+        kind = xmpp.classify_stanza(stanza)
+        classify_us = best_of(lambda: xmpp.classify_stanza(stanza), 1000)
+        parse_us = best_of(lambda: xmpp.parse_stanza(stanza), 1000)
+        if kind == xmpp.STANZA_IRRELEVANT:
+            hook_us = '{0:.1f}'.format(best_of(
+                lambda: plugin.prof_on_message_stanza_receive(stanza), 1000))
+        else:
+            hook_us = '-'
+        rows.append((name, kind, '{0:.1f}'.format(classify_us),
+                     '{0:.1f}'.format(parse_us), hook_us))
+
+    print_table(('stanza', 'kind', 'classify us', 'parse us', 'hook us'),
+                rows)
+
+
+if __name__ == '__main__':
+    main()
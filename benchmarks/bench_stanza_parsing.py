@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Count the XML parses per stanza in the receive hooks.
+
+Usage: python benchmarks/bench_stanza_parsing.py
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from common import load_plugin, best_of, print_table
+
+from mock import MagicMock, patch
+
+from profanity_omemo_plugin.constants import NS_OMEMO, NS_DEVICE_LIST
+import profanity_omemo_plugin.xmpp as xmpp
+from tests.fixtures import get_stanza_fixture
+
+ENCRYPTED_MSG = (
+    '<message id="msg1" to="me@there.com/profanity" type="groupchat" '
+    'from="room@muc.there.com/juliet">'
+    '<body>I sent you an OMEMO encrypted message.</body>'
+    '<encrypted xmlns="{0}">'
+    '<header sid="1461841909">'
+    '<key rid="1260459496">ZHVtbXk=</key>'
+    '<iv>PnZsChVPjwI6jTL6fpkz5Q==</iv>'
+    '</header>'
+    '<payload>5eCvRJz6ASe8YzCyhB6W3JozxHec</payload>'
+    '</encrypted>'
+    '<store xmlns="urn:xmpp:hints"/>'
+    '</message>'
+).format(NS_OMEMO)
+
+DEVICELIST_MSG = (
+    '<message from="juliet@capulet.lit" to="me@there.com" type="headline">'
+    '<event xmlns="http://jabber.org/protocol/pubsub#event">'
+    '<items node="{0}"><item><list xmlns="{1}">'
+    '<device id="12345" /><device id="4223" />'
+    '</list></item></items></event>'
+    '</message>'
+).format(NS_DEVICE_LIST, NS_OMEMO)
+
+PLAIN_MSG = ('<message from="room@muc.there.com/romeo" to="me@there.com" '
+             'type="groupchat"><body>Hello everybody</body></message>')
+
+
+def legacy_pipeline(stanza):
+    """ The call sequence of the hooks when every helper got the string. """
+    if xmpp.is_devicelist_update(stanza):
+        return xmpp.unpack_devicelist_info(stanza)
+    if xmpp.is_encrypted_message(stanza):
+        return xmpp.unpack_encrypted_stanza(stanza)
+    if xmpp.is_bundle_update(stanza):
+        return xmpp.unpack_bundle_info(stanza)
+
+
+def main():
+    plugin = load_plugin()
+    plugin.prof.settings_boolean_get.return_value = True
+
+    state = MagicMock()
+    state.decrypt_msg.return_value = None
+    state.device_list_for.return_value = {12345, 4223}
+
+    cases = [
+        ('plain muc message', PLAIN_MSG, plugin.prof_on_message_stanza_receive),
+        ('encrypted message', ENCRYPTED_MSG,
+         plugin.prof_on_message_stanza_receive),
+        ('devicelist event', DEVICELIST_MSG,
+         plugin.prof_on_message_stanza_receive),
+        ('bundle result', get_stanza_fixture('iq_bundle_info.xml'),
+         plugin.prof_on_iq_stanza_receive),
+    ]
+
+    rows = []
+    with patch.object(plugin, 'ProfOmemoState', return_value=state), \
+            patch.object(xmpp, 'ProfOmemoState', return_value=state):
+        for name, stanza, hook in cases:
+            with patch.object(xmpp, 'stanza_as_xml',
+                              wraps=xmpp.stanza_as_xml) as counter:
+                legacy_pipeline(stanza)
+                legacy = counter.call_count
+                counter.reset_mock()
+                hook(stanza)
+                parsed = counter.call_count
+
+            hook_us = best_of(lambda: hook(stanza))
+            rows.append((name, legacy, parsed, '{0:.1f}'.format(hook_us)))
+
+    print_table(('stanza', 'parses (str API)', 'parses (hook)', 'hook us'),
+                rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Time store calls which used to compile a new statement per call.
+
+setActiveState formatted the jid and the device placeholders into its
+SQL, so every contact got statements of its own which pushed the hot
+statements out of the sqlite3 statement cache.
+
+Usage: python benchmarks/bench_statement_cache.py [contacts]
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sqlite3
+import sys
+import time
+
+from axolotl.state.sessionrecord import SessionRecord
+
+from common import print_table
+
+
+def main(contact_count=300):
+    from profanity_omemo_plugin.omemo.liteaxolotlstore import LiteAxolotlStore
+
+    connection = sqlite3.connect(':memory:')
+    store = LiteAxolotlStore(connection, session_cache_size=0)
+    record = SessionRecord()
+    jids = ['contact{0}@example.lit'.format(i) for i in range(contact_count)]
+    for i, jid in enumerate(jids):
+        for device in range(1 + i % 5):
+            store.storeSession(jid, device, record)
+
+    sessions = store.sessionStore
+    start = time.time()
+    for _ in range(5):
+        for i, jid in enumerate(jids):
+            sessions.setActiveState(list(range(1 + i % 5)), jid)
+            store.loadSession(jid, 0)
+            store.containsSession(jid, 0)
+    elapsed = (time.time() - start) * 1e6 / (5 * contact_count)
+
+    print_table(('contacts', 'devicelist update + lookups us'),
+                [(contact_count, '{0:.1f}'.format(elapsed))])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+""" Shared helpers for the benchmark scripts.
+
+The benchmarks run outside of profanity, so the `prof` module is mocked the
+same way the tests do it and the plugin data is kept in a temporary directory.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import sys
+import tempfile
+import timeit
+from base64 import b64decode
+
+from mock import MagicMock
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.join(here, '..', 'src'))
+sys.path.append(os.path.join(here, '..', 'deploy'))
+sys.path.append(os.path.join(here, '..'))
+
+os.environ.setdefault('XDG_DATA_HOME', tempfile.mkdtemp(prefix='omemo-bench-'))
+sys.modules.setdefault('prof', MagicMock())
+
+
+def load_plugin(account='me@there.com', resource='profanity'):
+    """ Import the deploy plugin with a logged in user. """
+    import prof_omemo_plugin as plugin
+    from profanity_omemo_plugin.prof_omemo_state import ProfOmemoUser
+
+    ProfOmemoUser.set_user(account, '{0}/{1}'.format(account, resource))
+    return plugin
+
+
+def best_of(func, number=100, repeat=5):
+    """ Return the best time per call in microseconds. """
+    timings = timeit.repeat(func, number=number, repeat=repeat)
+    return min(timings) / number * 1e6
+
+
+def print_table(header, rows):
+    widths = [max(len(str(r[i])) for r in [header] + rows)
+              for i in range(len(header))]
+    line = '  '.join('{{{0}:>{1}}}'.format(i, w) for i, w in enumerate(widths))
+    print(line.format(*header))
+    for row in rows:
+        print(line.format(*row))
+
+
+def create_state(jid, connection=None, **kwargs):
+    """ Create an OmemoState for jid on an in-memory database. """
+    from profanity_omemo_plugin.omemo.state import OmemoState
+
+    connection = connection or sqlite3.connect(':memory:',
+                                               check_same_thread=False)
+    return OmemoState(jid, connection, jid, MagicMock(), **kwargs)
+
+
+def bundle_dict(state):
+    """ Convert the own bundle of a state to the dict build_session wants. """
+    bundle = state.bundle
+    prekey_id, prekey = bundle['prekeys'][0]
+    return {'preKeyId': prekey_id,
+            'preKeyPublic': b64decode(prekey),
+            'signedPreKeyId': bundle['signedPreKeyId'],
+            'signedPreKeyPublic': b64decode(bundle['signedPreKeyPublic']),
+            'signedPreKeySignature':
+                b64decode(bundle['signedPreKeySignature']),
+            'identityKey': b64decode(bundle['identityKey'])}
+
+
+def connect_devices(state, jid, count):
+    """ Build trusted sessions from state to count fresh devices of jid. """
+    from profanity_omemo_plugin.omemo.state import TRUSTED
+
+    devices = []
+    for _ in range(count):
+        remote = create_state(jid)
+        device_id = remote.own_device_id
+        state.build_session(jid, device_id, bundle_dict(remote))
+        state.store.setTrust(remote.store.getIdentityKeyPair().getPublicKey(),
+                             TRUSTED)
+        devices.append(device_id)
+
+    state.set_devices(jid, devices)
+    return devices
+
+
+class StatementCounter(object):
+    """ Count the SQL statements and commits run on a connection. """
+
+    def __init__(self, connection):
+        self.queries = []
+        connection.set_trace_callback(self.queries.append)
+
+    @property
+    def commits(self):
+        return sum(1 for q in self.queries if q.upper().startswith('COMMIT'))
+
+    @property
+    def statements(self):
+        return sum(1 for q in self.queries
+                   if not q.upper().startswith(('BEGIN', 'COMMIT')))
+
+    def count(self, prefix, table):
+        """ Count statements starting with prefix which touch table. """
+        return sum(1 for q in self.queries
+                   if q.upper().startswith(prefix) and table in q)
+
+    def reset(self):
+        del self.queries[:]
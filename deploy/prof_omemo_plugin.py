@@ -23,20 +23,37 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import binascii
+import logging
+import time
 from functools import wraps
 
 import prof
 
 import profanity_omemo_plugin.xmpp as xmpp
 from profanity_omemo_plugin.constants import (NS_DEVICE_LIST_NOTIFY,
+                                              NS_MUC_USER,
                                               SETTINGS_GROUP,
+                                              OMEMO_DEFAULT_CONNECTION_MANAGER,
                                               OMEMO_DEFAULT_ENABLED,
+                                              OMEMO_DEFAULT_LOG_LEVEL,
                                               OMEMO_DEFAULT_MESSAGE_CHAR,
-                                              PLUGIN_NAME)
-from profanity_omemo_plugin.log import get_plugin_logger
+                                              OMEMO_DEFAULT_PREWARM,
+                                              LOG_DRAIN_INTERVAL,
+                                              PENDING_MESSAGE_CHECK_INTERVAL,
+                                              PLUGIN_NAME,
+                                              PREKEY_REPLENISH_INTERVAL,
+                                              WAL_CHECKPOINT_INTERVAL)
+from profanity_omemo_plugin.log import (LOG_LEVELS, get_log_metrics,
+                                        get_plugin_logger, set_log_level,
+                                        drain_log_queue)
+from profanity_omemo_plugin.omemo.sql import (DEFAULT_WAL_AUTOCHECKPOINT,
+                                              JOURNAL_MODES)
 from profanity_omemo_plugin.prof_omemo_state import (ProfOmemoState,
                                                      ProfOmemoUser,
                                                      ProfActiveOmemoChats)
+from profanity_omemo_plugin.prewarmer import SessionPrewarmer
+from profanity_omemo_plugin.request_tracker import DEVICELIST, RequestTracker
+from profanity_omemo_plugin.weak_message_store import WeakMessageStore
 
 log = get_plugin_logger(__name__)
 
@@ -52,7 +69,7 @@ def send_stanza(stanza):
     """
 
     if xmpp.stanza_is_valid_xml(stanza):
-        log.debug('Sending Stanza: {}'.format(stanza))
+        log.debug('Sending Stanza: %s', stanza)
         prof.send_stanza(stanza)
         return True
 
@@ -127,6 +144,101 @@ def _set_omemo_message_char(char):
     prof.settings_string_set(SETTINGS_GROUP, 'message_char', char)
 
 
+def _get_journal_mode_setting():
+    return prof.settings_string_get(SETTINGS_GROUP, 'journal_mode', None)
+
+
+def _get_wal_autocheckpoint_setting():
+    return prof.settings_int_get(
+        SETTINGS_GROUP, 'wal_autocheckpoint', DEFAULT_WAL_AUTOCHECKPOINT)
+
+
+def _set_journal_mode_setting(mode):
+    mode = mode.lower()
+    if mode not in JOURNAL_MODES:
+        prof.cons_show('Journal mode must be one of: {0}'
+                       .format(', '.join(JOURNAL_MODES)))
+        return
+
+    prof.settings_string_set(SETTINGS_GROUP, 'journal_mode', mode)
+    if ProfOmemoUser().account:
+        mode = _apply_journal_mode()
+    msg = 'OMEMO Database Journal Mode: {0}'.format(mode)
+    log.debug(msg)
+    prof.cons_show(msg)
+
+
+def _set_wal_autocheckpoint_setting(pages):
+    try:
+        pages = int(pages)
+    except ValueError:
+        prof.cons_show('WAL autocheckpoint must be a number of pages.')
+        return
+
+    prof.settings_int_set(SETTINGS_GROUP, 'wal_autocheckpoint', pages)
+    if ProfOmemoUser().account:
+        _apply_journal_mode()
+    msg = 'OMEMO WAL Autocheckpoint: {0} pages'.format(pages)
+    log.debug(msg)
+    prof.cons_show(msg)
+
+
+def _get_prewarm_setting():
+    return prof.settings_boolean_get(
+        SETTINGS_GROUP, 'prewarm', OMEMO_DEFAULT_PREWARM)
+
+
+def _set_prewarm_setting(enabled):
+    msg = 'OMEMO Session Prewarming: {0}'.format(enabled)
+    log.debug(msg)
+    prof.cons_show(msg)
+    prof.settings_boolean_set(SETTINGS_GROUP, 'prewarm', enabled)
+
+
+def _get_connection_manager_setting():
+    return prof.settings_boolean_get(SETTINGS_GROUP, 'connection_manager',
+                                     OMEMO_DEFAULT_CONNECTION_MANAGER)
+
+
+def _set_connection_manager_setting(enabled):
+    msg = 'OMEMO Connection Manager: {0} (used after reconnecting)'.format(
+        enabled)
+    log.debug(msg)
+    prof.cons_show(msg)
+    prof.settings_boolean_set(SETTINGS_GROUP, 'connection_manager', enabled)
+
+
+def _get_log_level_setting():
+    return prof.settings_string_get(
+        SETTINGS_GROUP, 'log_level', OMEMO_DEFAULT_LOG_LEVEL)
+
+
+def _set_log_level_setting(level):
+    level = level.lower()
+    if level not in LOG_LEVELS:
+        prof.cons_show('Log level must be one of: {0}'
+                       .format(', '.join(sorted(LOG_LEVELS))))
+        return
+
+    prof.settings_string_set(SETTINGS_GROUP, 'log_level', level)
+    set_log_level(level)
+    prof.cons_show('OMEMO Log Level: {0}'.format(level))
+
+
+def _apply_journal_mode():
+    """ Switch the db of the current account to the configured mode.
+
+    Returns the journal mode in effect, without a configured mode the db
+    keeps the mode it was opened with.
+    """
+    sql = ProfOmemoState().store.sql
+    journal_mode = _get_journal_mode_setting()
+    if journal_mode not in JOURNAL_MODES:
+        return sql.getJournalMode()
+
+    return sql.setJournalMode(journal_mode, _get_wal_autocheckpoint_setting())
+
+
 ################################################################################
 # Decorators
 ################################################################################
@@ -144,7 +256,7 @@ def require_sessions_for_all_devices(attrib, else_return=None):
                 log.error('Recipient not valid.')
                 return else_return
 
-            log.info('Checking Sessions for {0}'.format(recipient))
+            log.info('Checking Sessions for %s', recipient)
             state = ProfOmemoState()
             uninitialized_devices = state.devices_without_sessions(contat_jid)
 
@@ -154,12 +266,12 @@ def require_sessions_for_all_devices(attrib, else_return=None):
             uninitialized_devices += own_uninitialized
 
             if not uninitialized_devices:
-                log.info('Recipient {0} has all sessions set up.'.format(recipient))
+                log.info('Recipient %s has all sessions set up.', recipient)
                 return func(stanza)
 
             _query_device_list(contat_jid)
             _query_device_list(own_jid)
-            log.warning('No Session found for user: {0}.'.format(recipient))
+            log.warning('No Session found for user: %s.', recipient)
             prof.notify('Failed to send last Message.', 5000, 'Profanity Omemo Plugin')
             return else_return
 
@@ -191,8 +303,11 @@ def omemo_enabled(else_return=None):
 def _init_omemo():
     account = ProfOmemoUser().account
     if account:
+        ProfOmemoState.connection_manager = _get_connection_manager_setting()
+        _apply_journal_mode()
+
         # subscribe to devicelist updates
-        log.info('Adding Disco Feature {0}.'.format(NS_DEVICE_LIST_NOTIFY))
+        log.info('Adding Disco Feature %s.', NS_DEVICE_LIST_NOTIFY)
         # subscribe to device list updates
         prof.disco_add_feature(NS_DEVICE_LIST_NOTIFY)
 
@@ -209,6 +324,71 @@ def _announce_own_bundle():
     send_stanza(own_bundle_stanza)
 
 
+def _replenish_prekeys():
+    """ Timed task topping up the own prekeys off the stanza hooks. """
+    if not ProfOmemoUser().account:
+        return
+
+    replenisher = ProfOmemoState().replenisher
+    if replenisher.run():
+        log.debug('Announcing replenished bundle info.')
+        _announce_own_bundle()
+
+
+def _sessions_ready(jid):
+    """ True if we have sessions with all devices of jid and our own. """
+    state = ProfOmemoState()
+    return not (state.devices_without_sessions(jid) or
+                state.devices_without_sessions(ProfOmemoUser.account))
+
+
+def _post_pending_message(message_dict):
+    if message_dict.get('first'):
+        prewarmer.first_message_sent(
+            message_dict['to'], time.time() - message_dict['timestamp'])
+
+    # encrypt and send it ourselves, passing the text to /msg would parse
+    # it as a command line once more
+    recipient, message = message_dict['to'], message_dict['message']
+    try:
+        stanza = xmpp.create_encrypted_message(ProfOmemoUser().fulljid,
+                                               recipient,
+                                               message.encode('utf-8'))
+    except Exception:
+        log.exception('Could not encrypt queued message')
+        stanza = None
+
+    if stanza is None or not send_stanza(stanza):
+        show_chat_critical(recipient, 'Message not sent, it could not be '
+                                      'encrypted: {0}'.format(message))
+        return
+
+    prof.chat_show_themed(recipient, PLUGIN_NAME, 'sent', None,
+                          _get_omemo_message_char(), message)
+
+
+pending_messages = WeakMessageStore(_post_pending_message, _sessions_ready)
+outstanding_requests = RequestTracker()
+
+
+def _expire_pending_messages():
+    """ Timed task reporting messages that never got their sessions. """
+    for message_dict in pending_messages.on_timeout():
+        show_chat_critical(message_dict['to'],
+                           'Message not sent, no OMEMO session could be '
+                           'established: {0}'.format(message_dict['message']))
+
+
+def _checkpoint_db():
+    """ Timed task moving the WAL content into the db without blocking. """
+    if not ProfOmemoUser().account:
+        return
+
+    result = ProfOmemoState().store.sql.checkpoint()
+    if result is not None:
+        log.debug('WAL checkpoint: %s pages, %s checkpointed', *result[1:])
+
+
 def _show_no_trust_mgmt_header(jid):
     show_chat_warning(jid, '###############################################')
     show_chat_warning(jid, '#                                             #')
@@ -243,8 +423,14 @@ def _start_omemo_session(jid):
     show_chat_info(jid, 'OMEMO Session started.')
     _show_no_trust_mgmt_header(jid)
 
-    log.info('Query Devicelist for {0}'.format(jid))
-    _query_device_list(jid)
+    if _get_prewarm_setting():
+        _prewarm_sessions(jid)
+    else:
+        log.info('Query Devicelist for %s', jid)
+        _query_device_list(jid)
+
+    if jid in ProfOmemoState().room_index.groupchat:
+        _query_room_device_lists(jid)
 
     prof.settings_string_list_add(SETTINGS_GROUP, 'omemo_sessions', jid)
 
@@ -272,12 +458,13 @@ def _handle_devicelist_update(stanza):
     own_jid = omemo_state.own_jid
     msg_dict = xmpp.unpack_devicelist_info(stanza)
     sender_jid = msg_dict['from']
-    log.info('Received devicelist update from {0}'.format(sender_jid))
+    log.info('Received devicelist update from %s', sender_jid)
 
     known_devices = omemo_state.device_list_for(sender_jid)
     new_devices = msg_dict['devices']
 
     added_devices = set(new_devices) - known_devices
+    prewarmer.devicelist_received(sender_jid)
 
     if added_devices:
         device_str = ', '.join([str(d) for d in added_devices])
@@ -285,6 +472,12 @@ def _handle_devicelist_update(stanza):
         show_chat_warning(sender_jid, msg)
         xmpp.update_devicelist(own_jid, sender_jid, new_devices)
 
+        # build the sessions with the new devices before they are needed
+        if _get_prewarm_setting() and (
+                sender_jid == own_jid or
+                ProfActiveOmemoChats.account_is_active(sender_jid)):
+            prewarmer.fetch_bundles(omemo_state, sender_jid)
+
     if not omemo_state.own_device_id_published():
         _announce_own_devicelist()
 
@@ -292,8 +485,38 @@ def _handle_devicelist_update(stanza):
         add_recipient_to_completer(sender_jid)
 
 
+def _handle_muc_presence(presence):
+    omemo_state = ProfOmemoState()
+    room_index = omemo_state.room_index
+    room, nick = presence['room'], presence['nick']
+
+    if presence['new_nick']:
+        room_index.rename_member(room, nick, presence['new_nick'])
+    elif not presence['available']:
+        if presence['self']:
+            room_index.remove_room(room)
+        else:
+            room_index.remove_member(room, nick)
+    elif presence['jid']:
+        jid = presence['jid']
+        room_index.add_member(room, nick, jid)
+        # the devicelists are only needed once OMEMO is used in the room
+        if (ProfActiveOmemoChats.account_is_active(room) and
+                jid != omemo_state.own_jid and
+                jid not in omemo_state.device_ids):
+            _query_device_list(jid)
+
+
+def _query_room_device_lists(room):
+    """ Request the devicelists of all members of room we do not know. """
+    omemo_state = ProfOmemoState()
+    for jid in omemo_state.room_index.jids(room):
+        if jid not in omemo_state.device_ids:
+            _query_device_list(jid)
+
+
 def add_recipient_to_completer(recipient):
-    log.info('Adding {} to the completer.'.format(recipient))
+    log.info('Adding %s to the completer.', recipient)
     prof.completer_add('/omemo start', [recipient])
     prof.completer_add('/omemo show_devices', [recipient])
     prof.completer_add('/omemo fingerprints', [recipient])
@@ -314,35 +537,58 @@ def _handle_bundle_update(stanza):
 
     try:
         omemo_state.build_session(sender, device_id, bundle_info)
-        log.info('Session built with user: {0}:{1}'.format(sender, device_id))
+        log.info('Session built with user: %s:%s', sender, device_id)
         prof.completer_add('/omemo end', [sender])
     except Exception as e:
-        msg_tmpl = 'Could not build session with {0}:{1}. {2}:{3}'
-        msg = msg_tmpl.format(sender, device_id, type(e).__name__, str(e))
-        log.error(msg)
+        log.error('Could not build session with %s:%s. %s:%s', sender,
+                  device_id, type(e).__name__, e)
         return
 
+    # the session may have been the last one a queued message waited for
+    pending_messages.trigger()
+
 
 def _announce_own_devicelist():
     fulljid = ProfOmemoUser().fulljid
     query_msg = xmpp.create_devicelist_update_msg(fulljid)
     log.info('Announce own device list.')
-    log.info(query_msg)
+    log.debug('%s', query_msg)
     send_stanza(query_msg)
 
 
 def _query_bundle_info_for(recipient, deviceid):
-    log.info('Query Bundle for {0}:{1}'.format(recipient, deviceid))
+    key = (recipient, int(deviceid))
+    if outstanding_requests.is_pending(key):
+        log.debug('Bundle for %s:%s already requested', recipient, deviceid)
+        return
+
+    log.info('Query Bundle for %s:%s', recipient, deviceid)
     account = ProfOmemoUser().account
     stanza = xmpp.create_bundle_request_stanza(account, recipient, deviceid)
-    send_stanza(stanza)
+    if send_stanza(stanza):
+        outstanding_requests.add(key, xmpp.get_stanza_id(stanza))
 
 
 def _query_device_list(contact_jid):
-    log.info('Query Device list for {0}'.format(contact_jid))
+    key = (contact_jid, DEVICELIST)
+    if outstanding_requests.is_pending(key):
+        log.debug('Device list of %s already requested', contact_jid)
+        return
+
+    log.info('Query Device list for %s', contact_jid)
     fulljid = ProfOmemoUser().fulljid
     query_msg = xmpp.create_devicelist_query_msg(fulljid, contact_jid)
-    send_stanza(query_msg)
+    if send_stanza(query_msg):
+        outstanding_requests.add(key, xmpp.get_stanza_id(query_msg))
+
+
+prewarmer = SessionPrewarmer(_query_device_list, _query_bundle_info_for)
+
+
+def _prewarm_sessions(jid):
+    """ Prepare the sessions with jid before the first message is sent. """
+    log.info('Prewarming sessions with %s', jid)
+    prewarmer.prewarm(ProfOmemoState(), jid)
 
 
 ################################################################################
@@ -353,15 +599,16 @@ def _query_device_list(contact_jid):
 @require_sessions_for_all_devices('to')
 def prof_on_message_stanza_send(stanza):
     stanza = ensure_unicode_stanza(stanza)
+    parsed = xmpp.parse_stanza(stanza)
 
-    contact_jid = xmpp.get_recipient(stanza)
+    contact_jid = xmpp.get_recipient(parsed)
     if not ProfActiveOmemoChats.account_is_active(contact_jid):
-        log.debug('Chat not activated for {0}'.format(contact_jid))
+        log.debug('Chat not activated for %s', contact_jid)
         return None
 
     try:
-        if xmpp.is_xmpp_plaintext_message(stanza):
-            encrypted_stanza = xmpp.encrypt_stanza(stanza)
+        if xmpp.is_xmpp_plaintext_message(parsed):
+            encrypted_stanza = xmpp.encrypt_stanza(parsed)
             if xmpp.stanza_is_valid_xml(encrypted_stanza):
                 return encrypted_stanza
     except Exception as e:
@@ -383,10 +630,11 @@ def prof_pre_chat_message_send(barejid, message):
         return message
 
     if not ProfActiveOmemoChats.account_is_active(barejid):
-        log.info('Chat not activated for {0}'.format(barejid))
+        log.info('Chat not activated for %s', barejid)
         return message
 
     omemo_state = ProfOmemoState()
+    first_message = prewarmer.is_first_message(barejid)
     uninitialzed_devices = omemo_state.devices_without_sessions(barejid)
 
     if uninitialzed_devices:
@@ -412,6 +660,21 @@ def prof_pre_chat_message_send(barejid, message):
         for device in own_uninitialized:
             _query_bundle_info_for(own_jid, device)
 
+    missing = uninitialzed_devices or own_uninitialized
+    if missing or pending_messages.pending(barejid):
+        # hold the message back until the bundles arrived, or behind the
+        # messages still waiting for them so the order is kept
+        pending_messages.add({'to': barejid, 'message': message,
+                              'first': first_message})
+        if missing:
+            show_chat_info(barejid, 'Message queued until all OMEMO sessions '
+                                    'are established.')
+        else:
+            pending_messages.trigger()
+        return None
+
+    if first_message:
+        prewarmer.first_message_sent(barejid, 0.0)
     return message
 
 
@@ -423,22 +686,33 @@ def prof_pre_chat_message_send(barejid, message):
 def prof_on_message_stanza_receive(stanza):
     stanza = ensure_unicode_stanza(stanza)
 
-    log.info('Received Message: {0}'.format(stanza))
-    if xmpp.is_devicelist_update(stanza):
+    kind = xmpp.classify_stanza(stanza)
+    if kind == xmpp.STANZA_IRRELEVANT:
+        return True
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Received Message: %s', stanza)
+    try:
+        parsed = xmpp.parse_stanza(stanza)
+    except Exception:
+        log.exception('Could not parse message stanza.')
+        return True
+
+    if kind == xmpp.STANZA_DEVICELIST:
         log.info('Device List update detected.')
         try:
-            _handle_devicelist_update(stanza)
+            _handle_devicelist_update(parsed)
         except:
             log.exception('Failed to handle devicelist update.')
 
         return False
 
-    if xmpp.is_encrypted_message(stanza):
+    if kind in (xmpp.STANZA_OMEMO_MESSAGE, xmpp.STANZA_FORWARDED):
         log.info('Received OMEMO encrypted message.')
         omemo_state = ProfOmemoState()
 
         try:
-            msg_dict = xmpp.unpack_encrypted_stanza(stanza)
+            msg_dict = xmpp.unpack_encrypted_stanza(parsed)
             sender = msg_dict['sender_jid']
             resource = msg_dict['sender_resource']
             sender_fulljid = sender + '/' + resource
@@ -457,11 +731,14 @@ def prof_on_message_stanza_receive(stanza):
                 log.error('Could not decrypt Message')
                 return True
 
+            # a PreKeyWhisperMessage builds the session of the sender
+            pending_messages.trigger()
+
             if plain_msg:
                 # only mark the message if it was an OMEMO encrypted message
                 try:
                     message_char = _get_omemo_message_char()
-                    log.debug('Set incoming Message Character: {0}'.format(message_char))
+                    log.debug('Set incoming Message Character: %s', message_char)
                     prof.chat_set_incoming_char(sender, message_char)
                     prof.incoming_message(sender, resource, plain_msg)
                 finally:
@@ -485,19 +762,54 @@ def prof_on_message_stanza_receive(stanza):
     return True
 
 
+@omemo_enabled(else_return=True)
+def prof_on_presence_stanza_receive(stanza):
+    stanza = ensure_unicode_stanza(stanza)
+
+    # only MUC presences carry room membership
+    if NS_MUC_USER not in stanza or not ProfOmemoUser().account:
+        return True
+
+    try:
+        presence = xmpp.unpack_muc_presence(stanza)
+        if presence:
+            _handle_muc_presence(presence)
+    except Exception:
+        log.exception('Could not handle MUC presence.')
+
+    return True
+
+
 @omemo_enabled(else_return=True)
 def prof_on_iq_stanza_receive(stanza):
     stanza = ensure_unicode_stanza(stanza)
-    log.info('Received IQ: {0}'.format(stanza))
 
-    if xmpp.is_bundle_update(stanza):  # bundle information received
+    # results and errors both answer a request
+    if len(outstanding_requests):
+        outstanding_requests.complete(xmpp.get_stanza_id(stanza))
+
+    kind = xmpp.classify_stanza(stanza)
+    if kind == xmpp.STANZA_IRRELEVANT:
+        return True
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('Received IQ: %s', stanza)
+
+    if kind == xmpp.STANZA_BUNDLE:  # bundle information received
         log.info('Bundle update detected.')
+        # bundles are streamed, no need to build the whole tree
         _handle_bundle_update(stanza)
         return False
 
-    elif xmpp.is_devicelist_update(stanza):
+    elif kind == xmpp.STANZA_DEVICELIST:
         log.info('Device List update detected.')
-        _handle_devicelist_update(stanza)
+        try:
+            parsed = xmpp.parse_stanza(stanza)
+        except Exception:
+            log.exception('Could not parse IQ stanza.')
+            return True
+
+        _handle_devicelist_update(parsed)
         return False
 
     return True
@@ -532,18 +844,18 @@ def _parse_args(arg1=None, arg2=None, arg3=None):
         current_recipient = prof.get_current_recipient()
 
         if not current_recipient and arg2 != current_recipient:
-            log.info('Opening Chat Window for {0}'.format(arg2))
+            log.info('Opening Chat Window for %s', arg2)
             prof.send_line('/msg {0}'.format(arg2))
 
         recipient = arg2 or current_recipient
         if recipient:
-            log.info('Start OMEMO session with: {0}'.format(recipient))
+            log.info('Start OMEMO session with: %s', recipient)
             _start_omemo_session(recipient)
 
     elif arg1 == 'end':
         # ensure we are in a chat window
         jid = arg2 or prof.get_current_muc() or prof.get_current_recipient()
-        log.info('Ending OMEMO session with: {0}'.format(jid))
+        log.info('Ending OMEMO session with: %s', jid)
         if jid:
             _end_omemo_session(jid)
 
@@ -551,6 +863,25 @@ def _parse_args(arg1=None, arg2=None, arg3=None):
         if arg2 == 'message_prefix':
             if arg3 is not None:
                 _set_omemo_message_char(arg3)
+        elif arg2 == 'journal_mode':
+            if arg3 is not None:
+                _set_journal_mode_setting(arg3)
+        elif arg2 == 'wal_autocheckpoint':
+            if arg3 is not None:
+                _set_wal_autocheckpoint_setting(arg3)
+        elif arg2 == 'prewarm':
+            if arg3 == 'on':
+                _set_prewarm_setting(True)
+            elif arg3 == 'off':
+                _set_prewarm_setting(False)
+        elif arg2 == 'connection_manager':
+            if arg3 == 'on':
+                _set_connection_manager_setting(True)
+            elif arg3 == 'off':
+                _set_connection_manager_setting(False)
+        elif arg2 == 'log_level':
+            if arg3 is not None:
+                _set_log_level_setting(arg3)
 
     elif arg1 == 'account':
         prof.cons_show('Account: {0}'.format(account))
@@ -558,6 +889,29 @@ def _parse_args(arg1=None, arg2=None, arg3=None):
     elif arg1 == 'status':
         enabled = _get_omemo_enabled_setting()
         prof.cons_show('OMEMO Plugin Enabled: {0}'.format(enabled))
+        if account:
+            metrics = ProfOmemoState().replenisher.get_metrics()
+            prof.cons_show('PreKeys available: {pool_depth}, replenished '
+                           '{replenish_count} times in {generation_time:.2f}s'
+                           .format(**metrics))
+            metrics = ProfOmemoState().session_ciphers.get_metrics()
+            prof.cons_show('SessionCiphers: {size}/{capacity}, '
+                           '{evictions} evicted'.format(**metrics))
+            journal_mode = ProfOmemoState().store.sql.getJournalMode()
+            prof.cons_show('Database Journal Mode: {0}'.format(journal_mode))
+        metrics = outstanding_requests.get_metrics()
+        prof.cons_show('Requests in flight: {pending}, sent {sent}, '
+                       '{suppressed} duplicates suppressed'.format(**metrics))
+        metrics = prewarmer.get_metrics()
+        prof.cons_show('First message latency: {prewarmed_latency:.2f}s '
+                       'prewarmed ({prewarmed_messages}), {cold_latency:.2f}s '
+                       'cold ({cold_messages})'.format(**metrics))
+        metrics = pending_messages.get_metrics()
+        prof.cons_show('Pending messages: {pending}, sent {sent} after '
+                       '{avg_latency:.1f}s on average, {expired} expired, '
+                       '{dropped} dropped'.format(**metrics))
+        prof.cons_show('Log Level: {0}, {1} records dropped'.format(
+            _get_log_level_setting(), get_log_metrics()['dropped']))
 
     elif arg1 == 'fulljid':
         prof.cons_show('Current JID: {0}'.format(fulljid))
@@ -604,10 +958,19 @@ def prof_on_chat_win_focus(barejid):
         # get remembered user sessions
         u_sess = prof.settings_string_list_get(SETTINGS_GROUP, 'omemo_sessions')
         if u_sess and barejid in u_sess:
+            # prewarms the sessions as well
             _start_omemo_session(barejid)
+            return
+
+    if (ProfOmemoUser().account and _get_prewarm_setting() and
+            ProfActiveOmemoChats.account_is_active(barejid)):
+        _prewarm_sessions(barejid)
 
 
 def prof_init(version, status, account_name, fulljid):
+    log_level = _get_log_level_setting()
+    if log_level in LOG_LEVELS:
+        set_log_level(log_level)
     log.info('prof_init() called')
     synopsis = [
         '/omemo',
@@ -628,6 +991,16 @@ def prof_init(version, status, account_name, fulljid):
         ['start|end <jid>', ('Start an OMEMO based conversation with <jid> '
                              'window or current window.')],
         ['set', 'Set Settings like Message Prefix'],
+        ['set journal_mode memory|delete|wal',
+         'Set the journal mode of the OMEMO database'],
+        ['set wal_autocheckpoint <pages>',
+         'Set the WAL size after which SQLite checkpoints on its own'],
+        ['set prewarm on|off',
+         'Prepare the sessions of a contact when its chat gains focus'],
+        ['set connection_manager on|off',
+         'Use one database writer thread and a reader per thread'],
+        ['set log_level debug|info|warning|error',
+         'Set the level of the plugin log messages'],
         ['status', 'Display the current Profanity OMEMO Plugin status.'],
         ['fingerprints <jid>', 'Display the known fingerprints for <jid>'],
         ['account', 'Show current account name'],
@@ -645,7 +1018,19 @@ def prof_init(version, status, account_name, fulljid):
                                   'account', 'fulljid', 'show_devices',
                                   'reset_devicelist', 'fingerprints'])
 
-    prof.completer_add('/omemo set', ['message_prefix'])
+    prof.completer_add('/omemo set', ['message_prefix', 'journal_mode',
+                                      'wal_autocheckpoint', 'log_level',
+                                      'prewarm', 'connection_manager'])
+    prof.completer_add('/omemo set prewarm', ['on', 'off'])
+    prof.completer_add('/omemo set connection_manager', ['on', 'off'])
+    prof.completer_add('/omemo set journal_mode', list(JOURNAL_MODES))
+    prof.completer_add('/omemo set log_level', sorted(LOG_LEVELS))
+
+    prof.register_timed(_replenish_prekeys, PREKEY_REPLENISH_INTERVAL)
+    prof.register_timed(_checkpoint_db, WAL_CHECKPOINT_INTERVAL)
+    prof.register_timed(_expire_pending_messages,
+                        PENDING_MESSAGE_CHECK_INTERVAL)
+    prof.register_timed(drain_log_queue, LOG_DRAIN_INTERVAL)
 
     # set user and init omemo only if account_name and fulljid provided
     if account_name is not None and fulljid is not None:
@@ -658,6 +1043,7 @@ def prof_init(version, status, account_name, fulljid):
 def prof_on_unload():
     log.debug('prof_on_unload() called')
     ProfOmemoUser.reset()
+    drain_log_queue()
 
 
 def prof_on_connect(account_name, fulljid):
@@ -669,11 +1055,16 @@ def prof_on_connect(account_name, fulljid):
 def prof_on_disconnect(account_name, fulljid):
     log.debug('prof_on_disconnect() called')
     ProfOmemoUser.reset()
+    pending_messages.clear()
+    outstanding_requests.clear()
+    prewarmer.reset()
 
 
 def prof_on_shutdown():
     log.debug('prof_on_shutdown() called')
     ProfOmemoUser.reset()
+    pending_messages.clear()
+    drain_log_queue()
 
 
 def human_hash(fpr):
@@ -31,9 +31,24 @@ LOGGER_NAME = 'ProfOmemoLogger'
 SETTINGS_GROUP = 'omemo'
 OMEMO_DEFAULT_ENABLED = True
 OMEMO_DEFAULT_MESSAGE_CHAR = '@'
+OMEMO_DEFAULT_LOG_LEVEL = 'info'
+OMEMO_DEFAULT_PREWARM = True
+OMEMO_DEFAULT_CONNECTION_MANAGER = False
+PREKEY_REPLENISH_INTERVAL = 60  # seconds between prekey pool checks
+WAL_CHECKPOINT_INTERVAL = 300  # seconds between passive WAL checkpoints
+PENDING_MESSAGE_CHECK_INTERVAL = 10  # seconds between pending message checks
+LOG_DRAIN_INTERVAL = 1  # seconds between shipping the queued log records
 
 # OMEMO namespace constants
 NS_OMEMO = 'eu.siacs.conversations.axolotl'
 NS_DEVICE_LIST = NS_OMEMO + '.devicelist'
 NS_DEVICE_LIST_NOTIFY = NS_DEVICE_LIST + '+notify'
 NS_BUNDLES = NS_OMEMO + '.bundles'
+
+# XMPP namespace constants
+NS_CLIENT = 'jabber:client'
+NS_PUBSUB = 'http://jabber.org/protocol/pubsub'
+NS_PUBSUB_EVENT = NS_PUBSUB + '#event'
+NS_FORWARD = 'urn:xmpp:forward:0'
+NS_CARBONS = 'urn:xmpp:carbons:2'
+NS_MUC_USER = 'http://jabber.org/protocol/muc#user'
@@ -22,9 +22,16 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 import os
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
 
 from profanity_omemo_plugin.constants import XDG_DATA_HOME
 from profanity_omemo_plugin.log import get_plugin_logger
+from profanity_omemo_plugin.omemo.queries import CACHED_STATEMENTS
 
 log = get_plugin_logger(__name__)
 
@@ -34,16 +41,357 @@ except ImportError:
     log.error('Could not import sqlite3')
     raise
 
+WRITE_QUEUE_SIZE = 256  # writes waiting for the writer before callers block
+GROUP_COMMIT_SIZE = 32  # commits the writer may merge into one
+BUSY_TIMEOUT = 10  # seconds a connection waits for a db lock
+
+_DML = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+_STOP = object()
+
+
+def get_connection(user, connection_manager=False):
+    """ Open the sqlite db of user.
 
-def get_connection(user):
-    """ Open in memory sqlite db and create a table. """
+        :param connection_manager: open the db behind a
+            :py:class:`ConnectionManager` instead of a single sqlite3
+            connection shared by all threads
+    """
     db_path = _get_db_path(user)
     db_root = os.path.dirname(db_path)
     if not os.path.isdir(db_root):
         os.makedirs(db_root)
-    log.info('Using database path {}'.format(db_path))
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    return conn
+    log.info('Using database path %s', db_path)
+    if connection_manager:
+        return ConnectionManager(db_path)
+    return sqlite3.connect(db_path, check_same_thread=False,
+                           cached_statements=CACHED_STATEMENTS)
+
+
+def _first_word(sql):
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class _Request(object):
+    """ A job for the writer thread, the caller waits for its result. """
+
+    __slots__ = ('op', 'args', 'result', 'error', 'done')
+
+    def __init__(self, op, *args):
+        self.op = op
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def resolve(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class _Result(object):
+    """ The fetched rows and counters of an executed statement. """
+
+    __slots__ = ('rows', 'rowcount', 'lastrowid', 'description')
+
+    def __init__(self, cursor):
+        self.rows = cursor.fetchall()
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self.description = cursor.description
+
+
+class ManagedCursor(object):
+    """ The part of the sqlite3.Cursor API the stores use.
+
+    Rows are fetched as soon as a statement ran, so the statement never
+    stays open on the connection which executed it.
+    """
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+        self._rows = []
+        self._pos = 0
+
+    def _set(self, result):
+        self._rows = result.rows
+        self._pos = 0
+        self.rowcount = result.rowcount
+        self.lastrowid = result.lastrowid
+        self.description = result.description
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._set(self.manager._execute(sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._set(self.manager._submit(
+            'executemany', sql, list(seq_of_parameters)))
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        row = self.fetchone()
+        while row is not None:
+            yield row
+            row = self.fetchone()
+
+    def close(self):
+        self._rows = []
+
+
+class ConnectionManager(object):
+    """ A sqlite3.Connection lookalike for one db file shared by threads.
+
+    SELECTs run on a read connection owned by the calling thread. All
+    other statements, commits and rollbacks are queued to a single writer
+    thread which owns the only write connection.
+
+    Visibility is the one of a single shared connection: while the writer
+    has an open transaction reads are sent to the writer as well, so a
+    thread always sees the writes issued before. A commit covers every
+    write queued before it. The writer merges commits arriving close
+    together into one COMMIT and only then returns from
+    :py:meth:`commit`. A SAVEPOINT after every commit request lets a
+    rollback undo the later writes without dropping the requested
+    commits.
+    """
+
+    def __init__(self, path, queue_size=WRITE_QUEUE_SIZE,
+                 group_commit_size=GROUP_COMMIT_SIZE):
+        self.path = path
+        self.group_commit_size = group_commit_size
+        self.commits = 0
+        self.commit_requests = 0
+        self._text_factory = str
+        self._trace_callback = None
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._queue = queue.Queue(queue_size)
+
+        # only touched by the writer thread
+        self._in_transaction = False
+        self._dirty = False
+        self._waiters = []
+
+        started = _Request('start')
+        self._writer = threading.Thread(target=self._run, args=(started, ),
+                                        name='omemo-db-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        started.wait()
+
+    # sqlite3.Connection API
+
+    @property
+    def text_factory(self):
+        return self._text_factory
+
+    @text_factory.setter
+    def text_factory(self, text_factory):
+        self._text_factory = text_factory
+        self._configure(lambda db: setattr(db, 'text_factory', text_factory))
+
+    @property
+    def in_transaction(self):
+        return self._in_transaction
+
+    def set_trace_callback(self, trace_callback):
+        self._trace_callback = trace_callback
+        self._configure(lambda db: db.set_trace_callback(trace_callback))
+
+    def cursor(self):
+        return ManagedCursor(self)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, script):
+        self._submit('executescript', script)
+
+    def commit(self):
+        self._submit('commit')
+
+    def rollback(self):
+        self._submit('rollback')
+
+    def close(self):
+        if not self._writer.is_alive():
+            return
+        self._queue.put(_STOP)
+        self._writer.join()
+        with self._readers_lock:
+            for db in self._readers:
+                db.close()
+            del self._readers[:]
+
+    def get_metrics(self):
+        return {'commits': self.commits,
+                'commit_requests': self.commit_requests,
+                'queued': self._queue.qsize(),
+                'readers': len(self._readers)}
+
+    # calling threads
+
+    def _connect(self, **kwargs):
+        db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                             check_same_thread=False,
+                             cached_statements=CACHED_STATEMENTS, **kwargs)
+        db.text_factory = self._text_factory
+        if self._trace_callback is not None:
+            db.set_trace_callback(self._trace_callback)
+        return db
+
+    def _reader(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = self._connect()
+            with self._readers_lock:
+                self._readers.append(db)
+        return db
+
+    def _configure(self, func):
+        self._submit('call', func)
+        with self._readers_lock:
+            for db in self._readers:
+                func(db)
+
+    def _submit(self, op, *args):
+        request = _Request(op, *args)
+        self._queue.put(request)
+        return request.wait()
+
+    def _execute(self, sql, parameters):
+        if _first_word(sql) == 'SELECT' and not self._in_transaction:
+            return _Result(self._reader().execute(sql, parameters))
+        return self._submit('execute', sql, parameters)
+
+    # writer thread
+
+    def _run(self, started):
+        try:
+            self._db = self._connect(isolation_level=None)
+        except Exception as e:
+            started.resolve(error=e)
+            return
+        started.resolve()
+
+        while True:
+            request = self._queue.get()
+            if request is _STOP:
+                break
+
+            if request.op == 'commit':
+                self._commit(request)
+            else:
+                try:
+                    request.resolve(getattr(self, '_do_' + request.op)(
+                        *request.args))
+                except Exception as e:
+                    request.resolve(error=e)
+
+            if (self._waiters and not self._dirty and
+                    (self._queue.empty() or
+                     len(self._waiters) >= self.group_commit_size)):
+                self._flush()
+
+        # writes nobody asked to commit are dropped, requested ones not
+        if self._dirty:
+            self._do_rollback()
+        if self._waiters:
+            self._flush()
+        self._db.close()
+
+    def _begin(self, sql):
+        if _first_word(sql) in _DML:
+            if not self._in_transaction:
+                self._db.execute('BEGIN')
+                self._in_transaction = True
+            self._dirty = True
+
+    def _do_execute(self, sql, parameters):
+        self._begin(sql)
+        return _Result(self._db.execute(sql, parameters))
+
+    def _do_executemany(self, sql, seq_of_parameters):
+        self._begin(sql)
+        return _Result(self._db.executemany(sql, seq_of_parameters))
+
+    def _do_executescript(self, script):
+        # sqlite3 commits an open transaction before running the script
+        self._db.executescript(script)
+        self._in_transaction = False
+        self._dirty = False
+        self._resolve_waiters()
+
+    def _do_call(self, func):
+        return func(self._db)
+
+    def _commit(self, request):
+        # the request is answered once its group is committed
+        self.commit_requests += 1
+        if not self._in_transaction:
+            request.resolve()
+            return
+        if self._dirty:
+            try:
+                self._db.execute('SAVEPOINT group_commit')
+            except Exception as e:
+                request.resolve(error=e)
+                return
+            self._dirty = False
+        self._waiters.append(request)
+
+    def _do_rollback(self):
+        if not self._in_transaction:
+            return
+        if self._waiters:
+            if self._dirty:
+                self._db.execute('ROLLBACK TO group_commit')
+        else:
+            self._db.execute('ROLLBACK')
+            self._in_transaction = False
+        self._dirty = False
+
+    def _flush(self):
+        error = None
+        try:
+            self._db.execute('COMMIT')
+            self.commits += 1
+        except Exception as e:
+            error = e
+            self._db.execute('ROLLBACK')
+        self._in_transaction = False
+        self._dirty = False
+        self._resolve_waiters(error)
+
+    def _resolve_waiters(self, error=None):
+        for request in self._waiters:
+            request.resolve(error=error)
+        del self._waiters[:]
 
 
 def _get_local_data_path(user):
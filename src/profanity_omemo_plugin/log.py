@@ -21,7 +21,16 @@
 from __future__ import unicode_literals
 
 import logging
-import traceback
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+try:
+    from logging.handlers import QueueHandler
+except ImportError:  # Python 2
+    QueueHandler = None
 
 PROFANITY_IS_HOST = True
 
@@ -30,6 +39,30 @@ try:
 except ImportError:
     PROFANITY_IS_HOST = False
 
+LOG_QUEUE_SIZE = 1024  # records waiting for a drain before we drop
+
+# names accepted by set_log_level
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR
+}
+
+# loggers whose level follows set_log_level
+_plugin_loggers = set()
+_log_level = logging.INFO
+
+
+# the prof function handling the records of each level
+_LEVEL_FUNCTIONS = {
+    logging.DEBUG: 'log_debug',
+    logging.INFO: 'log_info',
+    logging.WARNING: 'log_warning',
+    logging.ERROR: 'log_error',
+    logging.CRITICAL: 'log_error'
+}
+
 
 class ProfLogHandler(logging.Handler):
 
@@ -47,35 +80,146 @@ class ProfLogHandler(logging.Handler):
     def emit(self, record):
 
         if PROFANITY_IS_HOST:
-            level_fn_map = {
-                10: prof.log_debug,  # DEBUG
-                20: prof.log_info,  # INFO
-                30: prof.log_warning,  # WARNING
-                40: prof.log_error  # ERROR
-            }
-
             try:
+                # the formatter appends the traceback of record.exc_info
                 log_message = self.format(record)
-                try:
-                    if record.levelno == 40 and record.exc_info:
-                        tb_info = record.exc_info
-                        log_message += '\n' + traceback.print_exception(*tb_info)
-                except TypeError:  # tb_info is None
-                    pass
-
-                level_fn_map[record.levelno](log_message)
+                log_fn = getattr(prof, _LEVEL_FUNCTIONS.get(record.levelno,
+                                                            'log_error'))
+                log_fn(log_message)
             except Exception as e:
                 prof.log_error('Could not log last message. {0}'.format(repr(e)))
 
 
+if QueueHandler is None:
+
+    class QueueHandler(logging.Handler):
+        """ The parts of logging.handlers.QueueHandler we use. """
+
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def enqueue(self, record):
+            self.queue.put_nowait(record)
+
+        def prepare(self, record):
+            msg = self.format(record)
+            record.message = msg
+            record.msg = msg
+            record.args = None
+            record.exc_info = None
+            return record
+
+        def emit(self, record):
+            try:
+                self.enqueue(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+
+class BoundedQueueHandler(QueueHandler):
+    """ Queues records for the ProfLogListener, drops them if it falls behind.
+
+    Only the message is formatted on the logging thread, handing it to
+    profanity happens when the listener drains the queue.
+    """
+
+    def __init__(self, queue, prefix=None):
+        super(BoundedQueueHandler, self).__init__(queue)
+        self.dropped = 0
+
+        if prefix:
+            fmt_str = '{0} - %(message)s'.format(prefix)
+        else:
+            fmt_str = '%(name)s - %(message)s'
+        self.setFormatter(logging.Formatter(fmt_str))
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ProfLogListener(object):
+    """ Passes the queued records to profanity on the draining thread.
+
+    profanity expects its API to be called from the main thread, so the
+    plugin drains the queue from a timed task instead of a thread of its
+    own.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        # records arrive formatted by the BoundedQueueHandler
+        handler = ProfLogHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.handlers = (handler, )
+
+    def handle(self, record):
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def drain(self):
+        """ Hand all queued records to the handlers. """
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.handle(record)
+
+
+_log_queue = queue.Queue(LOG_QUEUE_SIZE)
+_plugin_handler = BoundedQueueHandler(_log_queue, prefix='ProfOmemoPlugin')
+_omemo_handler = BoundedQueueHandler(_log_queue)
+_listener = ProfLogListener(_log_queue)
+
+
+def drain_log_queue():
+    """ Ship the queued records to profanity, call on the main thread. """
+    _listener.drain()
+
+
+def _attach(logger, handler):
+    if handler not in logger.handlers:
+        logger.addHandler(handler)
+
+
 python_omemo_logger = logging.getLogger('omemo')
 python_omemo_logger.setLevel(logging.DEBUG)
-python_omemo_logger.addHandler(ProfLogHandler())
+_attach(python_omemo_logger, _omemo_handler)
 
 
 def get_plugin_logger(name):
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    logger.addHandler(ProfLogHandler(prefix='ProfOmemoPlugin'))
+    logger.setLevel(_log_level)
+    _attach(logger, _plugin_handler)
+    _plugin_loggers.add(name)
 
     return logger
+
+
+def set_log_level(level):
+    """ Set the level of all plugin loggers, level is a key of LOG_LEVELS.
+
+    Records below the level are dropped before their message is formatted.
+    """
+    global _log_level
+    try:
+        _log_level = LOG_LEVELS[level]
+    except KeyError:
+        raise ValueError('Unknown log level: {0}'.format(level))
+
+    for name in _plugin_loggers:
+        logging.getLogger(name).setLevel(_log_level)
+
+
+def get_log_metrics():
+    return {'queued': _log_queue.qsize(),
+            'dropped': _plugin_handler.dropped + _omemo_handler.dropped}
+
+
+# the omemo package logs through logging.getLogger directly
+get_plugin_logger('gajim.plugin_system.omemo')
@@ -25,35 +25,61 @@ from cryptography.hazmat.primitives.ciphers import Cipher
 from cryptography.hazmat.primitives.ciphers import algorithms
 from cryptography.hazmat.primitives.ciphers.modes import GCM
 
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:  # cryptography < 2.0
+    AESGCM = None
+
 # On Windows we have to import a specific backend because the
 # default_backend() mechanism doesnt work in Gajim for Windows.
 # Its because of how Gajim is build with cx_freeze
 
 if os.name == 'nt':
-    from cryptography.hazmat.backends.openssl import backend
+    from cryptography.hazmat.backends.openssl import backend as _backend
+    # AESGCM always resolves the default backend itself
+    AESGCM = None
 else:
     from cryptography.hazmat.backends import default_backend
+    _backend = default_backend()
+
+TAG_SIZE = 16
+# Decrypting the XEP-0384 layout with AESGCM needs one copy to join payload
+# and tag, encrypting one to split them. Above this size the copy costs more
+# than the Cipher setup saves.
+AEAD_COPY_LIMIT = 65536
 
 log = logging.getLogger('gajim.plugin_system.omemo')
 
-def aes_decrypt(_key, iv, payload):
-    """ Use AES128 GCM with the given key and iv to decrypt the payload. """
+
+def _split_key(_key, payload):
+    """ Return key, ciphertext and tag for both key/tag layouts. """
     if len(_key) >= 32:
         # XEP-0384
         log.debug('XEP Compliant Key/Tag')
-        data = payload
-        key = _key[:16]
-        tag = _key[16:]
+        return _key[:16], payload, _key[16:]
     else:
         # Legacy
         log.debug('Legacy Key/Tag')
-        data = payload[:-16]
-        key = _key
-        tag = payload[-16:]
-    if os.name == 'nt':
-        _backend = backend
+        return _key, payload[:-TAG_SIZE], payload[-TAG_SIZE:]
+
+
+def _aead_decrypt(_key, iv, payload):
+    if len(_key) >= 32:
+        log.debug('XEP Compliant Key/Tag')
+        return AESGCM(_key[:16]).decrypt(iv, payload + _key[16:], None)
     else:
-        _backend = default_backend()
+        # the legacy payload already ends with the tag
+        log.debug('Legacy Key/Tag')
+        return AESGCM(_key).decrypt(iv, payload, None)
+
+
+def _aead_encrypt(key, iv, plaintext):
+    data = AESGCM(key).encrypt(iv, plaintext, None)
+    return data[:-TAG_SIZE], data[-TAG_SIZE:]
+
+
+def _cipher_decrypt(_key, iv, payload):
+    key, data, tag = _split_key(_key, payload)
     decryptor = Cipher(
         algorithms.AES(key),
         GCM(iv, tag=tag),
@@ -61,14 +87,27 @@ def aes_decrypt(_key, iv, payload):
     return decryptor.update(data) + decryptor.finalize()
 
 
-def aes_encrypt(key, iv, plaintext):
-    """ Use AES128 GCM with the given key and iv to encrypt the plaintext. """
-    if os.name == 'nt':
-        _backend = backend
-    else:
-        _backend = default_backend()
+def _cipher_encrypt(key, iv, plaintext):
     encryptor = Cipher(
         algorithms.AES(key),
         GCM(iv),
         backend=_backend).encryptor()
     return encryptor.update(plaintext) + encryptor.finalize(), encryptor.tag
+
+
+def aes_decrypt(_key, iv, payload):
+    """ Use AES128 GCM with the given key and iv to decrypt the payload. """
+    if AESGCM is not None and (len(_key) < 32 or
+                               len(payload) <= AEAD_COPY_LIMIT):
+        return _aead_decrypt(_key, iv, payload)
+    return _cipher_decrypt(_key, iv, payload)
+
+
+def aes_encrypt(key, iv, plaintext):
+    """ Use AES128 GCM with the given key and iv to encrypt the plaintext.
+
+    Returns the ciphertext and the tag as bytes.
+    """
+    if AESGCM is not None and len(plaintext) <= AEAD_COPY_LIMIT:
+        return _aead_encrypt(key, iv, plaintext)
+    return _cipher_encrypt(key, iv, plaintext)
@@ -0,0 +1,104 @@
+''' Bounded pool of SessionCiphers '''
+
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+DEFAULT_CIPHER_POOL_SIZE = 512
+# Ciphers unused for a day are dropped on the next access of the pool,
+# 0 keeps them until they are pushed out by the capacity
+DEFAULT_CIPHER_TTL = 86400
+
+
+class CipherPool(object):
+    """ LRU pool of the SessionCiphers of an OmemoState.
+
+    A SessionCipher keeps no state of its own, the ratchet lives in the
+    store. Evicted ciphers are therefore simply recreated by `factory`
+    on their next use.
+    """
+
+    def __init__(self, factory, capacity=DEFAULT_CIPHER_POOL_SIZE,
+                 ttl=DEFAULT_CIPHER_TTL):
+        self.factory = factory
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (jid, device_id) => (cipher, last use)
+        self._ciphers = OrderedDict()
+
+    def __len__(self):
+        return len(self._ciphers)
+
+    def __contains__(self, key):
+        return key in self._ciphers
+
+    def get(self, jid, device_id):
+        now = time.time()
+        key = (jid, device_id)
+        entry = self._ciphers.pop(key, None)
+        if entry is not None and self._expired(entry, now):
+            self.evictions += 1
+            entry = None
+
+        if entry is not None:
+            self.hits += 1
+            # re-insert as most recently used
+            self._ciphers[key] = (entry[0], now)
+            return entry[0]
+
+        self.misses += 1
+        cipher = self.factory(jid, device_id)
+        self._ciphers[key] = (cipher, now)
+        self._shrink(now)
+        return cipher
+
+    def _expired(self, entry, now):
+        return self.ttl > 0 and entry[1] < now - self.ttl
+
+    def _shrink(self, now):
+        while len(self._ciphers) > max(self.capacity, 0):
+            self._ciphers.popitem(last=False)
+            self.evictions += 1
+
+        # the oldest entries are first, stop at the first one still in use
+        while self._ciphers:
+            key, entry = next(iter(self._ciphers.items()))
+            if not self._expired(entry, now):
+                break
+            del self._ciphers[key]
+            self.evictions += 1
+
+    def retain(self, jid, device_ids):
+        """ Evict the ciphers of all devices of jid not in device_ids. """
+        device_ids = set(device_ids)
+        stale = [key for key in self._ciphers
+                 if key[0] == jid and key[1] not in device_ids]
+        for key in stale:
+            del self._ciphers[key]
+        self.evictions += len(stale)
+        if stale:
+            log.debug('Evicted %d ciphers of %s', len(stale), jid)
+
+    def discard(self, jid, device_id):
+        """ Evict the cipher of one device, if there is one. """
+        if self._ciphers.pop((jid, device_id), None) is not None:
+            self.evictions += 1
+
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        self._shrink(time.time())
+
+    def clear(self):
+        self._ciphers.clear()
+
+    def get_metrics(self):
+        return {'size': len(self._ciphers),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
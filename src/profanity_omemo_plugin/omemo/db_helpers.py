@@ -1,5 +1,12 @@
 ''' Database helper functions '''
 
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# INSERT ... ON CONFLICT DO UPDATE is available since SQLite 3.24
+SQLITE_HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
 
 def table_exists(db, name):
     """ Check if the specified table exists in the db. """
@@ -13,3 +20,69 @@ def table_exists(db, name):
 def user_version(db):
     """ Return the value of PRAGMA user_version. """
     return db.execute('PRAGMA user_version').fetchone()[0]
+
+
+class TransactionScope(object):
+    """ Commit handling shared by all stores using the same connection.
+
+    Stores call :py:meth:`commit` instead of committing the connection
+    themselves. Inside of :py:meth:`transaction` these commits are deferred
+    and the outermost scope commits once, or rolls back on an exception.
+    The nesting depth is kept per thread, a transaction open in one thread
+    does not defer the commits of another.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._local = threading.local()
+        self._rollback_hooks = []
+
+    @property
+    def depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    @depth.setter
+    def depth(self, depth):
+        self._local.depth = depth
+
+    def add_rollback_hook(self, hook):
+        """ Register a callable which is called after every rollback. """
+        self._rollback_hooks.append(hook)
+
+    def commit(self):
+        if self.depth == 0:
+            self.db.commit()
+
+    def rollback(self):
+        self.db.rollback()
+        for hook in self._rollback_hooks:
+            hook()
+
+    @contextmanager
+    def joined(self, depth):
+        """ Let the calling thread work inside a transaction of depth.
+
+            Used by worker threads running on behalf of a thread which
+            holds the transaction open, their commits are deferred too.
+        """
+        previous = self.depth
+        self.depth = depth
+        try:
+            yield
+        finally:
+            self.depth = previous
+
+    @contextmanager
+    def transaction(self):
+        self.depth += 1
+        try:
+            yield
+        except BaseException:
+            self.depth -= 1
+            if self.depth == 0:
+                self.rollback()
+            raise
+
+        self.depth -= 1
+        if self.depth == 0:
+            self.db.commit()
@@ -18,46 +18,38 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from . import queries as sql
+from .db_helpers import TransactionScope
+
 
 class EncryptionState():
     """ Used to store if OMEMO is enabled or not between gajim restarts """
 
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, scope=None):
         """
         :type dbConn: Connection
+        :type scope: TransactionScope
         """
         self.dbConn = dbConn
+        self.scope = scope or TransactionScope(dbConn)
+        self.queries = sql.Queries(dbConn)
 
     def activate(self, jid):
-        q = """INSERT OR REPLACE INTO encryption_state (jid, encryption)
-               VALUES (?, 1) """
-
-        c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
-        self.dbConn.commit()
+        self.queries.execute(sql.UPSERT_ENCRYPTION, (jid, 1))
+        self.scope.commit()
 
     def deactivate(self, jid):
-        q = """INSERT OR REPLACE INTO encryption_state (jid, encryption)
-               VALUES (?, 0)"""
-
-        c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
-        self.dbConn.commit()
+        self.queries.execute(sql.UPSERT_ENCRYPTION, (jid, 0))
+        self.scope.commit()
 
     def is_active(self, jid):
-        q = 'SELECT encryption FROM encryption_state where jid = ?;'
-        c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
-        result = c.fetchone()
+        result = self.queries.fetchone(sql.SELECT_ENCRYPTION, (jid, ))
         if result is None:
             return False
         return result[0]
 
     def exist(self, jid):
-        q = 'SELECT encryption FROM encryption_state where jid = ?;'
-        c = self.dbConn.cursor()
-        c.execute(q, (jid, ))
-        result = c.fetchone()
+        result = self.queries.fetchone(sql.SELECT_ENCRYPTION, (jid, ))
         if result is None:
             return False
         else:
@@ -25,8 +25,9 @@ from axolotl.util.keyhelper import KeyHelper
 from .encryption import EncryptionState
 from .liteidentitykeystore import LiteIdentityKeyStore
 from .liteprekeystore import LitePreKeyStore
-from .litesessionstore import LiteSessionStore
+from .litesessionstore import LiteSessionStore, DEFAULT_SESSION_CACHE_SIZE
 from .litesignedprekeystore import LiteSignedPreKeyStore
+from .db_helpers import TransactionScope
 from .sql import SQLDatabase
 
 log = logging.getLogger('gajim.plugin_system.omemo')
@@ -37,20 +38,34 @@ SPK_ARCHIVE_TIME = 86400 * 15  # 15 Days
 SPK_CYCLE_TIME = 86400         # 24 Hours
 
 
+def _serializeKey(identityKey):
+    if identityKey is None:
+        return None
+    return identityKey.getPublicKey().serialize()
+
+
 class LiteAxolotlStore(AxolotlStore):
-    def __init__(self, connection):
+    def __init__(self, connection,
+                 session_cache_size=DEFAULT_SESSION_CACHE_SIZE,
+                 journal_mode=None, wal_autocheckpoint=None):
         try:
             connection.text_factory = bytes
         except(AttributeError):
             raise AssertionError('Expected a sqlite3.Connection got ' +
                                  str(connection))
 
-        self.sql = SQLDatabase(connection)
-        self.identityKeyStore = LiteIdentityKeyStore(connection)
-        self.preKeyStore = LitePreKeyStore(connection)
-        self.signedPreKeyStore = LiteSignedPreKeyStore(connection)
-        self.sessionStore = LiteSessionStore(connection)
-        self.encryptionStore = EncryptionState(connection)
+        self.sql = SQLDatabase(connection, journal_mode, wal_autocheckpoint)
+        self.scope = TransactionScope(connection)
+        self.identityKeyStore = LiteIdentityKeyStore(connection, self.scope)
+        self.preKeyStore = LitePreKeyStore(connection, self.scope)
+        self.signedPreKeyStore = LiteSignedPreKeyStore(connection, self.scope)
+        self.sessionStore = LiteSessionStore(connection, session_cache_size,
+                                             self.scope)
+        self.encryptionStore = EncryptionState(connection, self.scope)
+
+        # (recipient_id, device_id) => (serialized identity key, trust)
+        self._trustCache = {}
+        self.scope.add_rollback_hook(self._trustCache.clear)
 
         if not self.getLocalRegistrationId():
             log.info("Generating Axolotl keys")
@@ -61,15 +76,22 @@ class LiteAxolotlStore(AxolotlStore):
         registrationId = KeyHelper.generateRegistrationId()
         preKeys = KeyHelper.generatePreKeys(KeyHelper.getRandomSequence(),
                                             DEFAULT_PREKEY_AMOUNT)
-        self.storeLocalData(registrationId, identityKeyPair)
-
         signedPreKey = KeyHelper.generateSignedPreKey(
             identityKeyPair, KeyHelper.getRandomSequence(65536))
 
-        self.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
+        with self.transaction():
+            self.storeLocalData(registrationId, identityKeyPair)
+            self.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
+            self.storePreKeys(preKeys)
+
+    def transaction(self):
+        """ Run the writes of all stores in a single transaction.
 
-        for preKey in preKeys:
-            self.storePreKey(preKey.getId(), preKey)
+            Commits issued inside of the with block are deferred until the
+            outermost block exits. The transaction is rolled back if the
+            block raises.
+        """
+        return self.scope.transaction()
 
     def getIdentityKeyPair(self):
         return self.identityKeyStore.getIdentityKeyPair()
@@ -82,16 +104,47 @@ class LiteAxolotlStore(AxolotlStore):
 
     def saveIdentity(self, recepientId, identityKey):
         self.identityKeyStore.saveIdentity(recepientId, identityKey)
+        self._dropTrust(recepientId, _serializeKey(identityKey))
 
     def deleteIdentity(self, recipientId, identityKey):
         self.identityKeyStore.deleteIdentity(recipientId, identityKey)
+        self._dropTrust(recipientId, _serializeKey(identityKey))
 
     def isTrustedIdentity(self, recepientId, identityKey):
         return self.identityKeyStore.isTrustedIdentity(recepientId,
                                                        identityKey)
 
     def setTrust(self, identityKey, trust):
-        return self.identityKeyStore.setTrust(identityKey, trust)
+        result = self.identityKeyStore.setTrust(identityKey, trust)
+        self._dropTrust(publicKey=_serializeKey(identityKey))
+        return result
+
+    def getDeviceTrust(self, recipientId, deviceId):
+        """ Return the trust of the identity key used by a device session.
+
+            The result is cached until the identity key of the session or
+            the trust of the identity changes.
+        """
+        try:
+            return self._trustCache[(recipientId, deviceId)][1]
+        except KeyError:
+            pass
+
+        record = self.loadSession(recipientId, deviceId)
+        identityKey = record.getSessionState().getRemoteIdentityKey()
+        trust = self.isTrustedIdentity(recipientId, identityKey)
+        self._trustCache[(recipientId, deviceId)] = (
+            _serializeKey(identityKey), trust)
+        return trust
+
+    def _dropTrust(self, recipientId=None, publicKey=None):
+        """ Remove all cached trust entries matching the given values. """
+        for key, (cachedKey, _) in list(self._trustCache.items()):
+            if recipientId is not None and key[0] != recipientId:
+                continue
+            if publicKey is not None and cachedKey != publicKey:
+                continue
+            del self._trustCache[key]
 
     def getFingerprints(self, jid):
         return self.identityKeyStore.getFingerprints(jid)
@@ -117,6 +170,9 @@ class LiteAxolotlStore(AxolotlStore):
     def storePreKey(self, preKeyId, preKeyRecord):
         self.preKeyStore.storePreKey(preKeyId, preKeyRecord)
 
+    def storePreKeys(self, preKeys):
+        self.preKeyStore.storePreKeys(preKeys)
+
     def containsPreKey(self, preKeyId):
         return self.preKeyStore.containsPreKey(preKeyId)
 
@@ -136,20 +192,36 @@ class LiteAxolotlStore(AxolotlStore):
         # TODO Reuse this
         return self.sessionStore.getSubDeviceSessions(recepientId)
 
+    def getSessionDeviceIds(self, recipientId):
+        return self.sessionStore.getSessionDeviceIds(recipientId)
+
     def getJidFromDevice(self, device_id):
         return self.sessionStore.getJidFromDevice(device_id)
 
     def storeSession(self, recepientId, deviceId, sessionRecord):
         self.sessionStore.storeSession(recepientId, deviceId, sessionRecord)
 
+        cached = self._trustCache.get((recepientId, deviceId))
+        if cached is not None:
+            identityKey = sessionRecord.getSessionState() \
+                .getRemoteIdentityKey()
+            if _serializeKey(identityKey) != cached[0]:
+                del self._trustCache[(recepientId, deviceId)]
+
     def containsSession(self, recepientId, deviceId):
         return self.sessionStore.containsSession(recepientId, deviceId)
 
     def deleteSession(self, recepientId, deviceId):
         self.sessionStore.deleteSession(recepientId, deviceId)
+        self._trustCache.pop((recepientId, deviceId), None)
 
     def deleteAllSessions(self, recepientId):
         self.sessionStore.deleteAllSessions(recepientId)
+        self._dropTrust(recepientId)
+
+    def invalidateSession(self, recepientId, deviceId):
+        self.sessionStore.invalidateSession(recepientId, deviceId)
+        self._trustCache.pop((recepientId, deviceId), None)
 
     def getSessionsFromJid(self, recipientId):
         return self.sessionStore.getSessionsFromJid(recipientId)
@@ -22,24 +22,26 @@ from axolotl.identitykey import IdentityKey
 from axolotl.identitykeypair import IdentityKeyPair
 from axolotl.state.identitykeystore import IdentityKeyStore
 
+from . import queries as sql
+from .db_helpers import TransactionScope
+
 UNDECIDED = 2
 TRUSTED = 1
 UNTRUSTED = 0
 
 
 class LiteIdentityKeyStore(IdentityKeyStore):
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, scope=None):
         """
         :type dbConn: Connection
+        :type scope: TransactionScope
         """
         self.dbConn = dbConn
+        self.scope = scope or TransactionScope(dbConn)
+        self.queries = sql.Queries(dbConn)
 
     def getIdentityKeyPair(self):
-        q = "SELECT public_key, private_key FROM identities " + \
-            "WHERE recipient_id = -1"
-        c = self.dbConn.cursor()
-        c.execute(q)
-        result = c.fetchone()
+        result = self.queries.fetchone(sql.SELECT_IDENTITY_KEY_PAIR)
 
         publicKey, privateKey = result
         return IdentityKeyPair(
@@ -47,59 +49,42 @@ class LiteIdentityKeyStore(IdentityKeyStore):
             DjbECPrivateKey(privateKey))
 
     def getLocalRegistrationId(self):
-        q = "SELECT registration_id FROM identities WHERE recipient_id = -1"
-        c = self.dbConn.cursor()
-        c.execute(q)
-        result = c.fetchone()
+        result = self.queries.fetchone(sql.SELECT_REGISTRATION_ID)
         return result[0] if result else None
 
     def storeLocalData(self, registrationId, identityKeyPair):
-        q = "INSERT INTO identities( " + \
-            "recipient_id, registration_id, public_key, private_key) " + \
-            "VALUES(-1, ?, ?, ?)"
-        c = self.dbConn.cursor()
-        c.execute(q,
-                  (registrationId,
-                   identityKeyPair.getPublicKey().getPublicKey().serialize(),
-                   identityKeyPair.getPrivateKey().serialize()))
+        self.queries.execute(
+            sql.INSERT_LOCAL_IDENTITY,
+            (registrationId,
+             identityKeyPair.getPublicKey().getPublicKey().serialize(),
+             identityKeyPair.getPrivateKey().serialize()))
 
-        self.dbConn.commit()
+        self.scope.commit()
 
     def saveIdentity(self, recipientId, identityKey):
-        q = "INSERT INTO identities (recipient_id, public_key, trust) " \
-            "VALUES(?, ?, ?)"
-        c = self.dbConn.cursor()
-
         if not self.getIdentity(recipientId, identityKey):
-            c.execute(q, (recipientId,
-                          identityKey.getPublicKey().serialize(),
-                          UNDECIDED))
-            self.dbConn.commit()
+            self.queries.execute(sql.INSERT_IDENTITY,
+                                 (recipientId,
+                                  identityKey.getPublicKey().serialize(),
+                                  UNDECIDED))
+            self.scope.commit()
 
     def getIdentity(self, recipientId, identityKey):
-        q = "SELECT * FROM identities WHERE recipient_id = ? " \
-            "AND public_key = ?"
-        c = self.dbConn.cursor()
-
-        c.execute(q, (recipientId, identityKey.getPublicKey().serialize()))
-        result = c.fetchone()
-
-        return result is not None
+        result = self.queries.fetchone(
+            sql.IDENTITY_EXISTS,
+            (recipientId, identityKey.getPublicKey().serialize()))
+        return result[0] == 1
 
     def deleteIdentity(self, recipientId, identityKey):
-        q = "DELETE FROM identities WHERE recipient_id = ? AND public_key = ?"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId,
-                      identityKey.getPublicKey().serialize()))
-        self.dbConn.commit()
+        self.queries.execute(sql.DELETE_IDENTITY,
+                             (recipientId,
+                              identityKey.getPublicKey().serialize()))
+        self.scope.commit()
 
     def isTrustedIdentity(self, recipientId, identityKey):
-        q = "SELECT trust FROM identities WHERE recipient_id = ? " \
-            "AND public_key = ?"
-        c = self.dbConn.cursor()
-
-        c.execute(q, (recipientId, identityKey.getPublicKey().serialize()))
-        result = c.fetchone()
+        result = self.queries.fetchone(
+            sql.SELECT_TRUST,
+            (recipientId, identityKey.getPublicKey().serialize()))
 
         states = [UNTRUSTED, TRUSTED, UNDECIDED]
 
@@ -109,66 +94,35 @@ class LiteIdentityKeyStore(IdentityKeyStore):
             return True
 
     def getAllFingerprints(self):
-        q = "SELECT _id, recipient_id, public_key, trust FROM identities " \
-            "WHERE recipient_id != -1 ORDER BY recipient_id ASC"
-        c = self.dbConn.cursor()
-
         result = []
-        for row in c.execute(q):
+        for row in self.queries.fetchall(sql.SELECT_ALL_FINGERPRINTS):
             result.append((row[0], row[1], row[2], row[3]))
         return result
 
     def getFingerprints(self, jid):
-        q = "SELECT _id, recipient_id, public_key, trust FROM identities " \
-            "WHERE recipient_id =? ORDER BY trust ASC"
-        c = self.dbConn.cursor()
-
         result = []
-        c.execute(q, (jid,))
-        rows = c.fetchall()
-        for row in rows:
+        for row in self.queries.fetchall(sql.SELECT_FINGERPRINTS, (jid,)):
             result.append((row[0], row[1], row[2], row[3]))
         return result
 
     def getTrustedFingerprints(self, jid):
-        q = "SELECT public_key FROM identities WHERE recipient_id = ? AND trust = ?"
-        c = self.dbConn.cursor()
-
-        result = []
-        c.execute(q, (jid, TRUSTED))
-        rows = c.fetchall()
-        for row in rows:
-            result.append(row[0])
-        return result
+        rows = self.queries.fetchall(sql.SELECT_FINGERPRINTS_BY_TRUST,
+                                     (jid, TRUSTED))
+        return [row[0] for row in rows]
 
     def getUndecidedFingerprints(self, jid):
-        q = "SELECT trust FROM identities WHERE recipient_id = ? AND trust = ?"
-        c = self.dbConn.cursor()
-
-        result = []
-        c.execute(q, (jid, UNDECIDED))
-        result = c.fetchall()
-
-        return result
+        return self.queries.fetchall(sql.SELECT_TRUST_BY_TRUST,
+                                     (jid, UNDECIDED))
 
     def getNewFingerprints(self, jid):
-        q = "SELECT _id FROM identities WHERE shown = 0 AND " \
-            "recipient_id = ?"
-        c = self.dbConn.cursor()
-        result = []
-        for row in c.execute(q, (jid,)):
-            result.append(row[0])
-        return result
+        rows = self.queries.fetchall(sql.SELECT_NEW_FINGERPRINTS, (jid,))
+        return [row[0] for row in rows]
 
     def setShownFingerprints(self, fingerprints):
-        q = "UPDATE identities SET shown = 1 WHERE _id IN ({})" \
-            .format(', '.join(['?'] * len(fingerprints)))
-        c = self.dbConn.cursor()
-        c.execute(q, fingerprints)
-        self.dbConn.commit()
+        self.queries.execute_in(sql.UPDATE_SHOWN_FINGERPRINTS, fingerprints)
+        self.scope.commit()
 
     def setTrust(self, identityKey, trust):
-        q = "UPDATE identities SET trust = ? WHERE public_key = ?"
-        c = self.dbConn.cursor()
-        c.execute(q, (trust, identityKey.getPublicKey().serialize()))
-        self.dbConn.commit()
+        self.queries.execute(sql.UPDATE_TRUST,
+                             (trust, identityKey.getPublicKey().serialize()))
+        self.scope.commit()
@@ -17,71 +17,103 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from base64 import b64encode
+from collections import OrderedDict
+
 from axolotl.state.prekeyrecord import PreKeyRecord
 from axolotl.state.prekeystore import PreKeyStore
 from axolotl.util.keyhelper import KeyHelper
 
+from . import queries as sql
+from .db_helpers import TransactionScope
+
+def _publicKey(preKey):
+    """ Return the base64 encoded public key as published in the bundle. """
+    return b64encode(preKey.getKeyPair().getPublicKey().serialize()).decode(
+        'ascii')
+
 
 class LitePreKeyStore(PreKeyStore):
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, scope=None):
         """
         :type dbConn: Connection
+        :type scope: TransactionScope
         """
         self.dbConn = dbConn
+        self.scope = scope or TransactionScope(dbConn)
+        self.queries = sql.Queries(dbConn)
+        # Incremented whenever the set of stored PreKeys changes
+        self.version = 0
+        self._publicKeys = None
+        self.scope.add_rollback_hook(self._resetPublicKeys)
+
+    def _resetPublicKeys(self):
+        self._publicKeys = None
+        self.version += 1
+
+    def getPublicPreKeys(self):
+        """ Return a list of (prekey_id, base64 public key) tuples.
+
+        The public keys are kept in memory and updated as PreKeys are
+        stored and removed, so the records are only deserialized once.
+        """
+        if self._publicKeys is None:
+            self._publicKeys = OrderedDict(
+                (preKey.getId(), _publicKey(preKey))
+                for preKey in self.loadPendingPreKeys())
 
-    def loadPreKey(self, preKeyId):
-        q = "SELECT record FROM prekeys WHERE prekey_id = ?"
+        return list(self._publicKeys.items())
 
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (preKeyId, ))
+    def _addPublicKeys(self, preKeys):
+        if self._publicKeys is not None:
+            for preKey in preKeys:
+                self._publicKeys[preKey.getId()] = _publicKey(preKey)
+        self.version += 1
 
-        result = cursor.fetchone()
+    def loadPreKey(self, preKeyId):
+        result = self.queries.fetchone(sql.SELECT_PREKEY, (preKeyId, ))
         if not result:
             raise Exception("No such prekeyRecord!")
 
         return PreKeyRecord(serialized=result[0])
 
     def loadPendingPreKeys(self):
-        q = "SELECT record FROM prekeys"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q)
-        result = cursor.fetchall()
-
+        result = self.queries.fetchall(sql.SELECT_PREKEYS)
         return [PreKeyRecord(serialized=r[0]) for r in result]
 
     def storePreKey(self, preKeyId, preKeyRecord):
-        q = "INSERT INTO prekeys (prekey_id, record) VALUES(?,?)"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (preKeyId, preKeyRecord.serialize()))
-        self.dbConn.commit()
+        self.queries.execute(sql.INSERT_PREKEY,
+                             (preKeyId, preKeyRecord.serialize()))
+        self.scope.commit()
+        self._addPublicKeys([preKeyRecord])
+
+    def storePreKeys(self, preKeys):
+        """ Store a list of PreKeyRecords with a single commit. """
+        with self.scope.transaction():
+            self.queries.executemany(
+                sql.INSERT_PREKEY,
+                ((preKey.getId(), preKey.serialize()) for preKey in preKeys))
+        self._addPublicKeys(preKeys)
 
     def containsPreKey(self, preKeyId):
-        q = "SELECT record FROM prekeys WHERE prekey_id = ?"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (preKeyId, ))
-        return cursor.fetchone() is not None
+        return self.queries.fetchone(sql.PREKEY_EXISTS,
+                                     (preKeyId, )) is not None
 
     def removePreKey(self, preKeyId):
-        q = "DELETE FROM prekeys WHERE prekey_id = ?"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (preKeyId, ))
-        self.dbConn.commit()
+        cursor = self.queries.execute(sql.DELETE_PREKEY, (preKeyId, ))
+        self.scope.commit()
+        if cursor.rowcount:
+            if self._publicKeys is not None:
+                self._publicKeys.pop(preKeyId, None)
+            self.version += 1
 
     def getCurrentPreKeyId(self):
-        q = "SELECT MAX(prekey_id) FROM prekeys"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q)
-        return cursor.fetchone()[0]
+        return self.queries.fetchone(sql.SELECT_MAX_PREKEY_ID)[0]
 
     def getPreKeyCount(self):
-        q = "SELECT COUNT(prekey_id) FROM prekeys"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q)
-        return cursor.fetchone()[0]
+        return self.queries.fetchone(sql.SELECT_PREKEY_COUNT)[0]
 
     def generateNewPreKeys(self, count):
-        startId = self.getCurrentPreKeyId() + 1
-        preKeys = KeyHelper.generatePreKeys(startId, count)
-
-        for preKey in preKeys:
-            self.storePreKey(preKey.getId(), preKey)
+        """ Generate count new PreKeys and store them with one commit. """
+        startId = (self.getCurrentPreKeyId() or 0) + 1
+        self.storePreKeys(KeyHelper.generatePreKeys(startId, count))
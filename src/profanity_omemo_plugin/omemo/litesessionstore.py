@@ -17,125 +17,192 @@
 # the Gajim-OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+from collections import OrderedDict
+
 from axolotl.state.sessionrecord import SessionRecord
 from axolotl.state.sessionstore import SessionStore
 
+from . import queries as sql
+from .db_helpers import SQLITE_HAS_UPSERT, TransactionScope
+
+DEFAULT_SESSION_CACHE_SIZE = 256
+
 
 class LiteSessionStore(SessionStore):
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, cache_size=DEFAULT_SESSION_CACHE_SIZE,
+                 scope=None):
         """
         :type dbConn: Connection
+        :param cache_size: amount of deserialized SessionRecords kept in
+                           memory, 0 disables the cache
+        :type scope: TransactionScope
         """
         self.dbConn = dbConn
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        # recipient_id => frozenset of device_ids with a session
+        self._deviceIds = {}
+        self.scope = scope or TransactionScope(dbConn)
+        self.queries = sql.Queries(dbConn)
+        # rolled back records must not survive in the cache
+        self.scope.add_rollback_hook(self._cache.clear)
+        self.scope.add_rollback_hook(self._deviceIds.clear)
+
+    def _cache_get(self, key):
+        record = self._cache.pop(key, None)
+        if record is None:
+            self.cache_misses += 1
+            return None
+
+        # re-insert as most recently used
+        self._cache[key] = record
+        self.cache_hits += 1
+        return record
+
+    def _cache_put(self, key, record):
+        if self.cache_size <= 0:
+            return
+
+        self._cache.pop(key, None)
+        self._cache[key] = record
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def invalidateSession(self, recipientId, deviceId):
+        """ Drop a cached SessionRecord which may differ from the db. """
+        self._cache.pop((recipientId, deviceId), None)
+
+    def setCacheSize(self, cache_size):
+        self.cache_size = cache_size
+        while len(self._cache) > max(cache_size, 0):
+            self._cache.popitem(last=False)
+
+    def getCacheInfo(self):
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'size': len(self._cache),
+                'capacity': self.cache_size}
 
     def loadSession(self, recipientId, deviceId):
-        q = "SELECT record FROM sessions WHERE recipient_id = ? AND device_id = ?"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId, deviceId))
-        result = c.fetchone()
+        key = (recipientId, deviceId)
+        record = self._cache_get(key)
+        if record is not None:
+            return record
+
+        result = self.queries.fetchone(sql.SELECT_SESSION,
+                                       (recipientId, deviceId))
 
         if result:
-            return SessionRecord(serialized=result[0])
+            record = SessionRecord(serialized=result[0])
         else:
-            return SessionRecord()
+            record = SessionRecord()
+
+        self._cache_put(key, record)
+        return record
 
     def getSubDeviceSessions(self, recipientId):
-        q = "SELECT device_id from sessions WHERE recipient_id = ?"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId, ))
-        result = c.fetchall()
+        result = self.queries.fetchall(sql.SELECT_SESSION_DEVICE_IDS,
+                                       (recipientId, ))
 
         deviceIds = [r[0] for r in result]
         return deviceIds
 
+    def getSessionDeviceIds(self, recipientId):
+        """ Return the device_ids which have a session with recipientId.
+
+            The ids are cached per recipient and kept up to date by the
+            writes of this store.
+        """
+        deviceIds = self._deviceIds.get(recipientId)
+        if deviceIds is None:
+            deviceIds = frozenset(self.getSubDeviceSessions(recipientId))
+            self._deviceIds[recipientId] = deviceIds
+        return deviceIds
+
     def getJidFromDevice(self, device_id):
-        q = "SELECT recipient_id from sessions WHERE device_id = ?"
-        c = self.dbConn.cursor()
-        c.execute(q, (device_id, ))
-        result = c.fetchone()
+        result = self.queries.fetchone(sql.SELECT_JID_OF_DEVICE, (device_id, ))
 
         return result[0]
 
     def getActiveDeviceTuples(self):
-        q = "SELECT recipient_id, device_id FROM sessions WHERE active = 1"
-        c = self.dbConn.cursor()
         result = []
-        for row in c.execute(q):
+        for row in self.queries.fetchall(sql.SELECT_ACTIVE_DEVICES):
             result.append((row[0], row[1]))
         return result
 
     def storeSession(self, recipientId, deviceId, sessionRecord):
-        self.deleteSession(recipientId, deviceId)
+        record = sessionRecord.serialize()
+
+        # update in place, so the active state of the device is kept
+        if SQLITE_HAS_UPSERT:
+            self.queries.execute(sql.UPSERT_SESSION,
+                                 (recipientId, deviceId, record))
+        else:
+            c = self.queries.execute(sql.UPDATE_SESSION,
+                                     (record, recipientId, deviceId))
+            if c.rowcount == 0:
+                self.queries.execute(sql.INSERT_SESSION,
+                                     (recipientId, deviceId, record))
+
+        self.scope.commit()
+        self._cache_put((recipientId, deviceId), sessionRecord)
 
-        q = "INSERT INTO sessions(recipient_id, device_id, record) VALUES(?,?,?)"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId, deviceId, sessionRecord.serialize()))
-        self.dbConn.commit()
+        deviceIds = self._deviceIds.get(recipientId)
+        if deviceIds is not None and deviceId not in deviceIds:
+            self._deviceIds[recipientId] = deviceIds | {deviceId}
 
     def containsSession(self, recipientId, deviceId):
-        q = "SELECT record FROM sessions WHERE recipient_id = ? AND device_id = ?"
-        c = self.dbConn.cursor()
-        c.execute(q, (recipientId, deviceId))
-        result = c.fetchone()
+        result = self.queries.fetchone(sql.SESSION_EXISTS,
+                                       (recipientId, deviceId))
 
         return result is not None
 
     def deleteSession(self, recipientId, deviceId):
-        q = "DELETE FROM sessions WHERE recipient_id = ? AND device_id = ?"
-        self.dbConn.cursor().execute(q, (recipientId, deviceId))
-        self.dbConn.commit()
+        self.queries.execute(sql.DELETE_SESSION, (recipientId, deviceId))
+        self.scope.commit()
+        self.invalidateSession(recipientId, deviceId)
+
+        deviceIds = self._deviceIds.get(recipientId)
+        if deviceIds is not None:
+            self._deviceIds[recipientId] = deviceIds - {deviceId}
 
     def deleteAllSessions(self, recipientId):
-        q = "DELETE FROM sessions WHERE recipient_id = ?"
-        self.dbConn.cursor().execute(q, (recipientId, ))
-        self.dbConn.commit()
+        self.queries.execute(sql.DELETE_SESSIONS, (recipientId, ))
+        self.scope.commit()
+        for key in [k for k in self._cache if k[0] == recipientId]:
+            del self._cache[key]
+        self._deviceIds[recipientId] = frozenset()
 
     def getAllSessions(self):
-        q = "SELECT _id, recipient_id, device_id, record, active from sessions"
-        c = self.dbConn.cursor()
         result = []
-        for row in c.execute(q):
+        for row in self.queries.fetchall(sql.SELECT_ALL_SESSIONS):
             result.append((row[0], row[1], row[2], row[3], row[4]))
         return result
 
     def getSessionsFromJid(self, recipientId):
-        q = "SELECT _id, recipient_id, device_id, record, active from sessions" \
-            " WHERE recipient_id = ?"
-        c = self.dbConn.cursor()
         result = []
-        for row in c.execute(q, (recipientId,)):
+        for row in self.queries.fetchall(sql.SELECT_SESSIONS, (recipientId,)):
             result.append((row[0], row[1], row[2], row[3], row[4]))
         return result
 
     def getSessionsFromJids(self, recipientId):
-        q = "SELECT _id, recipient_id, device_id, record, active from sessions" \
-            " WHERE recipient_id IN ({})" \
-            .format(', '.join(['?'] * len(recipientId)))
-        c = self.dbConn.cursor()
         result = []
-        for row in c.execute(q, recipientId):
+        for row in self.queries.execute_in(sql.SELECT_SESSIONS_OF_JIDS,
+                                           recipientId):
             result.append((row[0], row[1], row[2], row[3], row[4]))
         return result
 
     def setActiveState(self, deviceList, jid):
-        c = self.dbConn.cursor()
-
-        q = "UPDATE sessions SET active = {} " \
-            "WHERE recipient_id = '{}' AND device_id IN ({})" \
-            .format(1, jid, ', '.join(['?'] * len(deviceList)))
-        c.execute(q, deviceList)
-
-        q = "UPDATE sessions SET active = {} " \
-            "WHERE recipient_id = '{}' AND device_id NOT IN ({})" \
-            .format(0, jid, ', '.join(['?'] * len(deviceList)))
-        c.execute(q, deviceList)
-        self.dbConn.commit()
+        with self.scope.transaction():
+            self.queries.execute(sql.DEACTIVATE_SESSIONS, (jid, ))
+            self.queries.execute_in(sql.ACTIVATE_SESSIONS, deviceList, (jid, ))
 
     def getInactiveSessionsKeys(self, recipientId):
-        q = "SELECT record FROM sessions WHERE active = 0 AND recipient_id = ?"
-        c = self.dbConn.cursor()
         result = []
-        for row in c.execute(q, (recipientId,)):
+        for row in self.queries.fetchall(sql.SELECT_INACTIVE_SESSIONS,
+                                         (recipientId,)):
             public_key = (SessionRecord(serialized=row[0]).
                           getSessionState().getRemoteIdentityKey().
                           getPublicKey())
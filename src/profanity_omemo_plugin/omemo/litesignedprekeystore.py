@@ -22,21 +22,29 @@ from axolotl.state.signedprekeyrecord import SignedPreKeyRecord
 from axolotl.state.signedprekeystore import SignedPreKeyStore
 from axolotl.util.medium import Medium
 
+from . import queries as sql
+from .db_helpers import TransactionScope
+
 
 class LiteSignedPreKeyStore(SignedPreKeyStore):
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, scope=None):
         """
         :type dbConn: Connection
+        :type scope: TransactionScope
         """
         self.dbConn = dbConn
+        self.scope = scope or TransactionScope(dbConn)
+        self.queries = sql.Queries(dbConn)
+        # Incremented whenever the set of stored SignedPreKeys changes
+        self.version = 0
+        self.scope.add_rollback_hook(self._changed)
 
-    def loadSignedPreKey(self, signedPreKeyId):
-        q = "SELECT record FROM signed_prekeys WHERE prekey_id = ?"
-
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (signedPreKeyId, ))
+    def _changed(self):
+        self.version += 1
 
-        result = cursor.fetchone()
+    def loadSignedPreKey(self, signedPreKeyId):
+        result = self.queries.fetchone(sql.SELECT_SIGNED_PREKEY,
+                                       (signedPreKeyId, ))
         if not result:
             raise InvalidKeyIdException("No such signedprekeyrecord! %s " %
                                         signedPreKeyId)
@@ -44,11 +52,7 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
         return SignedPreKeyRecord(serialized=result[0])
 
     def loadSignedPreKeys(self):
-        q = "SELECT record FROM signed_prekeys"
-
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, )
-        result = cursor.fetchall()
+        result = self.queries.fetchall(sql.SELECT_SIGNED_PREKEYS)
         results = []
         for row in result:
             results.append(SignedPreKeyRecord(serialized=row[0]))
@@ -56,22 +60,21 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
         return results
 
     def storeSignedPreKey(self, signedPreKeyId, signedPreKeyRecord):
-        q = "INSERT INTO signed_prekeys (prekey_id, record) VALUES(?,?)"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (signedPreKeyId, signedPreKeyRecord.serialize()))
-        self.dbConn.commit()
+        self.queries.execute(sql.INSERT_SIGNED_PREKEY,
+                             (signedPreKeyId, signedPreKeyRecord.serialize()))
+        self.scope.commit()
+        self._changed()
 
     def containsSignedPreKey(self, signedPreKeyId):
-        q = "SELECT record FROM signed_prekeys WHERE prekey_id = ?"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (signedPreKeyId, ))
-        return cursor.fetchone() is not None
+        return self.queries.fetchone(sql.SIGNED_PREKEY_EXISTS,
+                                     (signedPreKeyId, )) is not None
 
     def removeSignedPreKey(self, signedPreKeyId):
-        q = "DELETE FROM signed_prekeys WHERE prekey_id = ?"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (signedPreKeyId, ))
-        self.dbConn.commit()
+        cursor = self.queries.execute(sql.DELETE_SIGNED_PREKEY,
+                                      (signedPreKeyId, ))
+        self.scope.commit()
+        if cursor.rowcount:
+            self._changed()
 
     def getNextSignedPreKeyId(self):
         result = self.getCurrentSignedPreKeyId()
@@ -81,24 +84,15 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
             return (result % (Medium.MAX_VALUE - 1)) + 1
 
     def getCurrentSignedPreKeyId(self):
-        q = "SELECT MAX(prekey_id) FROM signed_prekeys"
-
-        cursor = self.dbConn.cursor()
-        cursor.execute(q)
-        result = cursor.fetchone()
+        result = self.queries.fetchone(sql.SELECT_MAX_SIGNED_PREKEY_ID)
         if not result:
             return None
         else:
             return result[0]
 
     def getSignedPreKeyTimestamp(self, signedPreKeyId):
-        q = "SELECT strftime('%s', timestamp) FROM " \
-            "signed_prekeys WHERE prekey_id = ?"
-
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (signedPreKeyId, ))
-
-        result = cursor.fetchone()
+        result = self.queries.fetchone(sql.SELECT_SIGNED_PREKEY_TIMESTAMP,
+                                       (signedPreKeyId, ))
         if not result:
             raise InvalidKeyIdException("No such signedprekeyrecord! %s " %
                                         signedPreKeyId)
@@ -106,8 +100,8 @@ class LiteSignedPreKeyStore(SignedPreKeyStore):
         return result[0]
 
     def removeOldSignedPreKeys(self, timestamp):
-        q = "DELETE FROM signed_prekeys " \
-            "WHERE timestamp < datetime(?, 'unixepoch')"
-        cursor = self.dbConn.cursor()
-        cursor.execute(q, (timestamp, ))
-        self.dbConn.commit()
+        cursor = self.queries.execute(sql.DELETE_OLD_SIGNED_PREKEYS,
+                                      (timestamp, ))
+        self.scope.commit()
+        if cursor.rowcount:
+            self._changed()
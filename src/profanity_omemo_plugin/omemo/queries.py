@@ -0,0 +1,169 @@
+''' SQL statements of the Lite*Store classes
+
+Every statement the stores run is defined here with a fixed text, so the
+statement cache of sqlite3 compiles each of them only once per
+connection. Lists of values are never formatted into the SQL, statements
+with an IN clause take a fixed number of IN_CHUNK_SIZE parameters and are
+run once per chunk by :py:meth:`Queries.execute_in`.
+'''
+
+import threading
+from collections import OrderedDict
+
+# IN clauses take this many parameters, shorter chunks are padded
+IN_CHUNK_SIZE = 16
+# Size of the sqlite3 statement cache, room for all statements below
+CACHED_STATEMENTS = 128
+
+
+def _in(sql):
+    return sql.format(', '.join(['?'] * IN_CHUNK_SIZE))
+
+
+# identities
+SELECT_IDENTITY_KEY_PAIR = \
+    "SELECT public_key, private_key FROM identities WHERE recipient_id = -1"
+SELECT_REGISTRATION_ID = \
+    "SELECT registration_id FROM identities WHERE recipient_id = -1"
+INSERT_LOCAL_IDENTITY = \
+    "INSERT INTO identities(recipient_id, registration_id, public_key, " \
+    "private_key) VALUES(-1, ?, ?, ?)"
+INSERT_IDENTITY = \
+    "INSERT INTO identities (recipient_id, public_key, trust) VALUES(?, ?, ?)"
+IDENTITY_EXISTS = \
+    "SELECT EXISTS(SELECT 1 FROM identities WHERE recipient_id = ? " \
+    "AND public_key = ?)"
+DELETE_IDENTITY = \
+    "DELETE FROM identities WHERE recipient_id = ? AND public_key = ?"
+SELECT_TRUST = \
+    "SELECT trust FROM identities WHERE recipient_id = ? AND public_key = ?"
+SELECT_ALL_FINGERPRINTS = \
+    "SELECT _id, recipient_id, public_key, trust FROM identities " \
+    "WHERE recipient_id != -1 ORDER BY recipient_id ASC"
+SELECT_FINGERPRINTS = \
+    "SELECT _id, recipient_id, public_key, trust FROM identities " \
+    "WHERE recipient_id = ? ORDER BY trust ASC"
+SELECT_FINGERPRINTS_BY_TRUST = \
+    "SELECT public_key FROM identities WHERE recipient_id = ? AND trust = ?"
+SELECT_TRUST_BY_TRUST = \
+    "SELECT trust FROM identities WHERE recipient_id = ? AND trust = ?"
+SELECT_NEW_FINGERPRINTS = \
+    "SELECT _id FROM identities WHERE shown = 0 AND recipient_id = ?"
+UPDATE_SHOWN_FINGERPRINTS = \
+    _in("UPDATE identities SET shown = 1 WHERE _id IN ({0})")
+UPDATE_TRUST = "UPDATE identities SET trust = ? WHERE public_key = ?"
+
+# prekeys
+SELECT_PREKEY = "SELECT record FROM prekeys WHERE prekey_id = ?"
+SELECT_PREKEYS = "SELECT record FROM prekeys"
+INSERT_PREKEY = "INSERT INTO prekeys (prekey_id, record) VALUES(?,?)"
+PREKEY_EXISTS = "SELECT 1 FROM prekeys WHERE prekey_id = ?"
+DELETE_PREKEY = "DELETE FROM prekeys WHERE prekey_id = ?"
+SELECT_MAX_PREKEY_ID = "SELECT MAX(prekey_id) FROM prekeys"
+SELECT_PREKEY_COUNT = "SELECT COUNT(prekey_id) FROM prekeys"
+
+# signed prekeys
+SELECT_SIGNED_PREKEY = "SELECT record FROM signed_prekeys WHERE prekey_id = ?"
+SELECT_SIGNED_PREKEYS = "SELECT record FROM signed_prekeys"
+INSERT_SIGNED_PREKEY = \
+    "INSERT INTO signed_prekeys (prekey_id, record) VALUES(?,?)"
+SIGNED_PREKEY_EXISTS = "SELECT 1 FROM signed_prekeys WHERE prekey_id = ?"
+DELETE_SIGNED_PREKEY = "DELETE FROM signed_prekeys WHERE prekey_id = ?"
+SELECT_MAX_SIGNED_PREKEY_ID = "SELECT MAX(prekey_id) FROM signed_prekeys"
+SELECT_SIGNED_PREKEY_TIMESTAMP = \
+    "SELECT strftime('%s', timestamp) FROM signed_prekeys WHERE prekey_id = ?"
+DELETE_OLD_SIGNED_PREKEYS = \
+    "DELETE FROM signed_prekeys WHERE timestamp < datetime(?, 'unixepoch')"
+
+# sessions
+SELECT_SESSION = \
+    "SELECT record FROM sessions WHERE recipient_id = ? AND device_id = ?"
+SELECT_SESSION_DEVICE_IDS = \
+    "SELECT device_id FROM sessions WHERE recipient_id = ?"
+SELECT_JID_OF_DEVICE = "SELECT recipient_id FROM sessions WHERE device_id = ?"
+SELECT_ACTIVE_DEVICES = \
+    "SELECT recipient_id, device_id FROM sessions WHERE active = 1"
+UPSERT_SESSION = \
+    "INSERT INTO sessions(recipient_id, device_id, record) VALUES(?,?,?) " \
+    "ON CONFLICT(recipient_id, device_id) DO UPDATE SET record = excluded.record"
+UPDATE_SESSION = \
+    "UPDATE sessions SET record = ? WHERE recipient_id = ? AND device_id = ?"
+INSERT_SESSION = \
+    "INSERT INTO sessions(recipient_id, device_id, record) VALUES(?,?,?)"
+SESSION_EXISTS = \
+    "SELECT 1 FROM sessions WHERE recipient_id = ? AND device_id = ?"
+DELETE_SESSION = \
+    "DELETE FROM sessions WHERE recipient_id = ? AND device_id = ?"
+DELETE_SESSIONS = "DELETE FROM sessions WHERE recipient_id = ?"
+SELECT_ALL_SESSIONS = \
+    "SELECT _id, recipient_id, device_id, record, active FROM sessions"
+SELECT_SESSIONS = SELECT_ALL_SESSIONS + " WHERE recipient_id = ?"
+SELECT_SESSIONS_OF_JIDS = \
+    _in(SELECT_ALL_SESSIONS + " WHERE recipient_id IN ({0})")
+DEACTIVATE_SESSIONS = "UPDATE sessions SET active = 0 WHERE recipient_id = ?"
+ACTIVATE_SESSIONS = _in("UPDATE sessions SET active = 1 "
+                        "WHERE recipient_id = ? AND device_id IN ({0})")
+SELECT_INACTIVE_SESSIONS = \
+    "SELECT record FROM sessions WHERE active = 0 AND recipient_id = ?"
+
+# encryption_state
+UPSERT_ENCRYPTION = \
+    "INSERT OR REPLACE INTO encryption_state (jid, encryption) VALUES (?, ?)"
+SELECT_ENCRYPTION = "SELECT encryption FROM encryption_state WHERE jid = ?"
+
+
+def chunks(values):
+    """ Split values into tuples of IN_CHUNK_SIZE.
+
+    Duplicates are dropped, the last chunk is padded by repeating its last
+    value, which changes neither the result of IN nor of NOT IN.
+    """
+    values = list(OrderedDict.fromkeys(values))
+    for start in range(0, len(values), IN_CHUNK_SIZE):
+        chunk = values[start:start + IN_CHUNK_SIZE]
+        chunk.extend(chunk[-1:] * (IN_CHUNK_SIZE - len(chunk)))
+        yield tuple(chunk)
+
+
+class Queries(object):
+    """ Runs the statements above for a store.
+
+    Each thread reuses one cursor per store instead of creating a new one
+    for every statement.
+    """
+
+    def __init__(self, dbConn):
+        self.dbConn = dbConn
+        self._local = threading.local()
+
+    def cursor(self):
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self._local.cursor = self.dbConn.cursor()
+        return cursor
+
+    def execute(self, sql, parameters=()):
+        cursor = self.cursor()
+        cursor.execute(sql, parameters)
+        return cursor
+
+    def executemany(self, sql, seq_of_parameters):
+        cursor = self.cursor()
+        cursor.executemany(sql, seq_of_parameters)
+        return cursor
+
+    def fetchone(self, sql, parameters=()):
+        return self.execute(sql, parameters).fetchone()
+
+    def fetchall(self, sql, parameters=()):
+        return self.execute(sql, parameters).fetchall()
+
+    def execute_in(self, sql, values, parameters=()):
+        """ Run sql once per chunk of values and return all fetched rows.
+
+        The chunk is bound after the given parameters.
+        """
+        rows = []
+        for chunk in chunks(values):
+            rows.extend(self.execute(sql, tuple(parameters) + chunk))
+        return rows
@@ -0,0 +1,80 @@
+''' Background replenishment of the own prekey pool '''
+
+import logging
+import time
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+# Check the signed prekey age at least once per hour, even if no prekey
+# has been consumed in the meantime
+CHECK_INTERVAL = 3600
+
+
+class PreKeyReplenisher(object):
+    """ Tops up the prekeys and rotates the signed prekey of an OmemoState.
+
+    The key generation is kept out of :py:attr:`OmemoState.bundle`, which
+    only reads the stored keys. :py:meth:`run` is meant to be called from a
+    timer, :py:meth:`schedule` marks the pool as used in between.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.pending = True
+        self.stale = False
+        self.replenish_count = 0
+        self.generation_time = 0.0
+        self.last_run = None
+
+    @property
+    def pool_depth(self):
+        """ Number of prekeys currently available for the bundle. """
+        return self.state.store.preKeyStore.getPreKeyCount()
+
+    def schedule(self):
+        """ A prekey has been consumed, the published bundle is outdated. """
+        self.pending = True
+        self.stale = True
+
+    def due(self):
+        if self.pending or self.last_run is None:
+            return True
+        return self.last_run < time.time() - CHECK_INTERVAL
+
+    def run(self, force=False):
+        """ Replenish the pool if it is due.
+
+        Returns `True` if the bundle changed since it was last published,
+        so the caller knows it has to be published again.
+        """
+        if not (force or self.due()):
+            return False
+
+        state = self.state
+        start = time.time()
+        prekeys = self.pool_depth
+        signed_prekey_id = state.store.getCurrentSignedPreKeyId()
+
+        with state.store.transaction():
+            state.checkPreKeyAmount()
+            state.cycleSignedPreKey(state.store.getIdentityKeyPair())
+
+        self.last_run = time.time()
+        generated = (self.pool_depth != prekeys or
+                     state.store.getCurrentSignedPreKeyId() != signed_prekey_id)
+        if generated:
+            self.replenish_count += 1
+            self.generation_time += self.last_run - start
+            log.debug('%s => Replenished PreKeys in %.1f ms', state.account,
+                      (self.last_run - start) * 1000)
+
+        changed = generated or self.stale
+        self.pending = False
+        self.stale = False
+        return changed
+
+    def get_metrics(self):
+        return {'pool_depth': self.pool_depth,
+                'generation_time': self.generation_time,
+                'replenish_count': self.replenish_count,
+                'pending': self.pending}
@@ -0,0 +1,99 @@
+''' Groupchat membership and device fan-out per room '''
+
+import logging
+
+log = logging.getLogger('gajim.plugin_system.omemo')
+
+
+class RoomIndex(object):
+    """ Maps rooms to the real jids of their members and to their devices.
+
+    The membership is kept in the `groupchat` dict of the plugin
+    (room => nick => real jid). Next to it the index counts the nicks per
+    real jid and keeps the sorted (jid, device_id) tuples of every room,
+    which are only rebuilt after a membership or devicelist change.
+    """
+
+    def __init__(self, state, groupchat=None):
+        self.state = state
+        # room => nick => real jid
+        self.groupchat = groupchat if groupchat is not None else {}
+        # room => real jid => number of nicks
+        self._members = {}
+        # real jid => rooms
+        self._rooms_of = {}
+        # room => sorted [(jid, device_id)]
+        self._devices = {}
+
+        for room, nicks in self.groupchat.items():
+            members = self._members.setdefault(room, {})
+            for jid in nicks.values():
+                members[jid] = members.get(jid, 0) + 1
+                self._rooms_of.setdefault(jid, set()).add(room)
+
+    def add_member(self, room, nick, jid):
+        """ A nick with the given real jid joined or is present in room. """
+        nicks = self.groupchat.setdefault(room, {})
+        if nicks.get(nick) == jid:
+            return
+        if nick in nicks:
+            self._remove_nick(room, nick)
+
+        nicks[nick] = jid
+        members = self._members.setdefault(room, {})
+        members[jid] = members.get(jid, 0) + 1
+        if members[jid] == 1:
+            self._rooms_of.setdefault(jid, set()).add(room)
+            self._devices.pop(room, None)
+
+    def remove_member(self, room, nick):
+        """ A nick left room. """
+        if nick in self.groupchat.get(room, {}):
+            self._remove_nick(room, nick)
+
+    def rename_member(self, room, old_nick, new_nick):
+        """ A member changed the nick, the real jid stays the same. """
+        nicks = self.groupchat.get(room, {})
+        if old_nick in nicks:
+            nicks[new_nick] = nicks.pop(old_nick)
+
+    def remove_room(self, room):
+        """ We left room. """
+        for jid in self._members.pop(room, {}):
+            self._rooms_of[jid].discard(room)
+        self.groupchat.pop(room, None)
+        self._devices.pop(room, None)
+
+    def _remove_nick(self, room, nick):
+        jid = self.groupchat[room].pop(nick)
+        members = self._members[room]
+        members[jid] -= 1
+        if members[jid] == 0:
+            del members[jid]
+            self._rooms_of[jid].discard(room)
+            self._devices.pop(room, None)
+
+    def devices_changed(self, jid):
+        """ The devicelist of jid changed, rebuild its rooms on next use. """
+        for room in self._rooms_of.get(jid, ()):
+            self._devices.pop(room, None)
+
+    def jids(self, room):
+        """ Return the real jids of all other members of room. """
+        own_jid = self.state.own_jid
+        return [jid for jid in self._members.get(room, {}) if jid != own_jid]
+
+    def devices(self, room):
+        """ Return the sorted (jid, device_id) tuples of the other members. """
+        try:
+            return self._devices[room]
+        except KeyError:
+            pass
+
+        device_ids = self.state.device_ids
+        devices = sorted((jid, device)
+                         for jid in self.jids(room)
+                         for device in device_ids.get(jid, ()))
+        self._devices[room] = devices
+        log.debug('Indexed %d devices for %s', len(devices), room)
+        return devices
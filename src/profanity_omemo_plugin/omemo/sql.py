@@ -18,26 +18,76 @@
 #
 from .db_helpers import user_version
 
+JOURNAL_MODES = ('memory', 'delete', 'wal')
+# SQLite checkpoints the WAL by itself once it holds this many pages
+DEFAULT_WAL_AUTOCHECKPOINT = 1000
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('ascii')
+    return value
+
 
 class SQLDatabase():
     """ SQL Database """
 
-    def __init__(self, dbConn):
+    def __init__(self, dbConn, journalMode=None, walAutocheckpoint=None):
         """
         :type dbConn: Connection
+        :param journalMode: one of JOURNAL_MODES, None keeps WAL if the
+                            db is already in WAL mode and uses MEMORY
+                            otherwise
+        :param walAutocheckpoint: pages after which SQLite checkpoints the
+                                  WAL itself, only used in WAL mode
         """
         self.dbConn = dbConn
         self.createDb()
         self.migrateDb()
         c = self.dbConn.cursor()
         c.execute("PRAGMA synchronous=NORMAL;")
-        c.execute("PRAGMA journal_mode;")
-        mode = c.fetchone()[0]
-        # WAL is a persistent DB mode, dont override it if user has set it
-        if mode != 'wal':
-            c.execute("PRAGMA journal_mode=MEMORY;")
+        if journalMode is None:
+            # WAL is a persistent DB mode, dont override it if user has set it
+            journalMode = 'wal' if self.getJournalMode() == 'wal' else 'memory'
+        self.setJournalMode(journalMode, walAutocheckpoint)
         self.dbConn.commit()
 
+    def getJournalMode(self):
+        mode = self.dbConn.execute("PRAGMA journal_mode;").fetchone()[0]
+        return _text(mode).lower()
+
+    def setJournalMode(self, journalMode, walAutocheckpoint=None):
+        """ Switch the journal mode, returns the mode which is in effect.
+
+            SQLite keeps the previous mode if it can not switch, e.g.
+            WAL on a database in memory.
+        """
+        journalMode = journalMode.lower()
+        if journalMode not in JOURNAL_MODES:
+            raise ValueError('Unsupported journal mode: ' + journalMode)
+
+        c = self.dbConn.cursor()
+        c.execute("PRAGMA journal_mode={0};".format(journalMode))
+        mode = _text(c.fetchone()[0]).lower()
+        if mode == 'wal':
+            c.execute("PRAGMA wal_autocheckpoint={0:d};".format(
+                DEFAULT_WAL_AUTOCHECKPOINT if walAutocheckpoint is None
+                else walAutocheckpoint))
+        return mode
+
+    def checkpoint(self):
+        """ Run a passive WAL checkpoint.
+
+            A passive checkpoint never waits for readers or writers, it
+            copies what it can into the db. Returns the tuple
+            (busy, wal pages, checkpointed pages) or None if the db is not
+            in WAL mode.
+        """
+        if self.getJournalMode() != 'wal':
+            return None
+        return tuple(self.dbConn.execute(
+            "PRAGMA wal_checkpoint(PASSIVE);").fetchone())
+
     def createDb(self):
         if user_version(self.dbConn) == 0:
 
@@ -79,12 +129,21 @@ class SQLDatabase():
                     jid TEXT UNIQUE,
                     encryption INTEGER
                     );
+
+                CREATE INDEX IF NOT EXISTS
+                    identities_trust_index ON identities (recipient_id, trust);
+
+                CREATE INDEX IF NOT EXISTS
+                    sessions_device_index ON sessions (device_id);
+
+                CREATE INDEX IF NOT EXISTS sessions_active_index
+                    ON sessions (active, recipient_id, device_id);
                 '''
 
             create_db_sql = """
                 BEGIN TRANSACTION;
                 %s
-                PRAGMA user_version=5;
+                PRAGMA user_version=6;
                 END TRANSACTION;
                 """ % (create_tables)
             self.dbConn.executescript(create_db_sql)
@@ -152,3 +211,21 @@ class SQLDatabase():
                                           PRAGMA user_version=5;
                                           END TRANSACTION;
                                       """ % (add_timestamp))
+
+        if user_version(self.dbConn) < 6:
+            # Adds indexes for the trust, device and active state lookups,
+            # public_key lookups already use public_key_index
+            add_indexes = """
+                CREATE INDEX IF NOT EXISTS
+                    identities_trust_index ON identities (recipient_id, trust);
+                CREATE INDEX IF NOT EXISTS
+                    sessions_device_index ON sessions (device_id);
+                CREATE INDEX IF NOT EXISTS sessions_active_index
+                    ON sessions (active, recipient_id, device_id);
+            """
+
+            self.dbConn.executescript(""" BEGIN TRANSACTION;
+                                          %s
+                                          PRAGMA user_version=6;
+                                          END TRANSACTION;
+                                      """ % (add_indexes))
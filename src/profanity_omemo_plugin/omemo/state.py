@@ -18,8 +18,15 @@
 #
 
 import logging
+import threading
 import time
 from base64 import b64encode
+from functools import wraps
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # Python 2 without the futures backport
+    ThreadPoolExecutor = None
 
 from Crypto.Random import get_random_bytes
 from axolotl.duplicatemessagexception import DuplicateMessageException
@@ -40,6 +47,10 @@ from .aes_gcm import NoValidSessions, decrypt, encrypt
 from .liteaxolotlstore import (LiteAxolotlStore, DEFAULT_PREKEY_AMOUNT,
                                MIN_PREKEY_AMOUNT, SPK_CYCLE_TIME,
                                SPK_ARCHIVE_TIME)
+from .cipher_pool import (CipherPool, DEFAULT_CIPHER_POOL_SIZE,
+                          DEFAULT_CIPHER_TTL)
+from .replenisher import PreKeyReplenisher
+from .room_index import RoomIndex
 
 log = logging.getLogger('gajim.plugin_system.omemo')
 logAxolotl = logging.getLogger('axolotl')
@@ -50,34 +61,106 @@ TRUSTED = 1
 UNDECIDED = 2
 
 
+def _b64encode(data):
+    return b64encode(data).decode('ascii')
+
+
+def in_transaction(func):
+    """ Run an OmemoState method in a single store transaction. """
+    @wraps(func)
+    def func_wrapper(self, *args, **kwargs):
+        with self.store.transaction():
+            return func(self, *args, **kwargs)
+
+    return func_wrapper
+
+
+class LockedStore(object):
+    """ Serializes all calls to a store through one lock.
+
+        Used by the key wrapping workers, so the sqlite connection and the
+        store caches are only ever used by one thread at a time.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
 class OmemoState:
-    def __init__(self, own_jid, connection, account, plugin):
+    def __init__(self, own_jid, connection, account, plugin,
+                 key_wrap_workers=0,
+                 cipher_pool_size=DEFAULT_CIPHER_POOL_SIZE,
+                 cipher_ttl=DEFAULT_CIPHER_TTL,
+                 journal_mode=None, wal_autocheckpoint=None):
         """ Instantiates an OmemoState object.
 
             :param connection: an :py:class:`sqlite3.Connection`
+            :param key_wrap_workers: wrap the message key for this many
+                devices concurrently, 0 wraps them one after another
+            :param cipher_pool_size: amount of SessionCiphers kept around
+            :param cipher_ttl: seconds an unused SessionCipher is kept,
+                0 keeps it until the pool is full
+            :param journal_mode: sqlite journal mode, see
+                :py:class:`SQLDatabase`
+            :param wal_autocheckpoint: WAL pages between automatic
+                checkpoints
         """
         self.account = account
         self.plugin = plugin
-        self.session_ciphers = {}
+        self.session_ciphers = CipherPool(self._create_session_cipher,
+                                          cipher_pool_size, cipher_ttl)
         self.own_jid = own_jid
         self.device_ids = {}
         self.own_devices = []
-        self.store = LiteAxolotlStore(connection)
+        self.store = LiteAxolotlStore(connection,
+                                      journal_mode=journal_mode,
+                                      wal_autocheckpoint=wal_autocheckpoint)
         self.encryption = self.store.encryptionStore
+        self.replenisher = PreKeyReplenisher(self)
+        groupchat = getattr(plugin, 'groupchat', None)
+        self.room_index = RoomIndex(
+            self, groupchat if isinstance(groupchat, dict) else None)
+        self._signed_bundle = None
+        self._key_wrap_executor = None
+        if key_wrap_workers and ThreadPoolExecutor is None:
+            log.warning('concurrent.futures is not available, '
+                        'wrapping message keys serially')
+        elif key_wrap_workers:
+            self._key_wrap_executor = ThreadPoolExecutor(key_wrap_workers)
+            self._locked_store = LockedStore(self.store)
         for jid, device_id in self.store.getActiveDeviceTuples():
             if jid != own_jid:
                 self.add_device(jid, device_id)
             else:
                 self.add_own_device(device_id)
 
-        log.info(self.account + ' => Roster devices after boot:' +
-                 str(self.device_ids))
-        log.info(self.account + ' => Own devices after boot:' +
-                 str(self.own_devices))
-        log.debug(self.account + ' => ' +
-                  str(self.store.preKeyStore.getPreKeyCount()) +
-                  ' PreKeys available')
-
+        log.info('%s => Roster devices after boot: %s', self.account,
+                 self.device_ids)
+        log.info('%s => Own devices after boot: %s', self.account,
+                 self.own_devices)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s => %d PreKeys available', self.account,
+                      self.store.preKeyStore.getPreKeyCount())
+
+    def close(self):
+        """ Stop the key wrapping workers, the connection stays open. """
+        if self._key_wrap_executor is not None:
+            self._key_wrap_executor.shutdown()
+            self._key_wrap_executor = None
+
+    @in_transaction
     def build_session(self, recipient_id, device_id, bundle_dict):
         sessionBuilder = SessionBuilder(self.store, self.store, self.store,
                                         self.store, recipient_id, device_id)
@@ -112,13 +195,18 @@ class OmemoState:
         """
 
         self.device_ids[name] = devices
-        log.info(self.account + ' => Saved devices for ' + name)
+        self.room_index.devices_changed(name)
+        self.session_ciphers.retain(name, devices)
+        log.info('%s => Saved devices for %s', self.account, name)
 
     def add_device(self, name, device_id):
         if name not in self.device_ids:
             self.device_ids[name] = [device_id]
         elif device_id not in self.device_ids[name]:
             self.device_ids[name].append(device_id)
+        else:
+            return
+        self.room_index.devices_changed(name)
 
     def set_own_devices(self, devices):
         """ Overwrite the current :py:attribute:`OmemoState.own_devices` with
@@ -130,7 +218,8 @@ class OmemoState:
                 A list of device_ids
         """
         self.own_devices = devices
-        log.info(self.account + ' => Saved own devices')
+        self.session_ciphers.retain(self.own_jid, devices)
+        log.info('%s => Saved own devices', self.account)
 
     def add_own_device(self, device_id):
         if device_id not in self.own_devices:
@@ -151,31 +240,40 @@ class OmemoState:
         return self.own_device_id in self.own_devices
 
     @property
-    def bundle(self):
-        self.checkPreKeyAmount()
-        prekeys = [
-            (k.getId(), b64encode(k.getKeyPair().getPublicKey().serialize()))
-            for k in self.store.loadPreKeys()
-        ]
-
-        identityKeyPair = self.store.getIdentityKeyPair()
-
-        self.cycleSignedPreKey(identityKeyPair)
-
-        signedPreKey = self.store.loadSignedPreKey(
-            self.store.getCurrentSignedPreKeyId())
+    def bundle_version(self):
+        """ Changes whenever the content of :py:attr:`bundle` changes. """
+        return (self.store.preKeyStore.version,
+                self.store.signedPreKeyStore.version)
 
-        result = {
-            'signedPreKeyId': signedPreKey.getId(),
-            'signedPreKeyPublic':
-            b64encode(signedPreKey.getKeyPair().getPublicKey().serialize()),
-            'signedPreKeySignature': b64encode(signedPreKey.getSignature()),
-            'identityKey':
-            b64encode(identityKeyPair.getPublicKey().serialize()),
-            'prekeys': prekeys
-        }
+    @property
+    def bundle(self):
+        # Key generation is left to the replenisher, unless there is
+        # nothing at all to publish yet.
+        if (self.replenisher.pool_depth == 0 or
+                not self.store.getCurrentSignedPreKeyId()):
+            self.replenisher.run(force=True)
+
+        version = self.store.signedPreKeyStore.version
+        if self._signed_bundle is None or self._signed_bundle[0] != version:
+            identityKeyPair = self.store.getIdentityKeyPair()
+            signedPreKey = self.store.loadSignedPreKey(
+                self.store.getCurrentSignedPreKeyId())
+
+            self._signed_bundle = (version, {
+                'signedPreKeyId': signedPreKey.getId(),
+                'signedPreKeyPublic': _b64encode(
+                    signedPreKey.getKeyPair().getPublicKey().serialize()),
+                'signedPreKeySignature': _b64encode(
+                    signedPreKey.getSignature()),
+                'identityKey': _b64encode(
+                    identityKeyPair.getPublicKey().serialize())
+            })
+
+        result = dict(self._signed_bundle[1])
+        result['prekeys'] = self.store.preKeyStore.getPublicPreKeys()
         return result
 
+    @in_transaction
     def decrypt_msg(self, msg_dict):
         own_id = self.own_device_id
         if msg_dict['sid'] == own_id:
@@ -199,16 +297,15 @@ class OmemoState:
             try:
                 key = self.handleWhisperMessage(sender_jid, sid, encrypted_key)
             except (NoSessionException, InvalidMessageException) as e:
-                log.warning('No Session found ' + e.message)
-                log.warning('sender_jid =>  ' + str(sender_jid) + ' sid =>' +
-                            str(sid))
+                log.warning('No Session found %s', e)
+                log.warning('sender_jid => %s sid => %s', sender_jid, sid)
                 return
             except (DuplicateMessageException) as e:
-                log.warning('Duplicate message found ' + str(e.args))
+                log.warning('Duplicate message found %s', e.args)
                 return
 
         except (DuplicateMessageException) as e:
-            log.warning('Duplicate message found ' + str(e.args))
+            log.warning('Duplicate message found %s', e.args)
             return
 
         result = decrypt(key, iv, payload)
@@ -217,13 +314,13 @@ class OmemoState:
         except NameError:  # Py3
             pass
 
-        log.debug("Decrypted Message => " + result)
+        log.debug('Decrypted message from %s', sender_jid)
         return result
 
+    @in_transaction
     def create_msg(self, from_jid, jid, plaintext):
         key = get_random_bytes(16)
         iv = get_random_bytes(16)
-        encrypted_keys = {}
 
         devices_list = self.device_list_for(jid)
         if len(devices_list) == 0:
@@ -235,18 +332,8 @@ class OmemoState:
         key += tag
 
         # Encrypt the message key with for each of receivers devices
-        for device in devices_list:
-            try:
-                if self.isTrusted(jid, device) == TRUSTED:
-                    cipher = self.get_session_cipher(jid, device)
-                    cipher_key = cipher.encrypt(key)
-                    prekey = isinstance(cipher_key, PreKeyWhisperMessage)
-                    encrypted_keys[device] = (cipher_key.serialize(), prekey)
-                else:
-                    log.debug('Skipped Device because Trust is: ' +
-                              str(self.isTrusted(jid, device)))
-            except:
-                log.warning('Failed to find key for device ' + str(device))
+        encrypted_keys = self.wrap_key(key, [(jid, device)
+                                             for device in devices_list])
 
         if len(encrypted_keys) == 0:
             log.error('Encrypted keys empty')
@@ -254,18 +341,9 @@ class OmemoState:
 
         my_other_devices = set(self.own_devices) - set({self.own_device_id})
         # Encrypt the message key with for each of our own devices
-        for device in my_other_devices:
-            try:
-                if self.isTrusted(from_jid, device) == TRUSTED:
-                    cipher = self.get_session_cipher(from_jid, device)
-                    cipher_key = cipher.encrypt(key)
-                    prekey = isinstance(cipher_key, PreKeyWhisperMessage)
-                    encrypted_keys[device] = (cipher_key.serialize(), prekey)
-                else:
-                    log.debug('Skipped own Device because Trust is: ' +
-                              str(self.isTrusted(from_jid, device)))
-            except:
-                log.warning('Failed to find key for device ' + str(device))
+        encrypted_keys.update(self.wrap_key(
+            key, [(from_jid, device) for device in my_other_devices],
+            own=True))
 
         result = {'sid': self.own_device_id,
                   'keys': encrypted_keys,
@@ -276,12 +354,79 @@ class OmemoState:
         log.debug('Finished encrypting message')
         return result
 
+    def wrap_key(self, key, devices, own=False):
+        """ Encrypt the message key for each trusted (jid, device_id).
+
+            Returns a dict of device_id => (encrypted key, is_prekey) in
+            the order of the sorted devices, no matter if the key was
+            wrapped serially or by the executor.
+        """
+        trusted = []
+        for jid, device in sorted(devices):
+            try:
+                trust = self.isTrusted(jid, device)
+            except:
+                log.warning('Failed to find key for device %s', device)
+                continue
+            if trust == TRUSTED:
+                trusted.append((jid, device))
+            elif own:
+                log.debug('Skipped own Device because Trust is: %s', trust)
+            else:
+                log.debug('Skipped Device because Trust is: %s', trust)
+
+        if self._key_wrap_executor is not None and len(trusted) > 1:
+            depth = self.store.scope.depth
+            results = self._key_wrap_executor.map(
+                lambda target: self._wrap_key_locked(key, depth, *target),
+                trusted)
+        else:
+            results = (self._wrap_key(key, jid, device)
+                       for jid, device in trusted)
+
+        encrypted_keys = {}
+        for (jid, device), result in zip(trusted, results):
+            if result is not None:
+                encrypted_keys[device] = result
+            else:
+                # wrapping failed, the pool is only touched on this thread
+                self.session_ciphers.discard(jid, device)
+        return encrypted_keys
+
+    def _wrap_key(self, key, jid, device):
+        try:
+            cipher = self.get_session_cipher(jid, device)
+            return self._encrypt_key(cipher, key)
+        except:
+            log.warning('Failed to find key for device %s', device)
+            # SessionCipher.encrypt may have advanced the cached
+            # SessionRecord already, the next use has to load the stored one
+            self.store.invalidateSession(jid, device)
+
+    def _wrap_key_locked(self, key, depth, jid, device):
+        # Workers use their own cipher on top of the locked store, only
+        # the ratchet work outside of the store runs concurrently. They
+        # write inside the transaction of the thread which called wrap_key.
+        store = self._locked_store
+        with self.store.scope.joined(depth):
+            try:
+                cipher = SessionCipher(store, store, store, store, jid,
+                                       device)
+                return self._encrypt_key(cipher, key)
+            except:
+                log.warning('Failed to find key for device %s', device)
+                store.invalidateSession(jid, device)
+
+    @staticmethod
+    def _encrypt_key(cipher, key):
+        cipher_key = cipher.encrypt(key)
+        prekey = isinstance(cipher_key, PreKeyWhisperMessage)
+        return (cipher_key.serialize(), prekey)
+
+    @in_transaction
     def create_gc_msg(self, from_jid, jid, plaintext):
         key = get_random_bytes(16)
         iv = get_random_bytes(16)
-        encrypted_keys = {}
-        room = jid
-        encrypted_jids = []
 
         devices_list = self.device_list_for(jid, True)
 
@@ -293,30 +438,9 @@ class OmemoState:
 
         key += tag
 
-        for tup in devices_list:
-            self.get_session_cipher(tup[0], tup[1])
-
         # Encrypt the message key with for each of receivers devices
-        for nick in self.plugin.groupchat[room]:
-            jid_to = self.plugin.groupchat[room][nick]
-            if jid_to == self.own_jid:
-                continue
-            if jid_to in encrypted_jids:  # We already encrypted to this JID
-                continue
-            for rid, cipher in self.session_ciphers[jid_to].items():
-                try:
-                    if self.isTrusted(jid_to, rid) == TRUSTED:
-                        cipher_key = cipher.encrypt(key)
-                        prekey = isinstance(cipher_key, PreKeyWhisperMessage)
-                        encrypted_keys[rid] = (cipher_key.serialize(), prekey)
-                    else:
-                        log.debug('Skipped Device because Trust is: ' +
-                                  str(self.isTrusted(jid_to, rid)))
-                except:
-                    log.exception('ERROR:')
-                    log.warning('Failed to find key for device ' +
-                                str(rid))
-            encrypted_jids.append(jid_to)
+        encrypted_keys = self.wrap_key(key, devices_list)
+
         if len(encrypted_keys) == 0:
             log_msg = 'Encrypted keys empty'
             log.error(log_msg)
@@ -324,19 +448,8 @@ class OmemoState:
 
         my_other_devices = set(self.own_devices) - set({self.own_device_id})
         # Encrypt the message key with for each of our own devices
-        for dev in my_other_devices:
-            try:
-                cipher = self.get_session_cipher(from_jid, dev)
-                if self.isTrusted(from_jid, dev) == TRUSTED:
-                    cipher_key = cipher.encrypt(key)
-                    prekey = isinstance(cipher_key, PreKeyWhisperMessage)
-                    encrypted_keys[dev] = (cipher_key.serialize(), prekey)
-                else:
-                    log.debug('Skipped own Device because Trust is: ' +
-                              str(self.isTrusted(from_jid, dev)))
-            except:
-                log.exception('ERROR:')
-                log.warning('Failed to find key for device ' + str(dev))
+        encrypted_keys.update(self.wrap_key(
+            key, [(from_jid, dev) for dev in my_other_devices], own=True))
 
         result = {'sid': self.own_device_id,
                   'keys': encrypted_keys,
@@ -357,15 +470,7 @@ class OmemoState:
                 Groupchat Message
         """
         if gc:
-            room = jid
-            devicelist = []
-            for nick in self.plugin.groupchat[room]:
-                jid_to = self.plugin.groupchat[room][nick]
-                if jid_to == self.own_jid:
-                    continue
-                for device in self.device_ids[jid_to]:
-                    devicelist.append((jid_to, device))
-            return devicelist
+            return self.room_index.devices(jid)
 
         if jid == self.own_jid:
             return set(self.own_devices) - set({self.own_device_id})
@@ -374,9 +479,7 @@ class OmemoState:
         return set(self.device_ids[jid])
 
     def isTrusted(self, recipient_id, device_id):
-        record = self.store.loadSession(recipient_id, device_id)
-        identity_key = record.getSessionState().getRemoteIdentityKey()
-        return self.store.isTrustedIdentity(recipient_id, identity_key)
+        return self.store.getDeviceTrust(recipient_id, device_id)
 
     def getFingerprints(self, recipient_id):
         return self.store.getFingerprints(recipient_id)
@@ -409,24 +512,24 @@ class OmemoState:
                 A list of device_ids
         """
         known_devices = self.device_list_for(jid)
+        if not known_devices:
+            return []
+
+        sessions = self.store.getSessionDeviceIds(jid)
         missing_devices = [dev
                            for dev in known_devices
-                           if not self.store.containsSession(jid, dev)]
+                           if dev not in sessions]
         if missing_devices:
-            log.info(self.account + ' => Missing device sessions for ' +
-                     jid + ': ' + str(missing_devices))
+            log.info('%s => Missing device sessions for %s: %s',
+                     self.account, jid, missing_devices)
         return missing_devices
 
     def get_session_cipher(self, jid, device_id):
-        if jid not in self.session_ciphers:
-            self.session_ciphers[jid] = {}
-
-        if device_id not in self.session_ciphers[jid]:
-            cipher = SessionCipher(self.store, self.store, self.store,
-                                   self.store, jid, device_id)
-            self.session_ciphers[jid][device_id] = cipher
+        return self.session_ciphers.get(jid, device_id)
 
-        return self.session_ciphers[jid][device_id]
+    def _create_session_cipher(self, jid, device_id):
+        return SessionCipher(self.store, self.store, self.store,
+                             self.store, jid, device_id)
 
     def handlePreKeyWhisperMessage(self, recipient_id, device_id, key):
         preKeyWhisperMessage = PreKeyWhisperMessage(serialized=key)
@@ -435,22 +538,26 @@ class OmemoState:
                             recipient_id)
         sessionCipher = self.get_session_cipher(recipient_id, device_id)
         try:
-            log.debug(self.account +
-                      " => Received PreKeyWhisperMessage from " +
-                      recipient_id)
+            log.debug('%s => Received PreKeyWhisperMessage from %s',
+                      self.account, recipient_id)
             key = sessionCipher.decryptPkmsg(preKeyWhisperMessage)
-            # Publish new bundle after PreKey has been used
-            # for building a new Session
-            self.plugin.publish_bundle(self.account)
+            # A PreKey has been used for building a new Session, the
+            # replenisher tops up the pool and publishes the new bundle
+            self.replenisher.schedule()
             self.add_device(recipient_id, device_id)
             return key
         except UntrustedIdentityException as e:
-            log.info(self.account + " => Received WhisperMessage " +
-                     "from Untrusted Fingerprint! => " + e.getName())
+            log.info('%s => Received WhisperMessage from Untrusted '
+                     'Fingerprint! => %s', self.account, e.getName())
+        except Exception:
+            # The cached SessionRecord gets altered before the message is
+            # decrypted, the next load has to read the stored one again.
+            self.store.invalidateSession(recipient_id, device_id)
+            raise
 
     def handleWhisperMessage(self, recipient_id, device_id, key):
         whisperMessage = WhisperMessage(serialized=key)
-        log.debug(self.account + " => Received WhisperMessage from " +
+        log.debug('%s => Received WhisperMessage from %s', self.account,
                   recipient_id)
         if self.isTrusted(recipient_id, device_id):
             sessionCipher = self.get_session_cipher(recipient_id, device_id)
@@ -461,15 +568,16 @@ class OmemoState:
             raise Exception("Received WhisperMessage "
                             "from Untrusted Fingerprint! => " + recipient_id)
 
+    @in_transaction
     def checkPreKeyAmount(self):
         # Check if enough PreKeys are available
         preKeyCount = self.store.preKeyStore.getPreKeyCount()
         if preKeyCount < MIN_PREKEY_AMOUNT:
             newKeys = DEFAULT_PREKEY_AMOUNT - preKeyCount
             self.store.preKeyStore.generateNewPreKeys(newKeys)
-            log.info(self.account + ' => ' + str(newKeys) +
-                     ' PreKeys created')
+            log.info('%s => %d PreKeys created', self.account, newKeys)
 
+    @in_transaction
     def cycleSignedPreKey(self, identityKeyPair):
         # Publish every SPK_CYCLE_TIME a new SignedPreKey
         # Delete all exsiting SignedPreKeys that are older
@@ -480,8 +588,8 @@ class OmemoState:
             signedPreKey = KeyHelper.generateSignedPreKey(
                 identityKeyPair, self.store.getNextSignedPreKeyId())
             self.store.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
-            log.debug(self.account +
-                      ' => New SignedPreKey created, because none existed')
+            log.debug('%s => New SignedPreKey created, because none existed',
+                      self.account)
 
         # if SPK_CYCLE_TIME is reached, generate a new SignedPreKey
         now = int(time.time())
@@ -492,7 +600,7 @@ class OmemoState:
             signedPreKey = KeyHelper.generateSignedPreKey(
                 identityKeyPair, self.store.getNextSignedPreKeyId())
             self.store.storeSignedPreKey(signedPreKey.getId(), signedPreKey)
-            log.debug(self.account + ' => Cycled SignedPreKey')
+            log.debug('%s => Cycled SignedPreKey', self.account)
 
         # Delete all SignedPreKeys that are older than SPK_ARCHIVE_TIME
         timestamp = now - SPK_ARCHIVE_TIME
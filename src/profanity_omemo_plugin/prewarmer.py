@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+
+import time
+
+DEFAULT_DEVICELIST_TTL = 600  # seconds a received devicelist counts as fresh
+
+
+class SessionPrewarmer(object):
+    """ Prepares the sessions with a contact before the first message.
+
+    Prewarming refreshes a stale devicelist and requests the bundles of
+    all devices without a session. The sessions are built by the bundle
+    handler as the responses arrive, so the first message finds them
+    ready instead of waiting for the round trips.
+
+    It also measures the latency of the first message to each contact,
+    from pressing enter to handing it over for encryption, split by
+    whether the contact was prewarmed.
+    """
+
+    def __init__(self, query_device_list, query_bundle,
+                 devicelist_ttl=DEFAULT_DEVICELIST_TTL):
+        self.query_device_list = query_device_list
+        self.query_bundle = query_bundle
+        self.devicelist_ttl = devicelist_ttl
+        self.runs = 0
+        # jid => time its devicelist was last received
+        self._refreshed = {}
+        # jids prewarmed before their first message
+        self._prewarmed = set()
+        # jids whose first message was measured
+        self._measured = set()
+        # prewarmed => [first messages, total latency]
+        self._latency = {True: [0, 0.0], False: [0, 0.0]}
+
+    def is_stale(self, jid):
+        return self._refreshed.get(jid, 0) < time.time() - self.devicelist_ttl
+
+    def prewarm(self, state, jid):
+        """ Request what is missing for sessions with jid and ourselves. """
+        self.runs += 1
+        if jid not in self._measured:
+            self._prewarmed.add(jid)
+
+        if self.is_stale(jid):
+            self.query_device_list(jid)
+
+        # the known devices do not have to wait for the devicelist
+        self.fetch_bundles(state, jid)
+        self.fetch_bundles(state, state.own_jid)
+
+    def fetch_bundles(self, state, jid):
+        for device_id in state.devices_without_sessions(jid):
+            self.query_bundle(jid, device_id)
+
+    def devicelist_received(self, jid):
+        self._refreshed[jid] = time.time()
+
+    def is_first_message(self, jid):
+        return jid not in self._measured
+
+    def first_message_sent(self, jid, latency):
+        if jid in self._measured:
+            return
+
+        prewarmed = jid in self._prewarmed
+        self._measured.add(jid)
+        self._prewarmed.discard(jid)
+        entry = self._latency[prewarmed]
+        entry[0] += 1
+        entry[1] += latency
+
+    def reset(self):
+        """ Forget the state of the connection, keep the metrics. """
+        self._refreshed.clear()
+        self._prewarmed.clear()
+        self._measured.clear()
+
+    def get_metrics(self):
+        metrics = {'runs': self.runs}
+        for prewarmed, name in ((True, 'prewarmed'), (False, 'cold')):
+            count, total = self._latency[prewarmed]
+            metrics[name + '_messages'] = count
+            metrics[name + '_latency'] = total / count if count else 0.0
+        return metrics
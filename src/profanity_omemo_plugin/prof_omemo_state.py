@@ -29,7 +29,9 @@ logger = get_plugin_logger(__name__)
 
 from profanity_omemo_plugin.omemo.state import OmemoState
 
-# Monkeypatching trusted state until it has been implemented correctly
+# Monkeypatching trusted state until it has been implemented correctly.
+# This also bypasses the trust lookups of LiteAxolotlStore.getDeviceTrust
+# and its cache, which only the omemo library code uses for now.
 def _isTrusted(self, recipient_id, device_id):
     return True
 
@@ -37,6 +39,10 @@ OmemoState.isTrusted = _isTrusted
 
 
 class DummyPLugin(object):
+    def __init__(self):
+        # room => nick => real jid, maintained by OmemoState.room_index
+        self.groupchat = {}
+
     def publish_bundle(self, account):
         pass
 
@@ -45,6 +51,10 @@ class ProfOmemoState(object):
     """ ProfOmemoState Singleton """
 
     __states = {}
+    __connections = {}
+
+    # open the dbs behind a ConnectionManager, see get_connection
+    connection_manager = False
 
     def __new__(cls, *args, **kwargs):
         account = ProfOmemoUser().account
@@ -58,12 +68,23 @@ class ProfOmemoState(object):
 
         if own_jid not in cls.__states:
             # create the OmemoState for the current user
-            connection = get_connection(own_jid)
+            connection = get_connection(own_jid, cls.connection_manager)
             new_state = OmemoState(own_jid, connection, account, DummyPLugin())
             cls.__states[own_jid] = new_state
+            cls.__connections[own_jid] = connection
 
         return cls.__states[own_jid]
 
+    @classmethod
+    def reset(cls):
+        """ Drop all states and close their db connections. """
+        for state in cls.__states.values():
+            state.close()
+        for connection in cls.__connections.values():
+            connection.close()
+        cls.__connections.clear()
+        cls.__states.clear()
+
 
 class ProfActiveOmemoChats(object):
 
@@ -160,3 +181,4 @@ class ProfOmemoUser(object):
     def reset(cls):
         cls.account = None
         cls.fulljid = None
+        ProfOmemoState.reset()
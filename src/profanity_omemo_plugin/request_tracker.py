@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 René `reneVolution` Calles <info@renevolution.com>
+#
+# This file is part of Profanity OMEMO plugin.
+#
+# The Profanity OMEMO plugin is free software: you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# The Profanity OMEMO plugin is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import unicode_literals
+
+import time
+
+DEFAULT_REQUEST_TTL = 30  # seconds before an unanswered request is resent
+
+# key suffix of devicelist requests, bundle requests use the device id
+DEVICELIST = 'devicelist'
+
+
+class RequestTracker(object):
+    """ Outstanding bundle and devicelist IQs.
+
+    Requests are keyed by (jid, device_id) or (jid, DEVICELIST). While a
+    request for a key is in flight and younger than the ttl, further
+    requests for it are suppressed. Responses are matched by their IQ id.
+    """
+
+    def __init__(self, ttl=DEFAULT_REQUEST_TTL):
+        self.ttl = ttl
+        # key => (iq id, time sent)
+        self._requests = {}
+        # iq id => key
+        self._keys = {}
+
+        self.sent = 0
+        self.suppressed = 0
+        self.answered = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._requests)
+
+    def is_pending(self, key):
+        """ True if a request for key is in flight, counts it as suppressed.
+        """
+        try:
+            iq_id, sent_at = self._requests[key]
+        except KeyError:
+            return False
+
+        if sent_at < time.time() - self.ttl:
+            self._remove(key)
+            self.expired += 1
+            return False
+
+        self.suppressed += 1
+        return True
+
+    def add(self, key, iq_id):
+        """ Track the request with iq_id that was sent for key. """
+        if key in self._requests:
+            self._remove(key)
+        self._requests[key] = (iq_id, time.time())
+        self._keys[iq_id] = key
+        self.sent += 1
+
+    def complete(self, iq_id):
+        """ Stop tracking the request answered by the IQ with iq_id.
+
+        Returns its key, None for IQs we did not ask for.
+        """
+        key = self._keys.get(iq_id)
+        if key is not None:
+            self._remove(key)
+            self.answered += 1
+        return key
+
+    def _remove(self, key):
+        iq_id, _ = self._requests.pop(key)
+        del self._keys[iq_id]
+
+    def clear(self):
+        self._requests.clear()
+        self._keys.clear()
+
+    def get_metrics(self):
+        return {'pending': len(self._requests),
+                'sent': self.sent,
+                'suppressed': self.suppressed,
+                'answered': self.answered,
+                'expired': self.expired}
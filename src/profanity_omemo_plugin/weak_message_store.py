@@ -18,45 +18,135 @@
 # the Profanity OMEMO plugin.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from prof_omemo_state import ProfOmemoState
+from __future__ import unicode_literals
+
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_STORE_SIZE = 50  # messages kept before the oldest is dropped
+DEFAULT_MESSAGE_TIMEOUT = 120  # seconds a message waits for its sessions
 
 
 class WeakMessageStore(object):
+    """ Outgoing messages waiting for the sessions of their recipient.
+
+    Messages are kept per recipient in the order they were written. Once
+    `is_ready(recipient)` holds, `trigger` hands all of them to
+    `post_message`. Messages that wait longer than their timeout, or are
+    pushed out by newer ones, are returned by `on_timeout`.
+    """
+
+    def __init__(self, post_message, is_ready, max_size=DEFAULT_STORE_SIZE,
+                 timeout=DEFAULT_MESSAGE_TIMEOUT):
+        self.post_message = post_message
+        self.is_ready = is_ready
+        self.max_size = max_size
+        self.timeout = timeout
+        # recipient => deque of message dicts, oldest first
+        self._messages = OrderedDict()
+        self._size = 0
+        # dropped messages, reported by the next on_timeout
+        self._stale = []
 
-    def __init__(self):
-        # - maybe max store size (10 Messages FIFO drop)
-        # - configure timeout
-        # - run a checker thread
-        # - use wait on empty store to save cpu
-        self._messages = []
+        self.sent = 0
+        self.expired = 0
+        self.dropped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def pending(self, recipient):
+        return list(self._messages.get(recipient, ()))
 
     def add(self, message_dict):
         """ Adds a Message dict to the store.
 
-        :message_dict: {'from': 'romeo@montague.lit',
-                        'to': 'juliet@capulet.lit',
+        :message_dict: {'to': 'juliet@capulet.lit',
                         'message': 'Some Message',}
 
-        - adds a timestamp to the dict
-        - tries to post immediately
+        - adds a timestamp and a timeout to the dict
+        - drops the oldest message of the store if it is full
 
         """
-        pass
+        message_dict.setdefault('timestamp', time.time())
+        message_dict.setdefault('timeout', self.timeout)
+        recipient = message_dict['to']
+        self._messages.setdefault(recipient, deque()).append(message_dict)
+        self._size += 1
 
-    def post_message(self, stanza):
-        # post the encrypted message, e.g. prof.send_message(stanza)
-        pass
+        while self._size > self.max_size:
+            oldest = min(self._messages,
+                         key=lambda r: self._messages[r][0]['timestamp'])
+            self._stale.append(self._pop(oldest))
+            self.dropped += 1
+
+    def _pop(self, recipient):
+        messages = self._messages[recipient]
+        message_dict = messages.popleft()
+        if not messages:
+            del self._messages[recipient]
+        self._size -= 1
+        return message_dict
 
     def trigger(self):
+        """ Post the messages of all recipients that are ready.
+
+        Gets triggered from the outside whenever a session was built.
+        Returns the number of posted messages.
         """
-        Gets triggered from the outside to check all messages if
-        they are ready to encrypt and calls post_message.
+        if not self._messages:
+            return 0
 
-        Or -> requests the missing bundles.
+        ready = [r for r in self._messages if self.is_ready(r)]
+        batch = []
+        for recipient in ready:
+            messages = self._messages.pop(recipient)
+            self._size -= len(messages)
+            batch.extend(messages)
 
-        """
+        now = time.time()
+        for message_dict in batch:
+            latency = now - message_dict['timestamp']
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.sent += 1
+            self.post_message(message_dict)
+
+        return len(batch)
 
     def on_timeout(self):
-        # posts some information to the ui if the bundle is not received yet
-        # or a device is not trusted."
-        pass
\ No newline at end of file
+        """ Remove and return the messages that waited too long.
+
+        Messages dropped because the store was full are returned as well.
+        """
+        now = time.time()
+        stale, self._stale = self._stale, []
+        for recipient in list(self._messages):
+            messages = self._messages[recipient]
+            while messages and (now - messages[0]['timestamp'] >
+                                messages[0]['timeout']):
+                stale.append(self._pop(recipient))
+                self.expired += 1
+                if recipient not in self._messages:
+                    break
+
+        return stale
+
+    def clear(self):
+        self._messages.clear()
+        self._size = 0
+        del self._stale[:]
+
+    def get_metrics(self):
+        if self.sent:
+            avg_latency = self.total_latency / self.sent
+        else:
+            avg_latency = 0.0
+        return {'pending': self._size,
+                'sent': self.sent,
+                'expired': self.expired,
+                'dropped': self.dropped,
+                'avg_latency': avg_latency,
+                'max_latency': self.max_latency}
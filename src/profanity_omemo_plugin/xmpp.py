@@ -20,12 +20,17 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import io
+import math
 import random
+import re
 import uuid
+import weakref
 from base64 import b64decode, b64encode
 
 from profanity_omemo_plugin.constants import NS_OMEMO, NS_DEVICE_LIST, \
-    NS_DEVICE_LIST_NOTIFY, NS_BUNDLES
+    NS_BUNDLES, NS_CLIENT, NS_PUBSUB, NS_PUBSUB_EVENT, NS_FORWARD, NS_CARBONS, \
+    NS_MUC_USER
 from profanity_omemo_plugin.errors import StanzaNodeNotFound, \
     CouldNotCreateBundleStanza
 from profanity_omemo_plugin.log import get_plugin_logger
@@ -40,6 +45,44 @@ except ImportError:
 
 logger = get_plugin_logger(__name__)
 
+try:
+    str_types = (str, unicode)
+except NameError:  # Py3
+    str_types = (str,)
+
+
+# Stanza kinds returned by classify_stanza()
+STANZA_IRRELEVANT = 'irrelevant'
+STANZA_OMEMO_MESSAGE = 'omemo_message'
+STANZA_FORWARDED = 'forwarded'
+STANZA_DEVICELIST = 'devicelist'
+STANZA_BUNDLE = 'bundle'
+
+# start tags only, attribute values may contain '>'
+_START_TAG_RE = re.compile(
+    r'<([^\s/>!?]+)((?:\s+[^\s=/>]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*)\s*/?>')
+_ATTRIB_RE = re.compile(r'([^\s=]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+_FORWARD_NAMESPACES = (NS_FORWARD, NS_CARBONS)
+
+# characters fed to the pull parser at once
+PULL_PARSER_CHUNK_SIZE = 4096
+
+
+def _qualified_tags(name, namespaces):
+    return frozenset('{%s}%s' % (ns, name) for ns in namespaces)
+
+
+# ChatSecure puts the bundle children into the jabber:client namespace
+_PREKEY_TAGS = _qualified_tags('preKeyPublic', (NS_OMEMO, NS_CLIENT))
+_PREKEYS_TAGS = _qualified_tags('prekeys', (NS_OMEMO, NS_CLIENT))
+_ITEMS_TAGS = _qualified_tags('items', (NS_PUBSUB, NS_CLIENT))
+_BUNDLE_FIELD_TAGS = dict(
+    (tag, name)
+    for name in ('signedPreKeyPublic', 'signedPreKeySignature', 'identityKey')
+    for tag in _qualified_tags(name, (NS_OMEMO, NS_CLIENT))
+)
+
 
 ################################################################################
 # Helper
@@ -55,19 +98,95 @@ def stanza_as_xml(stanza):
     return xml
 
 
+class ParsedStanza(object):
+    """ A stanza which is parsed exactly once per hook call.
+
+    Classifiers and unpackers accept either a raw stanza or a ParsedStanza,
+    so the hooks can parse the stanza once and hand the result around.
+    """
+
+    def __init__(self, stanza):
+        self.raw = stanza
+        self.xml = stanza_as_xml(stanza)
+        self.attrib = self.xml.attrib
+        self.from_jid = self.attrib.get('from')
+        self.to_jid = self.attrib.get('to')
+        self.id = self.attrib.get('id')
+
+        # namespace resolved direct children of the root element
+        self.children = {}
+        for child in self.xml:
+            self.children.setdefault(child.tag, child)
+
+        # all qualified tags and pubsub node names found in the stanza
+        self.tags = set()
+        self.nodes = set()
+        for element in self.xml.iter():
+            if not isinstance(element.tag, str_types):
+                continue  # comments and processing instructions
+            self.tags.add(element.tag)
+            node = element.attrib.get('node')
+            if node is not None:
+                self.nodes.add(node)
+
+    def has_tag(self, name, ns=None):
+        if ns:
+            return '{%s}%s' % (ns, name) in self.tags
+
+        return name in self.tags or '{%s}%s' % (NS_CLIENT, name) in self.tags
+
+
+def parse_stanza(stanza):
+    """ Return a ParsedStanza for the given stanza.
+
+    Already parsed stanzas are returned as they are.
+    """
+    if isinstance(stanza, ParsedStanza):
+        return stanza
+
+    return ParsedStanza(stanza)
+
+
+def iter_stanza_events(stanza):
+    """ Incrementally parse a stanza and yield (event, element) tuples.
+
+    The stanza is fed to the parser in chunks, so a consumer which stops
+    iterating early never parses the remaining bytes.
+    """
+    events = ('start', 'end')
+    try:
+        parser = ET.XMLPullParser(events=events)
+    except AttributeError:
+        # Py2 ElementTree has no XMLPullParser
+        if not isinstance(stanza, bytes):
+            stanza = stanza.encode('utf-8')
+        for event in ET.iterparse(io.BytesIO(stanza), events=events):
+            yield event
+        return
+
+    for offset in range(0, len(stanza), PULL_PARSER_CHUNK_SIZE):
+        parser.feed(stanza[offset:offset + PULL_PARSER_CHUNK_SIZE])
+        for event in parser.read_events():
+            yield event
+
+    parser.close()
+    for event in parser.read_events():
+        yield event
+
+
 def find_node(xml, name, ns=None):
     node = None
 
     if ns:
         xq = './/{%s}%s' % (ns, name)
-        logger.debug('Looking up node for query {0}'.format(xq))
+        logger.debug('Looking up node for query %s', xq)
         node = xml.find(xq)
 
     if node is None:
         # ChatSecure seems to use the wrong xml namespace
         # use a fallback here with the custom namespace for some nodes
-        xq = './/{%s}%s' % ('jabber:client', name)
-        logger.debug('Fallback node lookup for query {0}'.format(xq))
+        xq = './/{%s}%s' % (NS_CLIENT, name)
+        logger.debug('Fallback node lookup for query %s', xq)
         node = xml.find(xq)
 
     if node is None:
@@ -77,19 +196,17 @@ def find_node(xml, name, ns=None):
 
 
 def encrypt_stanza(stanza):
-    logger.debug('Enrypting stanza {0}'.format(stanza))
     logger.debug('Convert stanza to xml.')
-    msg_xml = stanza_as_xml(stanza)
+    msg_xml = parse_stanza(stanza).xml
     fulljid = msg_xml.attrib.get('from', ProfOmemoUser().fulljid)
-    logger.debug('Sender: {0}'.format(fulljid))
+    logger.debug('Sender: %s', fulljid)
     jid = msg_xml.attrib['to']
     account, resource = jid.rsplit('/', 1)
-    logger.debug('Recipient {0} [{1}]'.format(account, resource))
+    logger.debug('Recipient %s [%s]', account, resource)
     msg_id = msg_xml.attrib['id']
-    logger.debug('Message ID: {0}'.format(msg_id))
+    logger.debug('Message ID: %s', msg_id)
     body_node = msg_xml.find('.//body')
     plaintext = body_node.text
-    logger.debug('Message: {0}'.format(plaintext))
 
     try:
         plaintext = plaintext.encode('utf-8')
@@ -102,8 +219,8 @@ def encrypt_stanza(stanza):
 def update_devicelist(from_jid, recipient, devices):
     omemo_state = ProfOmemoState()
 
-    logger.debug('Update devices for account: {0}'.format(from_jid))
-    logger.info('Adding Device ID\'s: {0} for {1}.'.format(devices, recipient))
+    logger.debug('Update devices for account: %s', from_jid)
+    logger.info('Adding Device ID\'s: %s for %s.', devices, recipient)
     if devices:
         if from_jid == recipient:
             logger.info('Adding own devices')
@@ -118,11 +235,10 @@ def update_devicelist(from_jid, recipient, devices):
 
 def get_recipient(stanza):
     try:
-        xml = stanza_as_xml(stanza)
-        recipient = xml.attrib['to']
-        logger.debug('Found recipient {0} in stanza {1}'.format(recipient, stanza))
+        recipient = parse_stanza(stanza).attrib['to']
+        logger.debug('Found recipient %s in stanza', recipient)
     except:
-        logger.error('Recipient not found in stanza {0}'.format(stanza))
+        logger.error('Recipient not found in stanza')
         return None
 
     return recipient
@@ -130,14 +246,12 @@ def get_recipient(stanza):
 
 def get_root_attrib(stanza, attrib):
     try:
-        xml = stanza_as_xml(stanza)
-        result = xml.attrib[attrib]
+        result = parse_stanza(stanza).attrib[attrib]
     except KeyError:
-        logger.error('Stanza has not attrib {0}'.format(attrib))
+        logger.error('Stanza has not attrib %s', attrib)
         return None
     except Exception as e:
-        logger.error('Failed to parse stanza: {0}'.format(stanza))
-        logger.error('{0}: {1}'.format(type(e).__name__, e.message))
+        logger.error('Failed to parse stanza: %s: %s', type(e).__name__, e)
         return None
 
     return result
@@ -149,98 +263,254 @@ def get_root_attrib(stanza, attrib):
 
 def stanza_is_valid_xml(stanza):
     """ Validates a given stanza to be valid xml"""
+    if isinstance(stanza, ParsedStanza):
+        return True
+
     try:
         _ = stanza_as_xml(stanza)
     except Exception as e:
-        logger.error('Stanza is not valid xml. {0}'.format(e))
-        logger.error(stanza)
+        logger.error('Stanza is not valid xml. %s', e)
         return False
 
     return True
 
 
+def classify_stanza(stanza):
+    """ Classify a raw stanza without building an element tree.
+
+    Only the start tags are scanned and the scan stops at the first element
+    which decides the kind. Every stanza that is of interest for the plugin
+    mentions the OMEMO namespace, everything else is rejected up front.
+
+    :returns: one of the STANZA_* kinds
+    """
+    if not stanza:
+        return STANZA_IRRELEVANT
+
+    if isinstance(stanza, ParsedStanza):
+        stanza = stanza.raw
+
+    if not isinstance(stanza, str_types):
+        stanza = stanza.decode('utf-8')
+
+    if NS_OMEMO not in stanza:
+        return STANZA_IRRELEVANT
+
+    forwarded = False
+    prefixes = {}
+    for match in _START_TAG_RE.finditer(stanza):
+        prefix, _, name = match.group(1).rpartition(':')
+        attribs = {}
+        for key, dquoted, squoted in _ATTRIB_RE.findall(match.group(2)):
+            attribs[key] = dquoted or squoted
+            if key.startswith('xmlns:'):
+                prefixes[key[6:]] = attribs[key]
+
+        if prefix:
+            ns = prefixes.get(prefix)
+        else:
+            ns = attribs.get('xmlns')
+
+        if name == 'encrypted' and ns == NS_OMEMO:
+            return STANZA_FORWARDED if forwarded else STANZA_OMEMO_MESSAGE
+
+        if name in ('forwarded', 'received', 'sent'):
+            forwarded = forwarded or ns in _FORWARD_NAMESPACES
+
+        elif name == 'items':
+            node = attribs.get('node', '')
+            if node == NS_DEVICE_LIST:
+                return STANZA_DEVICELIST
+            if node.startswith(NS_BUNDLES + ':'):
+                return STANZA_BUNDLE
+
+    return STANZA_IRRELEVANT
+
+
+def get_stanza_id(stanza):
+    """ Return the id of the root element, only its start tag is scanned. """
+    if isinstance(stanza, ParsedStanza):
+        return stanza.attrib.get('id')
+
+    if not isinstance(stanza, str_types):
+        stanza = stanza.decode('utf-8')
+
+    match = _START_TAG_RE.search(stanza)
+    if match is None:
+        return None
+
+    for key, dquoted, squoted in _ATTRIB_RE.findall(match.group(2)):
+        if key == 'id':
+            return dquoted or squoted
+
+    return None
+
+
 def is_devicelist_update(stanza):
-    return NS_DEVICE_LIST in stanza and not NS_DEVICE_LIST_NOTIFY in stanza
+    return NS_DEVICE_LIST in parse_stanza(stanza).nodes
 
 
 def is_bundle_update(stanza):
-    return NS_BUNDLES in stanza
+    nodes = parse_stanza(stanza).nodes
+    return any(node.startswith(NS_BUNDLES) for node in nodes)
 
 
 def is_encrypted_message(stanza):
-    # TODO: check in NS_OMEMO only
-    return 'encrypted' in stanza
+    return parse_stanza(stanza).has_tag('encrypted', ns=NS_OMEMO)
 
 
 def is_xmpp_message(stanza):
-    stanza = stanza or ''
-    is_valid = all([NS_OMEMO in stanza, 'body' in stanza])
-    return is_valid
+    if not stanza:
+        return False
+
+    parsed = parse_stanza(stanza)
+    return parsed.has_tag('encrypted', ns=NS_OMEMO) and parsed.has_tag('body')
 
 
 def is_xmpp_plaintext_message(stanza):
-    stanza = stanza or ''
-    return 'body' in stanza
+    if not stanza:
+        return False
+
+    return parse_stanza(stanza).has_tag('body')
 
 
 ################################################################################
 # Unwrapping XMPP stanzas
 ################################################################################
 
-def unpack_bundle_info(stanza):
-    logger.info('Unwrapping bundle info.')
-    bundle_xml = stanza_as_xml(stanza)
+class PreKeyReservoir(object):
+    """ Single slot reservoir sample over a stream of prekeys.
 
-    try:
-        sender = bundle_xml.attrib['from'].rsplit('/', 1)[0]
-        logger.debug('Found sender jid {0} in bundle info.'.format(sender))
-    except KeyError:
-        # we assume bundle updates without sender to be own bundles for
-        # different devices
-        sender = ProfOmemoUser.account
-        logger.debug(
-            'Fallback to known sender {0} while unpacking bundle info'.format(sender)
-        )
+    Uses Algorithm L, so only a logarithmic amount of random numbers is
+    drawn and the prekeys which are skipped are never looked at.
+    """
 
-    try:
-        items_node = find_node(bundle_xml, 'items', ns='http://jabber.org/protocol/pubsub')
-        device_id = items_node.attrib['node'].split(':')[-1]
+    def __init__(self, rng=None):
+        self.rng = rng or random.SystemRandom()
+        self.picked = None
+        self.count = 0
+        self._next = 0
+        self._weight = 1.0
 
-        bundle_node = find_node(bundle_xml, 'bundle', ns=NS_OMEMO)
+    def _uniform(self):
+        """ Return a random number in the open interval (0, 1). """
+        value = self.rng.random()
+        while value == 0.0:
+            value = self.rng.random()
+        return value
 
-        signedPreKeyPublic_node = find_node(bundle_node, 'signedPreKeyPublic', ns=NS_OMEMO)
-        signedPreKeyPublic = signedPreKeyPublic_node.text
+    def offer(self, prekey):
+        if self.count == self._next:
+            self.picked = prekey
+            self._weight *= self._uniform()
+            skip = math.log(self._uniform()) / math.log1p(-self._weight)
+            self._next += int(skip) + 1
 
-        signedPreKeyId = int(signedPreKeyPublic_node.attrib['signedPreKeyId'])
+        self.count += 1
 
-        signedPreKeySignature_node = find_node(bundle_node, 'signedPreKeySignature', ns=NS_OMEMO)
-        signedPreKeySignature = signedPreKeySignature_node.text
 
-        identityKey_node = find_node(bundle_node, 'identityKey', ns=NS_OMEMO)
-        identityKey = identityKey_node.text
+def pick_prekey(prekeys, rng=None):
+    """ Pick one (preKeyId, preKeyPublic) tuple uniformly at random.
 
-        prekeys_node = find_node(bundle_node, 'prekeys', ns=NS_OMEMO)
-        prekeys = [(int(n.attrib['preKeyId']), n.text) for n in prekeys_node]
+    The prekeys are neither materialized in a list nor decoded before one
+    has been chosen.
+    """
+    reservoir = PreKeyReservoir(rng)
+    for prekey in prekeys:
+        reservoir.offer(prekey)
 
-        picked_key_tuple = random.SystemRandom().choice(prekeys)
-        preKeyId, preKeyPublic = picked_key_tuple
+    return reservoir.picked
 
-        if not preKeyId:
-            logger.warning('OMEMO PreKey has no id set')
-            return
 
-        if not preKeyPublic:
-            logger.warning('No Public PreKey set.')
-            return
+def stream_bundle_info(stanza):
+    """ Unwrap bundle info with a pull parser.
 
-    except StanzaNodeNotFound as e:
-        logger.warning('Could not unpack bundle info. {0}'.format(e))
+    Processed elements are dropped from the tree right away and parsing
+    stops as soon as all bundle fields have been captured, so memory usage
+    does not grow with the amount of prekeys in the bundle.
+    """
+    logger.info('Streaming bundle info.')
+    fields = {}
+    prekeys_done = False
+    reservoir = PreKeyReservoir()
+    stack = []
+
+    try:
+        for event, element in iter_stanza_events(stanza):
+            if event == 'start':
+                if not stack:
+                    fields['from'] = element.attrib.get('from')
+                stack.append(element)
+                continue
+
+            stack.pop()
+            tag = element.tag
+
+            if tag in _PREKEY_TAGS:
+                reservoir.offer((element.attrib.get('preKeyId'), element.text))
+            elif tag in _PREKEYS_TAGS:
+                prekeys_done = True
+            elif tag in _BUNDLE_FIELD_TAGS:
+                name = _BUNDLE_FIELD_TAGS[tag]
+                fields[name] = element.text
+                if name == 'signedPreKeyPublic':
+                    fields['signedPreKeyId'] = element.attrib['signedPreKeyId']
+            elif tag in _ITEMS_TAGS:
+                fields['items'] = element.attrib.get('node')
+
+            # drop the processed element to keep the tree flat
+            element.clear()
+            if stack:
+                stack[-1].remove(element)
+
+            if prekeys_done and len(fields) == 6:
+                break
+    except ET.ParseError as e:
+        logger.warning('Could not parse bundle info. %s', e)
+        return
+
+    if not prekeys_done or len(fields) < 6:
+        logger.warning('Could not unpack bundle info. Missing nodes.')
+        return
+
+    return _create_bundle_dict(fields['from'], fields['items'],
+                               fields['signedPreKeyId'],
+                               fields['signedPreKeyPublic'],
+                               fields['signedPreKeySignature'],
+                               fields['identityKey'], reservoir.picked)
+
+
+def _create_bundle_dict(from_jid, node, signedPreKeyId, signedPreKeyPublic,
+                        signedPreKeySignature, identityKey, picked_prekey):
+    if from_jid:
+        sender = from_jid.rsplit('/', 1)[0]
+        logger.debug('Found sender jid %s in bundle info.', sender)
+    else:
+        # we assume bundle updates without sender to be own bundles for
+        # different devices
+        sender = ProfOmemoUser.account
+        logger.debug('Fallback to known sender %s while unpacking bundle info',
+                     sender)
+
+    if picked_prekey is None:
+        logger.warning('Bundle contains no PreKeys')
+        return
+
+    preKeyId, preKeyPublic = picked_prekey
+    preKeyId = int(preKeyId) if preKeyId else None
+
+    if not preKeyId:
+        logger.warning('OMEMO PreKey has no id set')
+        return
+
+    if not preKeyPublic:
+        logger.warning('No Public PreKey set.')
         return
 
     bundle_dict = {
         'sender': sender,
-        'device': device_id,
-        'signedPreKeyId': signedPreKeyId,
+        'device': node.split(':')[-1],
+        'signedPreKeyId': int(signedPreKeyId),
         'signedPreKeyPublic': b64decode(signedPreKeyPublic),
         'signedPreKeySignature': b64decode(signedPreKeySignature),
         'identityKey': b64decode(identityKey),
@@ -251,6 +521,42 @@ def unpack_bundle_info(stanza):
     return bundle_dict
 
 
+def unpack_bundle_info(stanza):
+    """ Unwrap bundle info.
+
+    Raw stanzas are streamed with :func:`stream_bundle_info`, already parsed
+    stanzas are read from their element tree.
+    """
+    if not isinstance(stanza, ParsedStanza):
+        return stream_bundle_info(stanza)
+
+    logger.info('Unwrapping bundle info.')
+    bundle_xml = stanza.xml
+
+    try:
+        items_node = find_node(bundle_xml, 'items', ns=NS_PUBSUB)
+        bundle_node = find_node(bundle_xml, 'bundle', ns=NS_OMEMO)
+
+        signedPreKeyPublic_node = find_node(bundle_node, 'signedPreKeyPublic', ns=NS_OMEMO)
+        signedPreKeySignature_node = find_node(bundle_node, 'signedPreKeySignature', ns=NS_OMEMO)
+        identityKey_node = find_node(bundle_node, 'identityKey', ns=NS_OMEMO)
+        prekeys_node = find_node(bundle_node, 'prekeys', ns=NS_OMEMO)
+
+    except StanzaNodeNotFound as e:
+        logger.warning('Could not unpack bundle info. %s', e)
+        return
+
+    picked = pick_prekey((n.attrib.get('preKeyId'), n.text)
+                         for n in prekeys_node)
+
+    return _create_bundle_dict(bundle_xml.attrib.get('from'),
+                               items_node.attrib['node'],
+                               signedPreKeyPublic_node.attrib['signedPreKeyId'],
+                               signedPreKeyPublic_node.text,
+                               signedPreKeySignature_node.text,
+                               identityKey_node.text, picked)
+
+
 def unpack_encrypted_stanza(encrypted_stanza):
     """
     <message id="8d966c20-1690-46eb-b1cd-a7ddcc419fde" to="renevolution@yakshed.org" type="chat" from="testvolution@yakshed.org/conversations">
@@ -272,20 +578,21 @@ def unpack_encrypted_stanza(encrypted_stanza):
     """
 
     logger.info('Unpacking encrypted Message stanza.')
-    xml = ET.fromstring(encrypted_stanza)
-    if '<forwarded' in encrypted_stanza:
-        xml = xml.find('.//{jabber:client}message')
+    parsed = parse_stanza(encrypted_stanza)
+    xml = parsed.xml
+    if parsed.has_tag('forwarded', ns=NS_FORWARD):
+        xml = xml.find('.//{%s}message' % NS_CLIENT)
 
     sender_fulljid = xml.attrib['from']
     sender, resource = sender_fulljid.rsplit('/', 1)
-    logger.debug('Found sender {0} [{1}]'.format(sender, resource))
+    logger.debug('Found sender %s [%s]', sender, resource)
 
     encrypted_node = xml.find('.//{%s}encrypted' % NS_OMEMO)
 
     header_node = encrypted_node.find('.//{%s}header' % NS_OMEMO)
 
     sid = int(header_node.attrib['sid'])
-    logger.debug('Found sender ID: {0}'.format(sid))
+    logger.debug('Found sender ID: %s', sid)
 
     iv_node = header_node.find('.//{%s}iv' % NS_OMEMO)
     iv = iv_node.text
@@ -313,8 +620,41 @@ def unpack_encrypted_stanza(encrypted_stanza):
     return msg_dict
 
 
+def unpack_muc_presence(stanza):
+    """ Unwrap the room membership information of a MUC presence.
+
+    Returns `None` for presences without a muc#user item. `jid` is the bare
+    real jid of the member or `None` in anonymous rooms.
+    """
+    parsed = parse_stanza(stanza)
+    xml = parsed.xml
+    user_node = xml.find('{%s}x' % NS_MUC_USER)
+    if user_node is None:
+        return None
+
+    item_node = user_node.find('{%s}item' % NS_MUC_USER)
+    if item_node is None:
+        return None
+
+    room, _, nick = (parsed.from_jid or '').partition('/')
+    real_jid = item_node.attrib.get('jid')
+    codes = set(node.attrib.get('code')
+                for node in user_node.findall('{%s}status' % NS_MUC_USER))
+
+    new_nick = None
+    if '303' in codes:
+        new_nick = item_node.attrib.get('nick')
+
+    return {'room': room,
+            'nick': nick,
+            'jid': real_jid.rsplit('/', 1)[0] if real_jid else None,
+            'available': xml.attrib.get('type') != 'unavailable',
+            'self': '110' in codes,
+            'new_nick': new_nick}
+
+
 def unpack_devicelist_info(stanza):
-    xml = stanza_as_xml(stanza)
+    xml = parse_stanza(stanza).xml
 
     try:
         sender_jid = xml.attrib.get('from')
@@ -322,14 +662,14 @@ def unpack_devicelist_info(stanza):
         sender_jid = None
 
     if sender_jid is None:
-        event_node = xml.find('./{%s}event' % 'http://jabber.org/protocol/pubsub#event')
+        event_node = xml.find('./{%s}event' % NS_PUBSUB_EVENT)
         try:
             sender_jid = event_node.attrib.get('from')
         except AttributeError:
             # device list info is result of a request for our own account
             sender_jid = ProfOmemoUser().account
 
-    logger.debug('Found sender jid {0}'.format(sender_jid))
+    logger.debug('Found sender jid %s', sender_jid)
 
     item_list = xml.find('.//{%s}list' % NS_OMEMO)
     if item_list is not None:
@@ -337,7 +677,7 @@ def unpack_devicelist_info(stanza):
     else:
         device_ids = []
 
-    logger.debug('Found device ids {0}'.format(device_ids))
+    logger.debug('Found device ids %s', device_ids)
     msg_dict = {'from': sender_jid,
                 'devices': device_ids}
 
@@ -348,62 +688,85 @@ def unpack_devicelist_info(stanza):
 # Create XMPP stanzas
 ################################################################################
 
+def b64encode_text(data):
+    """ Base64 encode a bytes-like object into text for a stanza. """
+    return b64encode(data).decode('ascii')
+
+
+# OmemoState => (bundle version, serialized bundle node), the versions
+# of a state start over when it is rebuilt on reconnect
+_own_bundle_cache = weakref.WeakKeyDictionary()
+
+
+def _own_bundle_node(omemo_state):
+    """ Return the serialized bundle node of omemo_state.
+
+    The node is cached until the prekeys or the signed prekey change. The
+    prekeys come with precomputed base64 public keys from the store, so a
+    rebuild after a consumed prekey only joins strings.
+    """
+    BUNDLE_NODE = ('<bundle xmlns="{omemo_ns}">'
+                   '<signedPreKeyPublic signedPreKeyId="{signedPreKeyId}">'
+                   '{signedPreKeyPublic}'
+                   '</signedPreKeyPublic>'
+                   '<signedPreKeySignature>{signedPreKeySignature}'
+                   '</signedPreKeySignature>'
+                   '<identityKey>{identityKey}</identityKey>'
+                   '<prekeys>{prekeys}</prekeys>'
+                   '</bundle>')
+
+    cached = _own_bundle_cache.get(omemo_state)
+    if cached is not None and cached[0] == omemo_state.bundle_version:
+        return cached[1]
+
+    own_bundle = omemo_state.bundle
+    prekey_nodes = [
+        '<preKeyPublic preKeyId="{0}">{1}</preKeyPublic>'.format(key_id, key)
+        for key_id, key in own_bundle['prekeys']
+    ]
+    bundle_node = BUNDLE_NODE.format(
+        omemo_ns=NS_OMEMO,
+        signedPreKeyId=own_bundle['signedPreKeyId'],
+        signedPreKeyPublic=own_bundle['signedPreKeyPublic'],
+        signedPreKeySignature=own_bundle['signedPreKeySignature'],
+        identityKey=own_bundle['identityKey'],
+        prekeys=''.join(prekey_nodes))
+
+    _own_bundle_cache[omemo_state] = (omemo_state.bundle_version,
+                                      bundle_node)
+    return bundle_node
+
+
 def create_own_bundle_stanza():
     announce_template = ('<iq from="{from_jid}" type="set" id="{req_id}">'
                          '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
                          '<publish node="{bundles_ns}:{device_id}">'
                          '<item>'
-                         '<bundle xmlns="{omemo_ns}">'
-                         '</bundle>'
+                         '{bundle}'
                          '</item>'
                          '</publish>'
                          '</pubsub>'
                          '</iq>')
 
     omemo_state = ProfOmemoState()
-    own_bundle = omemo_state.bundle
-    own_jid = omemo_state.own_jid
-    bundle_msg = announce_template.format(from_jid=own_jid,
-                                          req_id=str(uuid.uuid4()),
-                                          device_id=omemo_state.own_device_id,
-                                          bundles_ns=NS_BUNDLES,
-                                          omemo_ns=NS_OMEMO)
-
-    bundle_xml = ET.fromstring(bundle_msg)
-
-    # to be appended to announce_template
-    find_str = './/{%s}bundle' % NS_OMEMO
-    bundle_node = bundle_xml.find(find_str)
-    pre_key_signed_node = ET.SubElement(bundle_node, 'signedPreKeyPublic',
-                                        attrib={'signedPreKeyId': str(
-                                            own_bundle['signedPreKeyId'])})
-    pre_key_signed_node.text = own_bundle.get('signedPreKeyPublic')
-
-    signedPreKeySignature_node = ET.SubElement(bundle_node,
-                                               'signedPreKeySignature')
-    signedPreKeySignature_node.text = own_bundle.get('signedPreKeySignature')
-
-    identityKey_node = ET.SubElement(bundle_node, 'identityKey')
-    identityKey_node.text = own_bundle.get('identityKey')
-
-    prekeys_node = ET.SubElement(bundle_node, 'prekeys')
-    for key_id, key in own_bundle.get('prekeys', []):
-        key_node = ET.SubElement(prekeys_node, 'preKeyPublic',
-                                 attrib={'preKeyId': str(key_id)})
-        key_node.text = key
-
-    # reconvert xml to stanza
     try:
-        bundle_stanza = ET.tostring(bundle_xml, encoding='utf-8', method='html')
-    except:
-        logger.exception('Could not convert Bunle XML to Stanza.')
+        bundle_node = _own_bundle_node(omemo_state)
+    except Exception:
+        logger.exception('Could not create Bundle Stanza.')
         raise CouldNotCreateBundleStanza
 
+    bundle_stanza = announce_template.format(
+        from_jid=omemo_state.own_jid,
+        req_id=str(uuid.uuid4()),
+        device_id=omemo_state.own_device_id,
+        bundles_ns=NS_BUNDLES,
+        bundle=bundle_node)
+
     return bundle_stanza
 
 
 def create_bundle_request_stanza(account, recipient, deviceid):
-    logger.info('Fetching bundle for device id {0} of {1}'.format(deviceid, recipient))
+    logger.info('Fetching bundle for device id %s of %s', deviceid, recipient)
 
     bundle_req_root = ET.Element('iq')
     bundle_req_root.set('type', 'get')
@@ -444,7 +807,7 @@ def create_encrypted_message(from_jid, to_jid, plaintext, msg_id=None):
     keys_dict = msg_data['keys'] or {}
 
     # key is now a tuple of (key, is_prekey)
-    keys_str = ''
+    key_nodes = []
     for rid, key_info in keys_dict.items():
         key, is_prekey = key_info
         if is_prekey:
@@ -452,16 +815,16 @@ def create_encrypted_message(from_jid, to_jid, plaintext, msg_id=None):
             tpl = '<key prekey="true" rid="{0}">{1}</key>'
         else:
             tpl = '<key rid="{0}">{1}</key>'
-        keys_str += tpl.format(rid, b64encode(key))
+        key_nodes.append(tpl.format(rid, b64encode_text(key)))
 
     msg_dict = {'to': to_jid,
                 'from': from_jid,
                 'id': msg_id or str(uuid.uuid4()),
                 'omemo_ns': NS_OMEMO,
                 'sid': msg_data['sid'],
-                'keys': keys_str,
-                'iv': b64encode(msg_data['iv']),
-                'enc_body': b64encode(msg_data['payload'])}
+                'keys': ''.join(key_nodes),
+                'iv': b64encode_text(msg_data['iv']),
+                'enc_body': b64encode_text(msg_data.pop('payload'))}
 
     enc_msg = OMEMO_MSG.format(**msg_dict)
 
@@ -469,7 +832,7 @@ def create_encrypted_message(from_jid, to_jid, plaintext, msg_id=None):
 
 
 def create_devicelist_update_msg(fulljid):
-    logger.debug('Create devicelist update message for jid {0}.'.format(fulljid))
+    logger.debug('Create devicelist update message for jid %s.', fulljid)
     QUERY_MSG = ('<iq type="set" from="{from}" id="{id}">'
                  '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
                  '<publish node="{devicelist_ns}">'
@@ -485,7 +848,7 @@ def create_devicelist_update_msg(fulljid):
     omemo_state = ProfOmemoState()
 
     own_devices = set(omemo_state.own_devices + [omemo_state.own_device_id])
-    logger.debug('Found own devices {0}'.format(own_devices))
+    logger.debug('Found own devices %s', own_devices)
     device_nodes = ['<device id="{0}"/>'.format(d) for d in own_devices]
 
     msg_dict = {'from': fulljid,
@@ -500,9 +863,8 @@ def create_devicelist_update_msg(fulljid):
 
 
 def create_devicelist_query_msg(sender, recipient):
-    logger.debug(
-        'Create devicelist query message from {0} to {1}'.format(sender, recipient)
-    )
+    logger.debug('Create devicelist query message from %s to %s', sender,
+                 recipient)
 
     QUERY_MSG = ('<iq type="get" from="{from}" to="{to}" id="{id}">'
                  '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
@@ -519,6 +881,6 @@ def create_devicelist_query_msg(sender, recipient):
 
     query_msg = QUERY_MSG.format(**msg_dict)
 
-    logger.debug('Sending Device List Query: {0}'.format(query_msg))
+    logger.debug('Sending Device List Query: %s', query_msg)
 
     return query_msg
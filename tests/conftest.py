@@ -0,0 +1,13 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import pytest
+from mock import patch
+
+
+@pytest.fixture(scope='session', autouse=True)
+def data_home(tmpdir_factory):
+    """ Keep the databases of ProfOmemoState out of the home directory. """
+    path = str(tmpdir_factory.mktemp('data_home'))
+    with patch('profanity_omemo_plugin.db.XDG_DATA_HOME', path):
+        yield path
@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from mock import patch
+
+from profanity_omemo_plugin.omemo import aes_gcm_native
+
+KEY = os.urandom(16)
+IV = os.urandom(16)
+PLAINTEXT = 'Hello Juliet, wherefore art thou?'.encode('utf-8')
+
+
+def encrypt_to_bytes(encrypt, key, iv, plaintext):
+    payload, tag = encrypt(key, iv, plaintext)
+    # both backends return bytes
+    assert isinstance(payload, bytes)
+    assert isinstance(tag, bytes)
+    return payload, tag
+
+
+ENCRYPT = [aes_gcm_native._cipher_encrypt]
+DECRYPT = [aes_gcm_native._cipher_decrypt]
+if aes_gcm_native.AESGCM is not None:
+    ENCRYPT.append(aes_gcm_native._aead_encrypt)
+    DECRYPT.append(aes_gcm_native._aead_decrypt)
+
+
+@pytest.mark.parametrize('encrypt', ENCRYPT)
+@pytest.mark.parametrize('decrypt', DECRYPT)
+class TestAesGcm(object):
+
+    def test_xep_key_tag_layout(self, encrypt, decrypt):
+        payload, tag = encrypt_to_bytes(encrypt, KEY, IV, PLAINTEXT)
+
+        assert decrypt(KEY + tag, IV, payload) == PLAINTEXT
+
+    def test_legacy_key_tag_layout(self, encrypt, decrypt):
+        payload, tag = encrypt_to_bytes(encrypt, KEY, IV, PLAINTEXT)
+
+        assert decrypt(KEY, IV, payload + tag) == PLAINTEXT
+
+    def test_invalid_tag_is_rejected(self, encrypt, decrypt):
+        payload, tag = encrypt_to_bytes(encrypt, KEY, IV, PLAINTEXT)
+
+        with pytest.raises(InvalidTag):
+            decrypt(KEY + os.urandom(16), IV, payload)
+
+
+@pytest.mark.parametrize('size', [0, 16, aes_gcm_native.AEAD_COPY_LIMIT + 1])
+def test_public_functions_roundtrip(size):
+    plaintext = os.urandom(size)
+    payload, tag = encrypt_to_bytes(aes_gcm_native.aes_encrypt,
+                                    KEY, IV, plaintext)
+
+    assert len(tag) == aes_gcm_native.TAG_SIZE
+    assert aes_gcm_native.aes_decrypt(KEY + tag, IV, payload) == plaintext
+    assert aes_gcm_native.aes_decrypt(KEY, IV, payload + tag) == plaintext
+
+
+def test_large_payloads_skip_the_aead_copy():
+    plaintext = os.urandom(aes_gcm_native.AEAD_COPY_LIMIT + 1)
+    with patch.object(aes_gcm_native, '_aead_encrypt') as aead_encrypt:
+        aes_gcm_native.aes_encrypt(KEY, IV, plaintext)
+
+    assert not aead_encrypt.called
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import threading
+import time
+
+import sqlite3
+
+import pytest
+from axolotl.state.sessionrecord import SessionRecord
+
+from profanity_omemo_plugin.db import ConnectionManager, _Request, \
+    get_connection
+from profanity_omemo_plugin.omemo.liteaxolotlstore import LiteAxolotlStore
+
+JULIET = 'juliet@capulet.lit'
+
+
+@pytest.fixture
+def manager(tmpdir):
+    manager = ConnectionManager(str(tmpdir.join('omemo.db')))
+    yield manager
+    manager.close()
+
+
+def in_thread(func):
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func()))
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def test_get_connection_is_plain_by_default():
+    connection = get_connection(JULIET)
+    try:
+        assert isinstance(connection, sqlite3.Connection)
+    finally:
+        connection.close()
+
+
+def test_get_connection_with_connection_manager():
+    manager = get_connection(JULIET, connection_manager=True)
+    try:
+        assert isinstance(manager, ConnectionManager)
+    finally:
+        manager.close()
+
+
+class TestConnectionManager(object):
+
+    def test_stores_work_unchanged(self, manager):
+        store = LiteAxolotlStore(manager)
+        record = SessionRecord()
+        store.storeSession(JULIET, 1, record)
+        store.sessionStore.invalidateSession(JULIET, 1)
+
+        assert store.containsSession(JULIET, 1)
+        assert store.loadSession(JULIET, 1).serialize() == record.serialize()
+        assert in_thread(lambda: store.getSubDeviceSessions(JULIET)) == [1]
+
+    def test_transaction_is_visible_to_all_threads(self, manager):
+        store = LiteAxolotlStore(manager)
+
+        with store.transaction():
+            store.storeSession(JULIET, 1, SessionRecord())
+            assert manager.in_transaction
+            assert in_thread(lambda: store.containsSession(JULIET, 1))
+
+        assert not manager.in_transaction
+        assert in_thread(lambda: store.containsSession(JULIET, 1))
+
+    def test_rollback(self, manager):
+        store = LiteAxolotlStore(manager)
+        try:
+            with store.transaction():
+                store.storeSession(JULIET, 1, SessionRecord())
+                raise ValueError()
+        except ValueError:
+            pass
+
+        assert not store.containsSession(JULIET, 1)
+
+    def test_rollback_keeps_requested_commits(self, manager):
+        manager.execute('CREATE TABLE t (x INTEGER)')
+        # hold the writer, so the requests below are handled in one go
+        gate = threading.Event()
+        held = _Request('call', lambda db: gate.wait())
+        manager._queue.put(held)
+        requests = [_Request('execute', 'INSERT INTO t VALUES (1)', ()),
+                    _Request('commit'),
+                    _Request('execute', 'INSERT INTO t VALUES (2)', ()),
+                    _Request('rollback')]
+        for request in requests:
+            manager._queue.put(request)
+        gate.set()
+        for request in [held] + requests:
+            request.wait()
+
+        assert manager.execute('SELECT x FROM t').fetchall() == [(1, )]
+        assert manager.get_metrics()['commits'] == 1
+
+    def test_readers_against_continuous_writer(self, manager):
+        store = LiteAxolotlStore(manager, journal_mode='wal')
+        record = SessionRecord()
+        writes = 100
+        errors = []
+        done = threading.Event()
+
+        def write():
+            try:
+                for device in range(writes):
+                    store.storeSession(JULIET, device, record)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        def read():
+            seen = 0
+            try:
+                while not done.is_set():
+                    devices = store.getSubDeviceSessions(JULIET)
+                    assert len(devices) >= seen
+                    seen = len(devices)
+                    # leave the GIL to the writer now and then
+                    time.sleep(0.001)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert len(store.getSubDeviceSessions(JULIET)) == writes
+        assert manager.get_metrics()['readers'] >= 8
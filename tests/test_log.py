@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import pytest
+from mock import patch
+
+from profanity_omemo_plugin import log
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+        self.threads = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+        self.threads.append(threading.current_thread())
+
+
+class Unformattable(object):
+
+    def __str__(self):
+        raise AssertionError('formatted a disabled record')
+
+
+def get_logger(handler):
+    logger = logging.getLogger('profanity_omemo_plugin.test_log')
+    logger.propagate = False
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+class TestLog(object):
+
+    def test_handlers_are_attached_once(self):
+        for _ in range(3):
+            logger = log.get_plugin_logger('profanity_omemo_plugin.twice')
+
+        assert logger.handlers.count(log._plugin_handler) == 1
+
+    def test_records_are_shipped_on_drain(self):
+        records = queue.Queue(10)
+        listener = log.ProfLogListener(records)
+        recorder = RecordingHandler()
+        listener.handlers = (recorder, )
+        logger = get_logger(log.BoundedQueueHandler(records, prefix='Test'))
+
+        logger.info('Received %d keys', 3)
+        assert recorder.messages == []
+
+        thread = threading.Thread(target=logger.info, args=('Sent', ))
+        thread.start()
+        thread.join()
+        listener.drain()
+
+        assert recorder.messages == ['Test - Received 3 keys', 'Test - Sent']
+        assert recorder.threads == [threading.current_thread()] * 2
+        assert records.empty()
+
+    def test_handler_looks_up_prof_on_emit(self):
+        with patch.object(log, 'prof', object(), create=True):
+            handler = log.ProfLogHandler()
+
+        assert handler.format(logging.makeLogRecord({'msg': 'ok'}))
+
+    def test_full_queue_drops_records(self):
+        handler = log.BoundedQueueHandler(queue.Queue(2))
+        logger = get_logger(handler)
+
+        for i in range(5):
+            logger.info('record %d', i)
+
+        assert handler.dropped == 3
+        assert handler.queue.qsize() == 2
+
+    def test_disabled_records_are_not_formatted(self):
+        handler = log.BoundedQueueHandler(queue.Queue(2))
+        logger = get_logger(handler)
+
+        logger.debug('%s', Unformattable())
+
+        assert handler.queue.empty()
+
+    def test_set_log_level_rejects_unknown_levels(self):
+        with pytest.raises(ValueError):
+            log.set_log_level('verbose')
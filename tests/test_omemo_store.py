@@ -0,0 +1,821 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sqlite3
+import threading
+from base64 import b64decode
+
+import pytest
+from axolotl.state.sessionrecord import SessionRecord
+from mock import MagicMock, patch
+
+from profanity_omemo_plugin.omemo import queries
+from profanity_omemo_plugin.omemo.db_helpers import user_version
+from profanity_omemo_plugin.omemo.liteaxolotlstore import LiteAxolotlStore
+from profanity_omemo_plugin.omemo.sql import SQLDatabase
+from profanity_omemo_plugin.omemo.state import OmemoState, TRUSTED, \
+    UNDECIDED
+
+
+def get_test_db_connection():
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+
+def get_omemo_state(jid, connection=None):
+    connection = connection or get_test_db_connection()
+    return OmemoState(jid, connection, jid, MagicMock())
+
+
+def get_bundle_dict(state):
+    bundle = state.bundle
+    prekey_id, prekey = bundle['prekeys'][0]
+    return {'preKeyId': prekey_id,
+            'preKeyPublic': b64decode(prekey),
+            'signedPreKeyId': bundle['signedPreKeyId'],
+            'signedPreKeyPublic': b64decode(bundle['signedPreKeyPublic']),
+            'signedPreKeySignature': b64decode(bundle['signedPreKeySignature']),
+            'identityKey': b64decode(bundle['identityKey'])}
+
+
+class TestSessionCache(object):
+
+    def setup_method(self, test_method):
+        self.store = LiteAxolotlStore(get_test_db_connection(),
+                                      session_cache_size=2)
+        self.sessions = self.store.sessionStore
+
+    def test_load_session_is_cached(self):
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+        self.sessions.invalidateSession('juliet@capulet.lit', 1)
+
+        record = self.store.loadSession('juliet@capulet.lit', 1)
+
+        assert self.store.loadSession('juliet@capulet.lit', 1) is record
+        assert self.sessions.getCacheInfo()['misses'] == 1
+        assert self.sessions.getCacheInfo()['hits'] == 1
+
+    def test_store_session_writes_through(self):
+        record = SessionRecord()
+        self.store.storeSession('juliet@capulet.lit', 1, record)
+
+        assert self.store.loadSession('juliet@capulet.lit', 1) is record
+        assert self.sessions.getCacheInfo()['misses'] == 0
+        assert self.store.containsSession('juliet@capulet.lit', 1)
+
+    def test_delete_session_invalidates_cache(self):
+        record = SessionRecord()
+        self.store.storeSession('juliet@capulet.lit', 1, record)
+        self.store.deleteSession('juliet@capulet.lit', 1)
+
+        assert self.store.loadSession('juliet@capulet.lit', 1) is not record
+        assert self.sessions.getCacheInfo()['misses'] == 1
+
+    def test_delete_all_sessions_invalidates_cache(self):
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+        self.store.storeSession('romeo@montague.lit', 1, SessionRecord())
+        self.store.deleteAllSessions('juliet@capulet.lit')
+
+        info = self.sessions.getCacheInfo()
+        assert info['size'] == 1
+        assert not self.store.containsSession('juliet@capulet.lit', 1)
+
+    def test_cache_evicts_least_recently_used(self):
+        first = SessionRecord()
+        self.store.storeSession('juliet@capulet.lit', 1, first)
+        self.store.storeSession('juliet@capulet.lit', 2, SessionRecord())
+        self.store.loadSession('juliet@capulet.lit', 1)
+        self.store.storeSession('juliet@capulet.lit', 3, SessionRecord())
+
+        assert self.sessions.getCacheInfo()['size'] == 2
+        assert self.store.loadSession('juliet@capulet.lit', 1) is first
+        assert self.sessions.getCacheInfo()['misses'] == 0
+
+        self.store.loadSession('juliet@capulet.lit', 2)
+        assert self.sessions.getCacheInfo()['misses'] == 1
+
+    def test_cache_can_be_disabled(self):
+        self.sessions.setCacheSize(0)
+        record = SessionRecord()
+        self.store.storeSession('juliet@capulet.lit', 1, record)
+
+        assert self.store.loadSession('juliet@capulet.lit', 1) is not record
+        assert self.sessions.getCacheInfo()['size'] == 0
+
+
+class TestStoreSession(object):
+
+    def setup_method(self, test_method):
+        self.connection = get_test_db_connection()
+        self.store = LiteAxolotlStore(self.connection)
+
+    def get_session_rows(self):
+        q = 'SELECT recipient_id, device_id, active FROM sessions'
+        return self.connection.execute(q).fetchall()
+
+    def test_store_session_updates_in_place(self):
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+
+        assert len(self.get_session_rows()) == 1
+
+    def test_store_session_keeps_active_state(self):
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+        self.store.storeSession('juliet@capulet.lit', 2, SessionRecord())
+        self.store.sessionStore.setActiveState([2], 'juliet@capulet.lit')
+
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+
+        assert [d for _, d in self.store.getActiveDeviceTuples()] == [2]
+
+    def test_transaction_defers_commit(self, tmpdir):
+        db_path = str(tmpdir.join('omemo.db'))
+        store = LiteAxolotlStore(sqlite3.connect(db_path))
+        reader = sqlite3.connect(db_path)
+        q = 'SELECT COUNT(*) FROM sessions'
+
+        with store.transaction():
+            store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+            store.storeSession('juliet@capulet.lit', 2, SessionRecord())
+            assert reader.execute(q).fetchone()[0] == 0
+
+        assert reader.execute(q).fetchone()[0] == 2
+
+    def test_transaction_rolls_back_on_error(self):
+        record = SessionRecord()
+        try:
+            with self.store.transaction():
+                self.store.storeSession('juliet@capulet.lit', 1, record)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        assert self.get_session_rows() == []
+        assert self.store.loadSession('juliet@capulet.lit', 1) is not record
+
+
+class TestSessionDeviceIds(object):
+
+    def setup_method(self, test_method):
+        self.connection = get_test_db_connection()
+        self.store = LiteAxolotlStore(self.connection)
+        self.queries = []
+        self.connection.set_trace_callback(self.queries.append)
+
+    def selects(self):
+        return [q for q in self.queries if q.startswith('SELECT device_id')]
+
+    def test_one_query_without_records(self):
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+        self.store.storeSession('juliet@capulet.lit', 2, SessionRecord())
+
+        assert self.store.getSessionDeviceIds('juliet@capulet.lit') == {1, 2}
+        assert self.store.getSessionDeviceIds('juliet@capulet.lit') == {1, 2}
+        assert len(self.selects()) == 1
+        assert not [q for q in self.queries if 'record FROM' in q]
+
+    def test_writes_update_the_cached_ids(self):
+        self.store.storeSession('juliet@capulet.lit', 1, SessionRecord())
+        self.store.getSessionDeviceIds('juliet@capulet.lit')
+
+        self.store.storeSession('juliet@capulet.lit', 2, SessionRecord())
+        assert self.store.getSessionDeviceIds('juliet@capulet.lit') == {1, 2}
+        self.store.deleteSession('juliet@capulet.lit', 1)
+        assert self.store.getSessionDeviceIds('juliet@capulet.lit') == {2}
+        self.store.deleteAllSessions('juliet@capulet.lit')
+        assert self.store.getSessionDeviceIds('juliet@capulet.lit') == set()
+        assert len(self.selects()) == 1
+
+    def test_rollback_drops_the_cached_ids(self):
+        self.store.getSessionDeviceIds('juliet@capulet.lit')
+        try:
+            with self.store.transaction():
+                self.store.storeSession('juliet@capulet.lit', 1,
+                                        SessionRecord())
+                raise ValueError()
+        except ValueError:
+            pass
+
+        assert self.store.getSessionDeviceIds('juliet@capulet.lit') == set()
+
+    def test_devices_without_sessions(self):
+        state = get_omemo_state('romeo@montague.lit')
+        state.set_devices('juliet@capulet.lit', [1, 2, 3])
+        state.store.storeSession('juliet@capulet.lit', 2, SessionRecord())
+
+        assert state.devices_without_sessions('juliet@capulet.lit') == [1, 3]
+
+
+class TestSchema(object):
+
+    INDEXES = ('identities_trust_index', 'sessions_device_index',
+               'sessions_active_index')
+
+    def get_indexes(self, connection):
+        q = "SELECT name FROM sqlite_master WHERE type = 'index'"
+        return [row[0].decode() for row in connection.execute(q)]
+
+    def test_migrates_version_5_to_6(self):
+        connection = get_test_db_connection()
+        LiteAxolotlStore(connection)
+        for index in self.INDEXES:
+            connection.execute('DROP INDEX {0}'.format(index))
+        connection.execute('PRAGMA user_version=5')
+
+        SQLDatabase(connection)
+
+        assert user_version(connection) == 6
+        assert set(self.INDEXES) <= set(self.get_indexes(connection))
+
+    def test_journal_modes(self, tmpdir):
+        connection = sqlite3.connect(str(tmpdir.join('omemo.db')))
+        sql = LiteAxolotlStore(connection, journal_mode='wal',
+                               wal_autocheckpoint=50).sql
+
+        assert sql.getJournalMode() == 'wal'
+        assert connection.execute(
+            'PRAGMA wal_autocheckpoint').fetchone()[0] == 50
+        assert sql.checkpoint()[0] == 0
+        # WAL is persistent and kept if no mode is requested
+        assert SQLDatabase(connection).getJournalMode() == 'wal'
+
+        assert sql.setJournalMode('DELETE') == 'delete'
+        assert sql.checkpoint() is None
+        assert SQLDatabase(connection).getJournalMode() == 'memory'
+        with pytest.raises(ValueError):
+            sql.setJournalMode('off')
+
+    def test_hot_queries_use_an_index(self):
+        connection = get_test_db_connection()
+        store = LiteAxolotlStore(connection)
+        state = get_omemo_state('juliet@capulet.lit')
+        identityKey = state.store.getIdentityKeyPair().getPublicKey()
+        jid = 'juliet@capulet.lit'
+        store.storeSession(jid, 1, SessionRecord())
+        store.saveIdentity(jid, identityKey)
+
+        queries = []
+        connection.set_trace_callback(queries.append)
+        store.getIdentityKeyPair()
+        store.getLocalRegistrationId()
+        store.identityKeyStore.getIdentity(jid, identityKey)
+        store.isTrustedIdentity(jid, identityKey)
+        store.setTrust(identityKey, TRUSTED)
+        store.getFingerprints(jid)
+        store.getTrustedFingerprints(jid)
+        store.getUndecidedFingerprints(jid)
+        store.getNewFingerprints(jid)
+        store.sessionStore.invalidateSession(jid, 1)
+        store.loadSession(jid, 1)
+        store.containsSession(jid, 1)
+        store.getSessionDeviceIds(jid)
+        store.getJidFromDevice(1)
+        store.getActiveDeviceTuples()
+        store.getInactiveSessionsKeys(jid)
+        store.sessionStore.setActiveState([1], jid)
+        store.containsPreKey(1)
+        store.loadPreKey(store.preKeyStore.getCurrentPreKeyId())
+        store.containsSignedPreKey(1)
+        connection.set_trace_callback(None)
+
+        queries = [q for q in queries
+                   if q.split()[0] in ('SELECT', 'UPDATE', 'DELETE')]
+        assert len(queries) >= 20
+        for q in queries:
+            plan = connection.execute('EXPLAIN QUERY PLAN ' + q).fetchall()
+            scans = [row[-1] for row in plan
+                     if row[-1].startswith(b'SCAN') and
+                     row[-1] != b'SCAN CONSTANT ROW']
+            assert not scans, q
+
+
+class TestQueries(object):
+
+    def setup_method(self, test_method):
+        self.connection = get_test_db_connection()
+        self.store = LiteAxolotlStore(self.connection)
+
+    def test_all_statements_fit_into_the_statement_cache(self):
+        statements = [value for name, value in vars(queries).items()
+                      if name.isupper() and isinstance(value, str)]
+        assert 40 < len(statements) < queries.CACHED_STATEMENTS
+
+    def test_chunks_are_padded(self):
+        chunks = list(queries.chunks(range(queries.IN_CHUNK_SIZE + 2)))
+
+        assert [len(chunk) for chunk in chunks] == [queries.IN_CHUNK_SIZE] * 2
+        assert set(chunks[1]) == {queries.IN_CHUNK_SIZE,
+                                  queries.IN_CHUNK_SIZE + 1}
+
+    def test_set_active_state_in_chunks(self):
+        # the jid used to be formatted into the SQL
+        jid = "o'brien@example.lit"
+        for device in range(40):
+            self.store.storeSession(jid, device, SessionRecord())
+
+        self.store.sessionStore.setActiveState(list(range(0, 40, 2)), jid)
+
+        active = [d for _, d in self.store.getActiveDeviceTuples()]
+        assert sorted(active) == list(range(0, 40, 2))
+
+    def test_sessions_from_many_jids(self):
+        jids = ['contact{0}@example.lit'.format(i) for i in range(20)]
+        for jid in jids:
+            self.store.storeSession(jid, 1, SessionRecord())
+
+        sessions = self.store.getSessionsFromJids(jids + jids[:2])
+
+        assert len(sessions) == 20
+
+    def test_set_shown_fingerprints_in_chunks(self):
+        for _ in range(20):
+            key = get_omemo_state('juliet@capulet.lit').store \
+                .getIdentityKeyPair().getPublicKey()
+            self.store.saveIdentity('juliet@capulet.lit', key)
+        new = self.store.getNewFingerprints('juliet@capulet.lit')
+        assert len(new) == 20
+
+        self.store.setShownFingerprints(new)
+
+        assert self.store.getNewFingerprints('juliet@capulet.lit') == []
+
+
+class TestTransactionScope(object):
+
+    def setup_method(self, test_method):
+        self.connection = get_test_db_connection()
+        self.store = LiteAxolotlStore(self.connection)
+        self.commits = []
+        self.connection.set_trace_callback(
+            lambda q: q.startswith('COMMIT') and self.commits.append(q))
+
+    def test_transaction_spans_all_stores(self):
+        prekey_count = self.store.preKeyStore.getPreKeyCount()
+        prekey_id = self.store.preKeyStore.getCurrentPreKeyId()
+
+        with pytest.raises(ValueError):
+            with self.store.transaction():
+                self.store.removePreKey(prekey_id)
+                self.store.storeSession('juliet@capulet.lit', 1,
+                                        SessionRecord())
+                self.store.encryptionStore.activate('juliet@capulet.lit')
+                raise ValueError()
+
+        assert self.store.preKeyStore.getPreKeyCount() == prekey_count
+        assert not self.store.containsSession('juliet@capulet.lit', 1)
+        assert not self.store.encryptionStore.exist('juliet@capulet.lit')
+        assert self.commits == []
+
+    def test_nested_transactions_commit_once(self):
+        with self.store.transaction():
+            with self.store.transaction():
+                self.store.encryptionStore.activate('juliet@capulet.lit')
+            self.store.encryptionStore.deactivate('romeo@montague.lit')
+            assert self.commits == []
+
+        assert len(self.commits) == 1
+
+    def test_transaction_depth_is_per_thread(self):
+        depths = []
+        with self.store.transaction():
+            thread = threading.Thread(
+                target=lambda: depths.append(self.store.scope.depth))
+            thread.start()
+            thread.join()
+            assert self.store.scope.depth == 1
+
+        assert depths == [0]
+
+    def test_omemo_state_builds_session_in_one_transaction(self):
+        alice = get_omemo_state('alice@wonderland.lit', self.connection)
+        bob = get_omemo_state('bob@builder.lit')
+        del self.commits[:]
+
+        alice.build_session('bob@builder.lit', bob.own_device_id,
+                            get_bundle_dict(bob))
+
+        assert alice.store.containsSession('bob@builder.lit',
+                                           bob.own_device_id)
+        assert len(self.commits) == 1
+
+    def test_check_prekey_amount_commits_once(self):
+        state = get_omemo_state('alice@wonderland.lit', self.connection)
+        for prekey in state.store.loadPreKeys()[:30]:
+            state.store.removePreKey(prekey.getId())
+        del self.commits[:]
+
+        state.checkPreKeyAmount()
+
+        assert state.store.preKeyStore.getPreKeyCount() == 100
+        assert len(self.commits) == 1
+
+
+class TestPreKeyGeneration(object):
+
+    def setup_method(self, test_method):
+        self.connection = get_test_db_connection()
+        self.store = LiteAxolotlStore(self.connection)
+        self.commits = []
+        self.connection.set_trace_callback(
+            lambda q: q.startswith('COMMIT') and self.commits.append(q))
+
+    def test_generate_new_prekeys_commits_once(self):
+        preKeyStore = self.store.preKeyStore
+        start = preKeyStore.getCurrentPreKeyId()
+        count = preKeyStore.getPreKeyCount()
+
+        preKeyStore.generateNewPreKeys(50)
+
+        assert len(self.commits) == 1
+        assert preKeyStore.getPreKeyCount() == count + 50
+        assert preKeyStore.getCurrentPreKeyId() == start + 50
+
+
+class TestPreKeyReplenisher(object):
+
+    def setup_method(self, test_method):
+        self.state = get_omemo_state('alice@wonderland.lit')
+        self.replenisher = self.state.replenisher
+
+    def remove_prekeys(self, count):
+        for prekey in self.state.store.loadPreKeys()[:count]:
+            self.state.store.removePreKey(prekey.getId())
+
+    def test_bundle_does_not_generate_keys(self):
+        self.remove_prekeys(30)
+
+        assert len(self.state.bundle['prekeys']) == 70
+        assert self.replenisher.replenish_count == 0
+
+    def test_bundle_generates_keys_if_pool_is_empty(self):
+        self.remove_prekeys(100)
+
+        assert len(self.state.bundle['prekeys']) == 100
+        assert self.replenisher.replenish_count == 1
+
+    def test_run_tops_up_the_pool(self):
+        assert self.replenisher.run() is False
+        self.remove_prekeys(30)
+        self.replenisher.schedule()
+
+        assert self.replenisher.run() is True
+
+        metrics = self.replenisher.get_metrics()
+        assert metrics['pool_depth'] == 100
+        assert metrics['replenish_count'] == 1
+        assert metrics['generation_time'] > 0
+        assert metrics['pending'] is False
+
+    def test_run_reports_consumed_prekey(self):
+        self.replenisher.run()
+        self.remove_prekeys(1)
+        self.replenisher.schedule()
+
+        assert self.replenisher.run() is True
+        assert self.replenisher.replenish_count == 0
+        assert self.replenisher.run() is False
+
+
+class TestTrustCache(object):
+
+    def setup_method(self, test_method):
+        self.connection = get_test_db_connection()
+        self.alice = get_omemo_state('alice@wonderland.lit', self.connection)
+        self.store = self.alice.store
+        self.bob = get_omemo_state('bob@builder.lit')
+        self.bob_id = self.bob.own_device_id
+        self.alice.build_session('bob@builder.lit', self.bob_id,
+                                 get_bundle_dict(self.bob))
+        self.bob_key = self.bob.store.getIdentityKeyPair().getPublicKey()
+
+        self.queries = []
+        self.connection.set_trace_callback(
+            lambda q: q.startswith('SELECT trust') and self.queries.append(q))
+
+    def trust(self):
+        return self.store.getDeviceTrust('bob@builder.lit', self.bob_id)
+
+    def test_trust_is_cached(self):
+        assert self.trust() == UNDECIDED
+        assert len(self.queries) == 1
+
+        assert self.trust() == UNDECIDED
+        assert len(self.queries) == 1
+
+    def test_set_trust_updates_cache(self):
+        self.trust()
+        self.store.setTrust(self.bob_key, TRUSTED)
+
+        assert self.trust() == TRUSTED
+
+    def test_set_trust_of_other_key_keeps_cache(self):
+        self.trust()
+        other_key = self.store.getIdentityKeyPair().getPublicKey()
+        self.store.setTrust(other_key, TRUSTED)
+
+        assert self.trust() == UNDECIDED
+        assert len(self.queries) == 1
+
+    def test_delete_identity_updates_cache(self):
+        self.trust()
+        self.store.deleteIdentity('bob@builder.lit', self.bob_key)
+
+        # devices without a stored identity are trusted
+        assert self.trust() is True
+
+    def test_save_identity_updates_cache(self):
+        self.store.deleteIdentity('bob@builder.lit', self.bob_key)
+        assert self.trust() is True
+
+        self.store.saveIdentity('bob@builder.lit', self.bob_key)
+        assert self.trust() == UNDECIDED
+
+    def test_store_session_with_same_identity_keeps_cache(self):
+        self.trust()
+        record = self.store.loadSession('bob@builder.lit', self.bob_id)
+        self.store.storeSession('bob@builder.lit', self.bob_id, record)
+
+        assert self.trust() == UNDECIDED
+        assert len(self.queries) == 1
+
+    def test_store_session_with_new_identity_updates_cache(self):
+        carol = get_omemo_state('carol@wonderland.lit')
+        self.alice.build_session('carol@wonderland.lit', carol.own_device_id,
+                                 get_bundle_dict(carol))
+        carol_key = carol.store.getIdentityKeyPair().getPublicKey()
+        self.store.setTrust(carol_key, TRUSTED)
+        self.store.saveIdentity('bob@builder.lit', carol_key)
+        self.store.setTrust(carol_key, TRUSTED)
+        self.trust()
+
+        record = self.store.loadSession('carol@wonderland.lit',
+                                        carol.own_device_id)
+        self.store.storeSession('bob@builder.lit', self.bob_id, record)
+
+        assert self.trust() == TRUSTED
+
+    def test_delete_session_drops_cache(self):
+        self.trust()
+        self.store.deleteAllSessions('bob@builder.lit')
+
+        assert self.store._trustCache == {}
+
+    def test_rollback_drops_cache(self):
+        with pytest.raises(ValueError):
+            with self.store.transaction():
+                self.store.setTrust(self.bob_key, TRUSTED)
+                assert self.trust() == TRUSTED
+                raise ValueError()
+
+        assert self.trust() == UNDECIDED
+
+
+class TestKeyWrapping(object):
+
+    def create_message(self, key_wrap_workers, device_count=4):
+        alice = OmemoState('alice@wonderland.lit', get_test_db_connection(),
+                           'alice@wonderland.lit', MagicMock(),
+                           key_wrap_workers=key_wrap_workers)
+        devices = []
+        for _ in range(device_count):
+            bob = get_omemo_state('bob@builder.lit')
+            alice.build_session('bob@builder.lit', bob.own_device_id,
+                                get_bundle_dict(bob))
+            alice.store.setTrust(
+                bob.store.getIdentityKeyPair().getPublicKey(), TRUSTED)
+            devices.append(bob)
+        alice.set_devices('bob@builder.lit',
+                          [bob.own_device_id for bob in devices])
+
+        msg = alice.create_msg('alice@wonderland.lit', 'bob@builder.lit',
+                               b'Hello Bob')
+        return alice, devices, msg
+
+    def test_close_stops_the_workers(self):
+        alice, devices, msg = self.create_message(4)
+        executor = alice._key_wrap_executor
+
+        alice.close()
+
+        with pytest.raises(RuntimeError):
+            executor.submit(lambda: None)
+        assert len(alice.create_msg('alice@wonderland.lit', 'bob@builder.lit',
+                                    b'Hello again')['keys']) == 4
+
+    @pytest.mark.parametrize('key_wrap_workers', [0, 4])
+    def test_every_device_can_decrypt(self, key_wrap_workers):
+        alice, devices, msg = self.create_message(key_wrap_workers)
+
+        for bob in devices:
+            msg_dict = {'sid': msg['sid'],
+                        'sender_jid': 'alice@wonderland.lit',
+                        'iv': msg['iv'],
+                        'keys': dict((rid, key) for rid, (key, _)
+                                     in msg['keys'].items()),
+                        'payload': msg['payload']}
+            assert bob.decrypt_msg(msg_dict) == 'Hello Bob'
+
+    def test_keys_are_merged_in_device_order(self):
+        alice, devices, msg = self.create_message(4, device_count=8)
+
+        assert list(msg['keys']) == sorted(bob.own_device_id
+                                           for bob in devices)
+
+    def test_workers_write_in_one_transaction(self):
+        alice, devices, msg = self.create_message(4)
+        commits = []
+        alice.store.sql.dbConn.set_trace_callback(
+            lambda q: q.startswith('COMMIT') and commits.append(q))
+
+        msg = alice.create_msg('alice@wonderland.lit', 'bob@builder.lit',
+                               b'Hello again')
+
+        assert len(msg['keys']) == 4
+        assert len(commits) == 1
+
+    @pytest.mark.parametrize('key_wrap_workers', [0, 4])
+    def test_failed_wrap_drops_the_cached_session(self, key_wrap_workers):
+        alice, devices, msg = self.create_message(key_wrap_workers, 2)
+        targets = [('bob@builder.lit', bob.own_device_id) for bob in devices]
+        records = [alice.store.loadSession(*target) for target in targets]
+
+        # SessionCipher.encrypt fails after it changed the cached record
+        with patch.object(OmemoState, '_encrypt_key',
+                          side_effect=ValueError()):
+            assert alice.wrap_key(b'k' * 32, targets) == {}
+
+        for target, record in zip(targets, records):
+            assert alice.store.loadSession(*target) is not record
+            assert target not in alice.session_ciphers
+
+
+class TestCipherPool(object):
+
+    def create_session(self, **kwargs):
+        alice = OmemoState('alice@wonderland.lit', get_test_db_connection(),
+                           'alice@wonderland.lit', MagicMock(), **kwargs)
+        bob = get_omemo_state('bob@builder.lit')
+        alice.build_session('bob@builder.lit', bob.own_device_id,
+                            get_bundle_dict(bob))
+        alice.store.setTrust(
+            bob.store.getIdentityKeyPair().getPublicKey(), TRUSTED)
+        alice.set_devices('bob@builder.lit', [bob.own_device_id])
+        return alice, bob
+
+    @staticmethod
+    def send(alice, bob, plaintext):
+        msg = alice.create_msg('alice@wonderland.lit', 'bob@builder.lit',
+                               plaintext)
+        msg_dict = {'sid': msg['sid'],
+                    'sender_jid': 'alice@wonderland.lit',
+                    'iv': msg['iv'],
+                    'keys': dict((rid, key) for rid, (key, _)
+                                 in msg['keys'].items()),
+                    'payload': msg['payload']}
+        return bob.decrypt_msg(msg_dict)
+
+    def test_capacity_evicts_least_recently_used(self):
+        state = get_omemo_state('alice@wonderland.lit')
+        state.session_ciphers.set_capacity(2)
+
+        first = state.get_session_cipher('bob@builder.lit', 1)
+        state.get_session_cipher('bob@builder.lit', 2)
+        assert state.get_session_cipher('bob@builder.lit', 1) is first
+        state.get_session_cipher('bob@builder.lit', 3)
+
+        assert ('bob@builder.lit', 1) in state.session_ciphers
+        assert ('bob@builder.lit', 2) not in state.session_ciphers
+        metrics = state.session_ciphers.get_metrics()
+        assert metrics['size'] == 2
+        assert metrics['evictions'] == 1
+        assert metrics['hits'] == 1
+        assert metrics['misses'] == 3
+
+    def test_ttl_evicts_unused_ciphers(self):
+        alice, bob = self.create_session(cipher_ttl=60)
+        pool = alice.session_ciphers
+        cipher = alice.get_session_cipher('bob@builder.lit', bob.own_device_id)
+
+        key = ('bob@builder.lit', bob.own_device_id)
+        pool._ciphers[key] = (cipher, pool._ciphers[key][1] - 61)
+
+        assert alice.get_session_cipher('bob@builder.lit',
+                                        bob.own_device_id) is not cipher
+        assert pool.get_metrics()['evictions'] == 1
+
+    def test_devicelist_removal_evicts(self):
+        alice, bob = self.create_session()
+        alice.get_session_cipher('bob@builder.lit', bob.own_device_id)
+        alice.get_session_cipher('bob@builder.lit', 4711)
+
+        alice.set_devices('bob@builder.lit', [4711])
+
+        assert ('bob@builder.lit', 4711) in alice.session_ciphers
+        assert ('bob@builder.lit',
+                bob.own_device_id) not in alice.session_ciphers
+        assert alice.session_ciphers.get_metrics()['evictions'] == 1
+
+    def test_recreated_cipher_continues_the_session(self):
+        alice, bob = self.create_session(cipher_pool_size=1)
+
+        assert self.send(alice, bob, b'first') == 'first'
+        # push the cipher of bob out of the pool
+        alice.get_session_cipher('carol@example.lit', 1)
+        assert ('bob@builder.lit',
+                bob.own_device_id) not in alice.session_ciphers
+
+        assert self.send(alice, bob, b'second') == 'second'
+        assert self.send(alice, bob, b'third') == 'third'
+
+
+class TestRoomIndex(object):
+
+    room = 'garden@chat.capulet.lit'
+
+    def setup_method(self, test_method):
+        self.state = get_omemo_state('juliet@capulet.lit')
+        self.index = self.state.room_index
+        self.state.set_devices('romeo@montague.lit', [1, 2])
+        self.state.set_devices('nurse@capulet.lit', [3])
+
+    def test_members_are_deduplicated(self):
+        self.index.add_member(self.room, 'romeo', 'romeo@montague.lit')
+        self.index.add_member(self.room, 'romeo2', 'romeo@montague.lit')
+        self.index.add_member(self.room, 'juliet', 'juliet@capulet.lit')
+        self.index.add_member(self.room, 'nurse', 'nurse@capulet.lit')
+
+        assert self.index.devices(self.room) == [
+            ('nurse@capulet.lit', 3),
+            ('romeo@montague.lit', 1),
+            ('romeo@montague.lit', 2)]
+        assert self.index.groupchat[self.room]['juliet'] == \
+            'juliet@capulet.lit'
+
+    def test_devices_are_cached_until_devicelist_changes(self):
+        self.index.add_member(self.room, 'romeo', 'romeo@montague.lit')
+        devices = self.index.devices(self.room)
+
+        assert self.index.devices(self.room) is devices
+
+        self.state.add_device('romeo@montague.lit', 2)
+        assert self.index.devices(self.room) is devices
+
+        self.state.add_device('romeo@montague.lit', 4)
+        assert ('romeo@montague.lit', 4) in self.index.devices(self.room)
+
+        self.state.set_devices('romeo@montague.lit', [5])
+        assert self.index.devices(self.room) == [('romeo@montague.lit', 5)]
+
+    def test_member_stays_while_one_nick_is_present(self):
+        self.index.add_member(self.room, 'romeo', 'romeo@montague.lit')
+        self.index.add_member(self.room, 'romeo2', 'romeo@montague.lit')
+
+        self.index.remove_member(self.room, 'romeo')
+        assert self.index.jids(self.room) == ['romeo@montague.lit']
+
+        self.index.remove_member(self.room, 'romeo2')
+        assert self.index.jids(self.room) == []
+        assert self.index.devices(self.room) == []
+
+    def test_rename_member(self):
+        self.index.add_member(self.room, 'romeo', 'romeo@montague.lit')
+        self.index.rename_member(self.room, 'romeo', 'montague')
+
+        assert self.index.groupchat[self.room] == {
+            'montague': 'romeo@montague.lit'}
+        assert self.index.jids(self.room) == ['romeo@montague.lit']
+
+    def test_remove_room(self):
+        self.index.add_member(self.room, 'romeo', 'romeo@montague.lit')
+        self.index.remove_room(self.room)
+
+        assert self.room not in self.index.groupchat
+        assert self.index.devices(self.room) == []
+
+    def test_index_is_built_from_existing_groupchat(self):
+        plugin = MagicMock()
+        plugin.groupchat = {self.room: {'romeo': 'romeo@montague.lit'}}
+        state = OmemoState('juliet@capulet.lit', get_test_db_connection(),
+                           'juliet@capulet.lit', plugin)
+        state.set_devices('romeo@montague.lit', [1])
+
+        assert state.room_index.devices(self.room) == [
+            ('romeo@montague.lit', 1)]
+
+    def test_create_gc_msg_encrypts_for_every_member(self):
+        members = {}
+        for jid in ('romeo@montague.lit', 'nurse@capulet.lit'):
+            member = get_omemo_state(jid)
+            self.state.build_session(jid, member.own_device_id,
+                                     get_bundle_dict(member))
+            self.state.store.setTrust(
+                member.store.getIdentityKeyPair().getPublicKey(), TRUSTED)
+            self.state.set_devices(jid, [member.own_device_id])
+            self.index.add_member(self.room, jid.split('@')[0], jid)
+            members[jid] = member.own_device_id
+        self.index.add_member(self.room, 'juliet', 'juliet@capulet.lit')
+
+        msg = self.state.create_gc_msg('juliet@capulet.lit', self.room,
+                                       b'Hello garden')
+
+        assert sorted(msg['keys']) == sorted(members.values())
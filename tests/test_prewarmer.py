@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from mock import MagicMock, patch
+
+from profanity_omemo_plugin.prewarmer import SessionPrewarmer
+
+ALICE = 'alice@wonderland.lit'
+JULIET = 'juliet@capulet.lit'
+
+
+class TestSessionPrewarmer(object):
+
+    def setup_method(self, test_method):
+        self.query_device_list = MagicMock()
+        self.query_bundle = MagicMock()
+        self.prewarmer = SessionPrewarmer(self.query_device_list,
+                                          self.query_bundle,
+                                          devicelist_ttl=600)
+        self.state = MagicMock()
+        self.state.own_jid = ALICE
+        self.missing = {JULIET: [1, 2], ALICE: [3]}
+        self.state.devices_without_sessions.side_effect = \
+            lambda jid: self.missing.get(jid, [])
+
+    def test_prewarm_requests_missing_bundles(self):
+        self.prewarmer.prewarm(self.state, JULIET)
+
+        self.query_device_list.assert_called_once_with(JULIET)
+        requested = [c[0] for c in self.query_bundle.call_args_list]
+        assert requested == [(JULIET, 1), (JULIET, 2), (ALICE, 3)]
+
+    @patch('profanity_omemo_plugin.prewarmer.time.time')
+    def test_fresh_devicelist_is_not_requested(self, now):
+        now.return_value = 1000.0
+        self.prewarmer.devicelist_received(JULIET)
+
+        now.return_value = 1500.0
+        self.prewarmer.prewarm(self.state, JULIET)
+        assert not self.query_device_list.called
+
+        now.return_value = 1700.0
+        self.prewarmer.prewarm(self.state, JULIET)
+        assert self.query_device_list.called
+
+    def test_first_message_latency(self):
+        self.prewarmer.prewarm(self.state, JULIET)
+        self.prewarmer.first_message_sent(JULIET, 0.0)
+        self.prewarmer.first_message_sent(JULIET, 5.0)
+        self.prewarmer.first_message_sent('romeo@montague.lit', 1.5)
+
+        assert not self.prewarmer.is_first_message(JULIET)
+        metrics = self.prewarmer.get_metrics()
+        assert metrics['prewarmed_messages'] == 1
+        assert metrics['prewarmed_latency'] == 0.0
+        assert metrics['cold_messages'] == 1
+        assert metrics['cold_latency'] == 1.5
@@ -2,9 +2,11 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import logging
 import os
 import sys
 
+import pytest
 from mock import MagicMock, patch
 
 here = os.path.abspath(os.path.dirname(__file__))
@@ -14,8 +16,12 @@ sys.path.append(deploy_root)
 # we need to mock the prof module as it is not available outside profanity
 sys.modules['prof'] = MagicMock()
 import prof_omemo_plugin as plugin
+import profanity_omemo_plugin.xmpp as xmpp
 from profanity_omemo_plugin.constants import NS_OMEMO, NS_DEVICE_LIST
-from profanity_omemo_plugin.prof_omemo_state import ProfActiveOmemoChats, ProfOmemoUser
+from profanity_omemo_plugin.omemo.state import log as state_log
+from profanity_omemo_plugin.xmpp import logger as xmpp_log
+from profanity_omemo_plugin.prof_omemo_state import ProfActiveOmemoChats, \
+    ProfOmemoUser, ProfOmemoState
 
 
 class TestPluginHooks(object):
@@ -183,3 +189,258 @@ class TestPluginHooks(object):
         stanza = '<message to="{}"></message>'.format(recipient)
 
         assert func(stanza) == 'enabled_first'
+
+    @patch('prof_omemo_plugin._announce_own_bundle')
+    @patch('profanity_omemo_plugin.omemo.replenisher.PreKeyReplenisher.run')
+    def test_replenish_prekeys_announces_changed_bundle(self, run, announce):
+        run.return_value = False
+        plugin._replenish_prekeys()
+        assert not announce.called
+
+        run.return_value = True
+        plugin._replenish_prekeys()
+        assert announce.called
+
+    @patch('profanity_omemo_plugin.omemo.replenisher.PreKeyReplenisher.run')
+    def test_replenish_prekeys_requires_user(self, run):
+        ProfOmemoUser.reset()
+        plugin._replenish_prekeys()
+
+        assert not run.called
+
+    @patch('prof.settings_int_get')
+    @patch('prof.settings_string_get')
+    def test_journal_mode_setting_is_applied(self, settings_string_get,
+                                             settings_int_get):
+        settings_int_get.return_value = 100
+        sql = ProfOmemoState().store.sql
+        try:
+            settings_string_get.return_value = 'wal'
+            plugin._set_journal_mode_setting('WAL')
+
+            assert sql.getJournalMode() == 'wal'
+            assert sql.dbConn.execute(
+                'PRAGMA wal_autocheckpoint').fetchone()[0] == 100
+            assert sql.checkpoint() is not None
+        finally:
+            settings_string_get.return_value = 'memory'
+            plugin._apply_journal_mode()
+
+        assert sql.getJournalMode() == 'memory'
+        assert sql.checkpoint() is None
+
+    @patch('prof.settings_string_set')
+    def test_journal_mode_setting_rejects_unknown_modes(self,
+                                                       settings_string_set):
+        plugin._set_journal_mode_setting('off')
+
+        assert not settings_string_set.called
+
+    @patch('prof.settings_string_set')
+    def test_log_level_setting_is_applied(self, settings_string_set):
+        try:
+            plugin._set_log_level_setting('WARNING')
+
+            settings_string_set.assert_called_with('omemo', 'log_level',
+                                                   'warning')
+            assert not plugin.log.isEnabledFor(logging.INFO)
+            assert not xmpp_log.isEnabledFor(logging.INFO)
+            assert not state_log.isEnabledFor(logging.INFO)
+        finally:
+            plugin._set_log_level_setting('info')
+
+        assert plugin.log.isEnabledFor(logging.INFO)
+        assert not plugin.log.isEnabledFor(logging.DEBUG)
+
+    @patch('prof.settings_string_set')
+    def test_log_level_setting_rejects_unknown_levels(self,
+                                                      settings_string_set):
+        plugin._set_log_level_setting('verbose')
+
+        assert not settings_string_set.called
+
+    @patch('prof_omemo_plugin.send_stanza')
+    @patch('profanity_omemo_plugin.xmpp.create_encrypted_message')
+    @patch('prof.settings_boolean_get')
+    @patch('prof_omemo_plugin._query_bundle_info_for')
+    @patch('profanity_omemo_plugin.xmpp.unpack_bundle_info')
+    @patch('profanity_omemo_plugin.omemo.state.OmemoState.build_session')
+    @patch('profanity_omemo_plugin.omemo.state.OmemoState.devices_without_sessions')
+    def test_message_is_queued_until_sessions_exist(self, devices_mock,
+                                                    build_session, unpack,
+                                                    query_bundle,
+                                                    settings_boolean_get,
+                                                    create_message,
+                                                    send_stanza):
+        settings_boolean_get.return_value = True
+        create_message.return_value = '<message/>'
+        recipient = 'juliet@capulet.lit'
+        ProfActiveOmemoChats.add(recipient)
+        devices_mock.return_value = [4711]
+        message = '/quit\n"Hello"'
+
+        try:
+            ret_val = plugin.prof_pre_chat_message_send(recipient, message)
+
+            assert ret_val is None
+            assert query_bundle.called
+            assert len(plugin.pending_messages.pending(recipient)) == 1
+
+            unpack.return_value = {'sender': recipient, 'device': 4711}
+            devices_mock.return_value = []
+            plugin._handle_bundle_update('<iq/>')
+
+            # the text is encrypted as typed, not parsed as a command
+            create_message.assert_called_once_with(
+                'me@there.com/profanity', recipient, message.encode('utf-8'))
+            send_stanza.assert_called_once_with('<message/>')
+            assert plugin.pending_messages.pending(recipient) == []
+        finally:
+            plugin.pending_messages.clear()
+
+    @patch('prof_omemo_plugin.send_stanza')
+    @patch('profanity_omemo_plugin.xmpp.create_encrypted_message')
+    @patch('prof.settings_boolean_get')
+    @patch('prof_omemo_plugin._query_bundle_info_for')
+    @patch('profanity_omemo_plugin.omemo.state.OmemoState.devices_without_sessions')
+    def test_message_is_queued_behind_pending_messages(self, devices_mock,
+                                                       query_bundle,
+                                                       settings_boolean_get,
+                                                       create_message,
+                                                       send_stanza):
+        settings_boolean_get.return_value = True
+        recipient = 'juliet@capulet.lit'
+        ProfActiveOmemoChats.add(recipient)
+        devices_mock.return_value = [4711]
+
+        try:
+            plugin.prof_pre_chat_message_send(recipient, 'First')
+
+            # the session arrived, but the first message was not sent yet
+            devices_mock.return_value = []
+            create_message.side_effect = lambda sender, to, text: text
+            ret_val = plugin.prof_pre_chat_message_send(recipient, 'Second')
+
+            assert ret_val is None
+            assert [c[0][0] for c in send_stanza.call_args_list] == \
+                [b'First', b'Second']
+            assert plugin.pending_messages.pending(recipient) == []
+        finally:
+            plugin.pending_messages.clear()
+
+    @pytest.mark.parametrize('hook', [
+        lambda: plugin.prof_on_disconnect('me@there.com',
+                                          'me@there.com/profanity'),
+        plugin.prof_on_shutdown])
+    def test_pending_messages_are_dropped_on_disconnect(self, hook):
+        plugin.pending_messages.add({'to': 'juliet@capulet.lit',
+                                     'message': 'Hello'})
+
+        hook()
+
+        assert len(plugin.pending_messages) == 0
+
+    @patch('prof.settings_boolean_get')
+    @patch('prof_omemo_plugin.ProfOmemoState')
+    def test_decrypted_message_triggers_pending_messages(self, omemo_state,
+                                                         settings_boolean_get):
+        settings_boolean_get.return_value = True
+        recipient = 'juliet@capulet.lit'
+        ProfActiveOmemoChats.add(recipient)
+        omemo_state.return_value.decrypt_msg.return_value = 'Hello'
+        stanza = ('<message from="juliet@capulet.lit/balcony" '
+                  'to="me@there.com/profanity" type="chat">'
+                  '<encrypted xmlns="{0}"><header sid="4711">'
+                  '<key rid="1">a2V5</key><iv>aXY=</iv></header>'
+                  '<payload>cGF5bG9hZA==</payload></encrypted>'
+                  '</message>').format(NS_OMEMO)
+
+        with patch.object(plugin.pending_messages, 'trigger') as trigger:
+            assert plugin.prof_on_message_stanza_receive(stanza) is False
+
+        assert trigger.called
+
+    @patch('prof_omemo_plugin.send_stanza')
+    @patch('prof.settings_boolean_get')
+    @patch('profanity_omemo_plugin.omemo.state.OmemoState.devices_without_sessions')
+    def test_bundle_requests_are_deduplicated(self, devices_mock,
+                                              settings_boolean_get,
+                                              send_stanza):
+        settings_boolean_get.return_value = True
+        send_stanza.return_value = True
+        recipient = 'juliet@capulet.lit'
+        ProfActiveOmemoChats.add(recipient)
+        devices_mock.side_effect = lambda jid: [4711] if jid == recipient else []
+
+        suppressed = plugin.outstanding_requests.suppressed
+        try:
+            for _ in range(5):
+                plugin.prof_pre_chat_message_send(recipient, 'Hello')
+
+            assert send_stanza.call_count == 1
+            assert plugin.outstanding_requests.suppressed == suppressed + 4
+
+            request = send_stanza.call_args[0][0]
+            response = '<iq type="result" id="{0}" from="{1}"/>'.format(
+                xmpp.get_stanza_id(request), recipient)
+            plugin.prof_on_iq_stanza_receive(response)
+            plugin.prof_pre_chat_message_send(recipient, 'Hello')
+
+            assert send_stanza.call_count == 2
+        finally:
+            plugin.pending_messages.clear()
+            plugin.outstanding_requests.clear()
+
+    @patch.object(plugin.prewarmer, 'query_device_list')
+    @patch.object(plugin.prewarmer, 'query_bundle')
+    @patch('prof.settings_boolean_get')
+    @patch('profanity_omemo_plugin.omemo.state.OmemoState.devices_without_sessions')
+    def test_focus_prewarms_sessions(self, devices_mock, settings_boolean_get,
+                                     query_bundle, query_device_list):
+        settings_boolean_get.return_value = True
+        recipient = 'juliet@capulet.lit'
+        ProfActiveOmemoChats.add(recipient)
+        devices_mock.side_effect = lambda jid: [4711] if jid == recipient else []
+
+        try:
+            plugin.prof_on_chat_win_focus(recipient)
+
+            query_device_list.assert_called_once_with(recipient)
+            query_bundle.assert_called_once_with(recipient, 4711)
+
+            settings_boolean_get.return_value = False
+            plugin.prof_on_chat_win_focus(recipient)
+            assert query_bundle.call_count == 1
+        finally:
+            plugin.prewarmer.reset()
+
+    @patch('prof_omemo_plugin.send_stanza')
+    @patch('prof.settings_boolean_get')
+    def test_muc_presence_updates_room_index(self, settings_boolean_get,
+                                             send_stanza):
+        settings_boolean_get.return_value = True
+        room = 'coven@chat.shakespeare.lit'
+        presence = ('<presence from="{0}/{1}"{2}>'
+                    '<x xmlns="http://jabber.org/protocol/muc#user">'
+                    '<item jid="hag66@shakespeare.lit/pda" role="participant"/>'
+                    '</x></presence>')
+        room_index = ProfOmemoState().room_index
+
+        assert plugin.prof_on_presence_stanza_receive(
+            presence.format(room, 'thirdwitch', '')) is True
+        assert room_index.jids(room) == ['hag66@shakespeare.lit']
+        # OMEMO is not used in the room, no devicelists are fetched
+        assert not send_stanza.called
+
+        try:
+            plugin._start_omemo_session(room)
+            sent = [call[0][0] for call in send_stanza.call_args_list]
+            assert any('to="hag66@shakespeare.lit"' in stanza
+                       for stanza in sent)
+        finally:
+            ProfActiveOmemoChats.reset()
+            plugin.outstanding_requests.clear()
+
+        plugin.prof_on_presence_stanza_receive(
+            presence.format(room, 'thirdwitch', ' type="unavailable"'))
+        assert room_index.jids(room) == []
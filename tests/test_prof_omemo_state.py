@@ -68,6 +68,23 @@ class TestProfOmemoUtils(object):
 
         assert state == new_state
 
+    @patch('profanity_omemo_plugin.prof_omemo_state.get_connection')
+    def test_reset_omemo_user_closes_state(self, mockdb):
+        connection = get_test_db_connection()
+        mockdb.return_value = connection
+
+        ProfOmemoUser.set_user('me@there.com', 'me@there.com/profanity')
+        state = ProfOmemoState()
+        with patch.object(state, 'close') as close_state:
+            ProfOmemoUser.reset()
+
+        assert close_state.called
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute('SELECT 1')
+        mockdb.return_value = get_test_db_connection()
+        ProfOmemoUser.set_user('me@there.com', 'me@there.com/profanity')
+        assert ProfOmemoState() is not state
+
     @patch('profanity_omemo_plugin.db.get_connection')
     def test_omemo_state_raises_runtime_error_if_not_connected(self, mockdb):
         mockdb.return_value = get_test_db_connection()
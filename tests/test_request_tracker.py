@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from mock import patch
+
+from profanity_omemo_plugin.request_tracker import DEVICELIST, RequestTracker
+
+JULIET = 'juliet@capulet.lit'
+
+
+class TestRequestTracker(object):
+
+    def test_duplicates_are_suppressed(self):
+        tracker = RequestTracker()
+        assert not tracker.is_pending((JULIET, 4711))
+        tracker.add((JULIET, 4711), 'iq1')
+
+        for _ in range(4):
+            assert tracker.is_pending((JULIET, 4711))
+        assert not tracker.is_pending((JULIET, DEVICELIST))
+
+        metrics = tracker.get_metrics()
+        assert metrics['sent'] == 1
+        assert metrics['suppressed'] == 4
+
+    def test_response_completes_request(self):
+        tracker = RequestTracker()
+        tracker.add((JULIET, DEVICELIST), 'iq1')
+
+        assert tracker.complete('unknown') is None
+        assert tracker.complete('iq1') == (JULIET, DEVICELIST)
+        assert not tracker.is_pending((JULIET, DEVICELIST))
+        assert len(tracker) == 0
+
+    @patch('profanity_omemo_plugin.request_tracker.time.time')
+    def test_unanswered_request_expires(self, now):
+        tracker = RequestTracker(ttl=30)
+        now.return_value = 100.0
+        tracker.add((JULIET, 4711), 'iq1')
+
+        now.return_value = 131.0
+        assert not tracker.is_pending((JULIET, 4711))
+        assert tracker.get_metrics()['expired'] == 1
+
+        tracker.add((JULIET, 4711), 'iq2')
+        assert tracker.complete('iq1') is None
+        assert tracker.complete('iq2') == (JULIET, 4711)
@@ -2,6 +2,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import logging
+import random
 import sqlite3
 
 import pytest
@@ -9,9 +11,11 @@ from mock import patch
 
 import profanity_omemo_plugin.xmpp as xmpp
 from profanity_omemo_plugin.constants import NS_DEVICE_LIST, NS_OMEMO
+from profanity_omemo_plugin.log import set_log_level
 from profanity_omemo_plugin.prof_omemo_state import ProfOmemoUser, \
     ProfOmemoState
 from .fixtures import get_stanza_fixture
+from .test_omemo_store import get_bundle_dict, get_omemo_state
 
 
 def get_test_db_connection():
@@ -133,4 +137,338 @@ class TestUnpackingXMPP(object):
                       '</message>'
                       ).format(recipient)
 
-        encrypted = xmpp.encrypt_stanza(raw_stanza)
\ No newline at end of file
+        encrypted = xmpp.encrypt_stanza(raw_stanza)
+
+class TestParsedStanza(object):
+
+    def test_parsed_stanza_exposes_root_attributes(self):
+        stanza = get_stanza_fixture('iq_bundle_info.xml')
+        parsed = xmpp.parse_stanza(stanza)
+
+        assert parsed.from_jid == 'bob@secure.it'
+        assert parsed.to_jid == 'alice@secure.it/profanity'
+        assert parsed.id == 'bundle_msg_1'
+        assert '{http://jabber.org/protocol/pubsub}pubsub' in parsed.children
+
+    def test_get_stanza_id(self):
+        stanza = ('<iq type="result" id=\'bundle1\' to="me@there.com">'
+                  '<pubsub id="inner"/></iq>')
+
+        assert xmpp.get_stanza_id(stanza) == 'bundle1'
+        assert xmpp.get_stanza_id(stanza.encode('utf-8')) == 'bundle1'
+        assert xmpp.get_stanza_id(xmpp.parse_stanza(stanza)) == 'bundle1'
+        assert xmpp.get_stanza_id('<iq type="result"><a id="x"/></iq>') is None
+
+    def test_parse_stanza_returns_parsed_stanza_unchanged(self):
+        parsed = xmpp.parse_stanza('<message to="juliet@capulet.lit"/>')
+
+        assert xmpp.parse_stanza(parsed) is parsed
+
+    def test_unpackers_accept_parsed_stanza(self):
+        stanza = get_stanza_fixture('iq_bundle_info.xml')
+        parsed = xmpp.parse_stanza(stanza)
+
+        assert xmpp.is_bundle_update(parsed) is True
+        assert xmpp.is_devicelist_update(parsed) is False
+        assert xmpp.unpack_bundle_info(parsed)['device'] == '666666'
+        assert xmpp.get_root_attrib(parsed, 'id') == 'bundle_msg_1'
+
+    def test_stanza_is_parsed_once(self):
+        stanza = get_stanza_fixture('iq_bundle_info.xml')
+
+        with patch.object(xmpp, 'stanza_as_xml',
+                          wraps=xmpp.stanza_as_xml) as parse_mock:
+            parsed = xmpp.parse_stanza(stanza)
+            xmpp.is_bundle_update(parsed)
+            xmpp.is_devicelist_update(parsed)
+            xmpp.unpack_bundle_info(parsed)
+
+        assert parse_mock.call_count == 1
+
+    def test_classifiers_ignore_words_in_body(self):
+        stanza = ('<message to="juliet@capulet.lit" from="romeo@montague.lit">'
+                  '<body>encrypted {0}</body>'
+                  '</message>').format(NS_DEVICE_LIST)
+
+        assert xmpp.is_encrypted_message(stanza) is False
+        assert xmpp.is_devicelist_update(stanza) is False
+        assert xmpp.is_xmpp_plaintext_message(stanza) is True
+
+
+class TestClassifyStanza(object):
+
+    def test_classify_plain_message_as_irrelevant(self):
+        stanza = ('<message to="juliet@capulet.lit" type="chat">'
+                  '<body>encrypted body</body></message>')
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_IRRELEVANT
+
+    def test_classify_namespace_in_body_as_irrelevant(self):
+        stanza = ('<message to="juliet@capulet.lit" type="chat">'
+                  '<body>&lt;encrypted xmlns="{0}"&gt; {1}</body>'
+                  '</message>').format(NS_OMEMO, NS_DEVICE_LIST)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_IRRELEVANT
+
+    def test_classify_omemo_message(self):
+        stanza = ('<message to="juliet@capulet.lit" type="chat">'
+                  '<body>I sent you an OMEMO encrypted message.</body>'
+                  '<encrypted xmlns="{0}"><header sid="1"/></encrypted>'
+                  '</message>').format(NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_OMEMO_MESSAGE
+
+    def test_classify_prefixed_omemo_message(self):
+        stanza = ('<message xmlns:o="{0}" title="a > b">'
+                  '<o:encrypted><o:header sid="1"/></o:encrypted>'
+                  '</message>').format(NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_OMEMO_MESSAGE
+
+    def test_classify_carbon_copy(self):
+        stanza = ('<message to="romeo@montague.lit/profanity">'
+                  '<received xmlns="urn:xmpp:carbons:2">'
+                  '<forwarded xmlns="urn:xmpp:forward:0">'
+                  '<message xmlns="jabber:client" from="juliet@capulet.lit/pda">'
+                  '<encrypted xmlns="{0}"><header sid="1"/></encrypted>'
+                  '</message></forwarded></received></message>'
+                  ).format(NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_FORWARDED
+
+    def test_classify_devicelist_event(self):
+        stanza = ('<message from="juliet@capulet.lit">'
+                  '<event xmlns="http://jabber.org/protocol/pubsub#event">'
+                  '<items node="{0}"><item><list xmlns="{1}">'
+                  '<device id="12345" /></list></item></items>'
+                  '</event></message>').format(NS_DEVICE_LIST, NS_OMEMO)
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_DEVICELIST
+
+    def test_classify_bundle_result(self):
+        stanza = get_stanza_fixture('iq_bundle_info.xml')
+
+        assert xmpp.classify_stanza(stanza) == xmpp.STANZA_BUNDLE
+
+
+class TestStreamingBundleInfo(object):
+
+    @staticmethod
+    def create_bundle(prekey_count):
+        prekeys = ''.join(
+            '<preKeyPublic preKeyId="{0}">BQw8uYlgoCTPIzUMlhJlLYyY+t848TCm0kFN'
+            'Ef4C1i00</preKeyPublic>'.format(i) for i in range(1, prekey_count + 1)
+        )
+        return ('<iq from="bob@secure.it/pda" type="result" id="1">'
+                '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
+                '<items node="{0}.bundles:4711"><item>'
+                '<bundle xmlns="{0}">'
+                '<signedPreKeyPublic signedPreKeyId="2">BZGk</signedPreKeyPublic>'
+                '<signedPreKeySignature>ypCX</signedPreKeySignature>'
+                '<identityKey>BQw8</identityKey>'
+                '<prekeys>{1}</prekeys>'
+                '</bundle></item></items></pubsub></iq>').format(NS_OMEMO, prekeys)
+
+    def test_stream_bundle_info_matches_tree_path(self):
+        for name in ('iq_bundle_info.xml', 'iq_bundle_info_chatsecure.xml'):
+            stanza = get_stanza_fixture(name)
+            streamed = xmpp.stream_bundle_info(stanza)
+            parsed = xmpp.unpack_bundle_info(xmpp.parse_stanza(stanza))
+
+            streamed.pop('preKeyId'), streamed.pop('preKeyPublic')
+            parsed.pop('preKeyId'), parsed.pop('preKeyPublic')
+            assert streamed == parsed
+
+    def test_stream_bundle_info_picks_a_prekey(self):
+        bundle_info = xmpp.stream_bundle_info(self.create_bundle(1000))
+
+        assert bundle_info['sender'] == 'bob@secure.it'
+        assert bundle_info['device'] == '4711'
+        assert bundle_info['signedPreKeyId'] == 2
+        assert 1 <= bundle_info['preKeyId'] <= 1000
+
+    def test_stream_bundle_info_stops_after_bundle(self):
+        stanza = self.create_bundle(10) + '<not-closed>'
+
+        assert xmpp.stream_bundle_info(stanza) is not None
+
+    def test_stream_bundle_info_rejects_incomplete_bundle(self):
+        stanza = self.create_bundle(10).replace(
+            '<identityKey>BQw8</identityKey>', '')
+
+        assert xmpp.stream_bundle_info(stanza) is None
+
+    def test_pick_prekey_is_uniform(self):
+        rng = random.Random(42)
+        picks = [xmpp.pick_prekey(iter(range(4)), rng=rng) for _ in range(4000)]
+
+        for prekey in range(4):
+            assert 800 < picks.count(prekey) < 1200
+
+
+class TestOwnBundleStanza(object):
+
+    def setup_method(self, test_method):
+        self.omemo_state = get_omemo_state('bundle@cache.lit')
+        xmpp._own_bundle_cache.clear()
+        self.state_patch = patch.object(xmpp, 'ProfOmemoState',
+                                        return_value=self.omemo_state)
+        self.state_patch.start()
+
+    def teardown_method(self, test_method):
+        self.state_patch.stop()
+
+    @staticmethod
+    def prekey_ids(stanza):
+        xml = xmpp.stanza_as_xml(stanza)
+        tag = '{%s}preKeyPublic' % NS_OMEMO
+        return [int(node.attrib['preKeyId']) for node in xml.iter(tag)]
+
+    def test_own_bundle_stanza_contains_bundle(self):
+        stanza = xmpp.create_own_bundle_stanza()
+        xml = xmpp.stanza_as_xml(stanza)
+
+        for name in ('signedPreKeyPublic', 'signedPreKeySignature',
+                     'identityKey'):
+            assert xml.find('.//{%s}%s' % (NS_OMEMO, name)).text
+        prekeys = self.omemo_state.store.loadPreKeys()
+        assert len(self.prekey_ids(stanza)) == len(prekeys)
+
+    def test_own_bundle_stanza_is_cached(self):
+        first = xmpp.create_own_bundle_stanza()
+
+        with patch.object(self.omemo_state.store.preKeyStore,
+                          'loadPendingPreKeys') as load_prekeys:
+            second = xmpp.create_own_bundle_stanza()
+
+        assert not load_prekeys.called
+        assert self.prekey_ids(first) == self.prekey_ids(second)
+
+    def test_own_bundle_stanza_follows_removed_prekey(self):
+        prekey_ids = self.prekey_ids(xmpp.create_own_bundle_stanza())
+        store = self.omemo_state.store
+
+        with patch.object(store.preKeyStore,
+                          'loadPendingPreKeys') as load_prekeys:
+            store.removePreKey(prekey_ids[0])
+            store.removePreKey(prekey_ids[0])
+            stanza = xmpp.create_own_bundle_stanza()
+
+        assert not load_prekeys.called
+        assert self.prekey_ids(stanza) == prekey_ids[1:]
+
+    def test_own_bundle_stanza_follows_rollback(self):
+        prekey_ids = self.prekey_ids(xmpp.create_own_bundle_stanza())
+        store = self.omemo_state.store
+
+        with pytest.raises(ValueError):
+            with store.transaction():
+                store.removePreKey(prekey_ids[0])
+                raise ValueError()
+
+        assert self.prekey_ids(xmpp.create_own_bundle_stanza()) == prekey_ids
+
+    def reconnect(self):
+        # a reconnect builds a new state on the same db
+        connection = self.omemo_state.store.sql.dbConn
+        self.omemo_state = get_omemo_state('bundle@cache.lit', connection)
+        xmpp.ProfOmemoState.return_value = self.omemo_state
+
+    def test_own_bundle_stanza_follows_rebuilt_state(self):
+        self.reconnect()
+        prekey_ids = self.prekey_ids(xmpp.create_own_bundle_stanza())
+        self.omemo_state.store.removePreKey(prekey_ids[0])
+
+        self.reconnect()
+
+        assert self.prekey_ids(xmpp.create_own_bundle_stanza()) == \
+            prekey_ids[1:]
+
+
+class TestEncryptedMessage(object):
+
+    def setup_method(self, test_method):
+        account = 'alice@wonderland.lit'
+        ProfOmemoUser.set_user(account, account + '/profanity')
+        self.alice = ProfOmemoState()
+        self.bob = get_omemo_state('bob@builder.lit')
+        self.alice.build_session('bob@builder.lit', self.bob.own_device_id,
+                                 get_bundle_dict(self.bob))
+        self.alice.set_devices('bob@builder.lit', [self.bob.own_device_id])
+
+    def teardown_method(self, test_method):
+        ProfOmemoUser.reset()
+
+    @pytest.mark.parametrize('body', ['Hello Bob', 'x' * 100000])
+    def test_encrypt_stanza_roundtrip(self, body):
+        stanza = ('<message to="bob@builder.lit/pda" id="msg1" type="chat">'
+                  '<body>{0}</body></message>').format(body)
+
+        encrypted = xmpp.encrypt_stanza(stanza)
+        msg_dict = xmpp.unpack_encrypted_stanza(encrypted)
+
+        assert msg_dict['sender_jid'] == 'alice@wonderland.lit'
+        assert self.bob.decrypt_msg(msg_dict) == body
+
+    def test_plaintext_is_not_logged(self, caplog):
+        body = 'Meet me at the secret place'
+        stanza = ('<message to="bob@builder.lit/pda" id="msg1" type="chat">'
+                  '<body>{0}</body></message>').format(body)
+
+        set_log_level('debug')
+        try:
+            with caplog.at_level(logging.DEBUG):
+                encrypted = xmpp.encrypt_stanza(stanza)
+                msg_dict = xmpp.unpack_encrypted_stanza(encrypted)
+                assert self.bob.decrypt_msg(msg_dict) == body
+        finally:
+            set_log_level('info')
+
+        assert caplog.records
+        assert all(body not in record.getMessage()
+                   for record in caplog.records)
+
+
+class TestMucPresence(object):
+
+    @staticmethod
+    def presence(nick='thirdwitch', jid='hag66@shakespeare.lit/pda',
+                 type_=None, codes=(), new_nick=None):
+        attrib = ' jid="{0}"'.format(jid) if jid else ''
+        if new_nick:
+            attrib += ' nick="{0}"'.format(new_nick)
+        return ('<presence from="coven@chat.shakespeare.lit/{0}"{1}>'
+                '<x xmlns="http://jabber.org/protocol/muc#user">'
+                '<item affiliation="member" role="participant"{2}/>'
+                '{3}'
+                '</x></presence>').format(
+                    nick, ' type="{0}"'.format(type_) if type_ else '', attrib,
+                    ''.join('<status code="{0}"/>'.format(c) for c in codes))
+
+    def test_unpack_join(self):
+        presence = xmpp.unpack_muc_presence(self.presence())
+
+        assert presence == {'room': 'coven@chat.shakespeare.lit',
+                            'nick': 'thirdwitch',
+                            'jid': 'hag66@shakespeare.lit',
+                            'available': True,
+                            'self': False,
+                            'new_nick': None}
+
+    def test_unpack_anonymous_room(self):
+        assert xmpp.unpack_muc_presence(self.presence(jid=None))['jid'] is None
+
+    def test_unpack_leave_and_nick_change(self):
+        leave = xmpp.unpack_muc_presence(
+            self.presence(type_='unavailable', codes=['110']))
+        assert not leave['available'] and leave['self']
+
+        rename = xmpp.unpack_muc_presence(
+            self.presence(type_='unavailable', codes=['303'],
+                          new_nick='oldhag'))
+        assert rename['new_nick'] == 'oldhag'
+
+    def test_unpack_plain_presence(self):
+        stanza = '<presence from="romeo@montague.lit/orchard"/>'
+
+        assert xmpp.unpack_muc_presence(stanza) is None
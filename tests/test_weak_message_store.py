@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+from mock import patch
+
+from profanity_omemo_plugin.weak_message_store import WeakMessageStore
+
+JULIET = 'juliet@capulet.lit'
+ROMEO = 'romeo@montague.lit'
+
+
+class TestWeakMessageStore(object):
+
+    def setup_method(self, test_method):
+        self.posted = []
+        self.ready = set()
+        self.store = WeakMessageStore(self.posted.append,
+                                      lambda jid: jid in self.ready,
+                                      max_size=3, timeout=60)
+
+    def message(self, to, text):
+        return {'to': to, 'message': text}
+
+    def test_messages_wait_for_sessions(self):
+        self.store.add(self.message(JULIET, 'one'))
+
+        assert self.store.trigger() == 0
+        assert self.posted == []
+        assert len(self.store) == 1
+
+    def test_trigger_posts_ready_messages_in_order(self):
+        for text in ('one', 'two'):
+            self.store.add(self.message(JULIET, text))
+        self.store.add(self.message(ROMEO, 'three'))
+        self.ready.add(JULIET)
+
+        assert self.store.trigger() == 2
+        assert [m['message'] for m in self.posted] == ['one', 'two']
+        assert self.store.pending(JULIET) == []
+        assert len(self.store.pending(ROMEO)) == 1
+
+    @patch('profanity_omemo_plugin.weak_message_store.time.time')
+    def test_latency_is_measured_until_posted(self, now):
+        now.return_value = 100.0
+        self.store.add(self.message(JULIET, 'one'))
+        now.return_value = 102.5
+        self.ready.add(JULIET)
+        self.store.trigger()
+
+        metrics = self.store.get_metrics()
+        assert metrics['sent'] == 1
+        assert metrics['avg_latency'] == 2.5
+        assert metrics['max_latency'] == 2.5
+
+    def test_full_store_drops_oldest_message(self):
+        for text in ('one', 'two', 'three', 'four'):
+            self.store.add(self.message(JULIET, text))
+
+        assert len(self.store) == 3
+        assert [m['message'] for m in self.store.on_timeout()] == ['one']
+        assert self.store.get_metrics()['dropped'] == 1
+
+    @patch('profanity_omemo_plugin.weak_message_store.time.time')
+    def test_on_timeout_returns_stale_messages(self, now):
+        now.return_value = 100.0
+        self.store.add(self.message(JULIET, 'one'))
+        now.return_value = 150.0
+        self.store.add(self.message(ROMEO, 'two'))
+
+        now.return_value = 170.0
+        stale = self.store.on_timeout()
+
+        assert [m['message'] for m in stale] == ['one']
+        assert self.store.pending(JULIET) == []
+        assert len(self.store) == 1
+        assert self.store.get_metrics()['expired'] == 1